@@ -5,6 +5,7 @@ import os
 import subprocess
 import re
 import argparse
+import functools
 from string import Template
 import csv
 import codecs
@@ -18,6 +19,8 @@ from psycopg2 import Error
 #~ local imports
 import db_config
 import PG_status
+import PG_ingest
+import CSV2PG_boots_products
 
 
 def args_setup():
@@ -29,6 +32,12 @@ def args_setup():
         "-i", "--input", type=argparse.FileType("r"), default=sys.stdin,
         metavar="PATH",
         help="CSV file to import.")
+    PG_ingest.add_ingest_arguments(parser)
+    PG_ingest.add_batch_arguments(parser)
+    PG_ingest.add_validation_arguments(parser)
+    parser.add_argument(
+        "--upgrade", action="store_true",
+        help="Bring an existing boots_transactions table up to date (adds and fills STORE_CODE, PRODUCT_KEY and the daily summary), then exit.")
 
     args = parser.parse_args()
 
@@ -46,6 +55,16 @@ def create_table(connection, cursor):
 
     Fields which you might think would be INT are VARCHAR because
     they sometimes start with 0s, which we want to preserve.
+
+    STORE_CODE is the store number from STORE, eg 6565 from
+    "Bristol (6565)", so stores can be looked up with an index.
+
+    PRODUCT_KEY is ITEM_CODE as a number, to join boots_products on
+    (see CSV2PG_boots_products.product_key_expression).
+
+    If db_config.partition_by says so, the table is partitioned by DATE2.
+
+    The daily summary table is made alongside (see create_summary_table).
     """
 
     sql = Template("""
@@ -62,27 +81,221 @@ def create_table(connection, cursor):
         POINTS_ITEM REAL,
         UNITS INT,
         SPEND MONEY,
-        DISCOUNT REAL);""")
+        DISCOUNT REAL,
+        STORE_CODE INT GENERATED ALWAYS AS ($store_code) STORED,
+        PRODUCT_KEY BIGINT GENERATED ALWAYS AS ($product_key) STORED)
+        $partitioning;""")
+
+    try:
+        cursor.execute(sql.substitute(
+            table=db_config.boots_transactions,
+            store_code=store_code_expression(),
+            product_key=CSV2PG_boots_products.product_key_expression("ITEM_CODE"),
+            partitioning=PG_ingest.partition_clause(
+                PG_ingest.partition_interval(db_config.boots_transactions),
+                "DATE2")))
+        connection.commit()
+    except Exception as e:
+        print(e)
+
+    add_store_code(
+        connection,
+        cursor)
+
+    CSV2PG_boots_products.add_product_key(
+        db_config.boots_transactions,
+        "ITEM_CODE",
+        connection,
+        cursor)
+
+    create_summary_table(
+        connection,
+        cursor)
+
+
+def store_code_expression():
+
+    """SQL for the number in brackets at the end of STORE, or NULL."""
+
+    return "substring(STORE FROM '[(]([0-9]+)[)][[:space:]]*$')::INT"
+
+
+def add_store_code(connection, cursor):
+
+    """
+    Adds the STORE_CODE column to a boots_transactions table made
+    before it existed (Postgres fills it in for the existing rows),
+    and the index used for store queries.
+    """
+
+    sql_column = Template("""
+        ALTER TABLE $table
+        ADD COLUMN IF NOT EXISTS STORE_CODE INT
+        GENERATED ALWAYS AS ($store_code) STORED;""")
+    sql_index = Template("""
+        CREATE INDEX IF NOT EXISTS ${table}_store_code_idx
+        ON $table (STORE_CODE);""")
 
     try:
-        cursor.execute(sql.substitute(table=db_config.boots_transactions))
+        cursor.execute(sql_column.substitute(
+            table=db_config.boots_transactions,
+            store_code=store_code_expression()))
+        cursor.execute(sql_index.substitute(table=db_config.boots_transactions))
         connection.commit()
     except Exception as e:
+        connection.rollback()
         print(e)
 
 
+def create_summary_table(connection, cursor):
+
+    """
+    Creates boots_daily_summary, the units, spend, item and basket
+    counts of each customer in each store on each day, filled from
+    boots_transactions if it already has rows. Boots cards have no
+    basket ids, so each TIME3 a customer shops at is taken as a basket.
+    """
+
+    PG_ingest.create_summary_table(
+        db_config.boots_daily_summary,
+        """
+        ID VARCHAR,
+        DATE2 DATE,
+        STORE_CODE INT,
+        UNITS BIGINT,
+        SPEND MONEY,
+        ITEMS BIGINT,
+        BASKET_KEYS TIME[]""",
+        summary_key_columns(),
+        summary_rows(db_config.boots_transactions),
+        connection,
+        cursor)
+
+
+def summary_key_columns():
+
+    """The columns boots_daily_summary has a row for each combination of."""
+
+    return ["ID", "DATE2", "STORE_CODE"]
+
+
+def summary_rows(source_table):
+
+    """SQL summarizing the rows in source_table (boots_transactions, or
+    a load table shaped like it) as rows of boots_daily_summary."""
+
+    return Template("""
+        SELECT
+        ID,
+        DATE2,
+        $store_code AS STORE_CODE,
+        SUM(UNITS),
+        SUM(SPEND),
+        COUNT(*),
+        array_agg(DISTINCT TIME3)
+        FROM $source_table
+        GROUP BY ID, DATE2, 3""").substitute(
+            store_code=store_code_expression(),
+            source_table=source_table)
+
+
+def create_load_table(cursor):
+
+    """
+    Creates, if this connection doesn't have it yet, a temp table with
+    the columns of a card file for it to be COPYed into. It is emptied
+    at every commit, by which time its rows have been published to
+    boots_transactions (see publish_load_table).
+
+    Returns:
+        str:    name of the load table
+    """
+
+    load_table = f"{db_config.boots_transactions}_load"
+    cursor.execute(f"""
+        CREATE TEMP TABLE IF NOT EXISTS {load_table} (
+        {", ".join(f"{name} {pg_type}" for name, pg_type in column_types())})
+        ON COMMIT DELETE ROWS;""")
+
+    return load_table
+
+
+def publish_load_table(load_table, cursor):
+
+    """
+    INSERTs the rows in load_table into boots_transactions, adding any
+    partitions they need first, and adds them to boots_daily_summary.
+    Nothing is committed here.
+    """
+
+    columns = ", ".join(name for name, _ in column_types())
+
+    if PG_ingest.is_partitioned(db_config.boots_transactions, cursor):
+        cursor.execute(f"SELECT DISTINCT DATE2::TEXT FROM {load_table};")
+        PG_ingest.create_partitions(
+            db_config.boots_transactions,
+            [date for (date,) in cursor.fetchall() if date],
+            PG_ingest.partition_interval(db_config.boots_transactions),
+            cursor)
+
+    cursor.execute(f"""
+        INSERT INTO {db_config.boots_transactions} ({columns})
+        SELECT {columns} FROM {load_table};""")
+    PG_ingest.update_summary(
+        db_config.boots_daily_summary,
+        summary_key_columns(),
+        summary_rows(load_table),
+        cursor)
+
+
+def column_types():
+
+    """The boots_transactions columns in file order, with the types
+    rows are checked against by --validate. These must match create_table."""
+
+    return [
+        ("ID", "text"),
+        ("DATE2", "date"),
+        ("TIME3", "time"),
+        ("STORE", "text"),
+        ("PAYMENT", "text"),
+        ("STAFF_DISCOUNT_CARD_NUMBER", "text"),
+        ("ITEM_CODE", "text"),
+        ("ITEM_DESCRIPTION", "text"),
+        ("POINTS_ADJUSTMENT", "int4"),
+        ("POINTS_ITEM", "real"),
+        ("UNITS", "int4"),
+        ("SPEND", "money"),
+        ("DISCOUNT", "real")]
+
+
 def import_csv_to_pg_table(
     csv,
-    csv_original_name,
     connection,
-    cursor):
+    cursor,
+    batch_rows=None,
+    validate=False):
 
-    """Imports a CSV with columns consistent with Boots loyalty card CSV columns"""
+    """Imports a CSV with columns consistent with Boots loyalty card CSV columns.
+    The file is streamed from this machine, so it need not be on the DB host.
 
-    print(f"\nImporting Boots Card {csv} to Postgres table 'boots_transactions', just a moment...")
+    Boots cards come as UTF16 TSV: these are decoded and converted to
+    UTF8 CSV on the way into COPY, without writing a converted copy to disk.
+
+    With batch_rows, rows are committed in batches and a rerun after a
+    failure picks up after the last committed batch.
+
+    With validate, rows which don't fit the table are written to
+    {csv}.rejects.csv instead of failing the import.
 
-    dirname = os.path.dirname(__file__)
-    csv_path = os.path.join(dirname, csv)
+    Rows are COPYed into a load table, and published to
+    boots_transactions and the daily summary from there, in the same
+    transaction (each batch's, with batch_rows)."""
+
+    encoding = PG_ingest.detect_encoding(csv)
+    print(f"\nInput file {csv} detected as {encoding}: converting to UTF-8 CSV as it streams.")
+
+    print(f"\nImporting Boots Card {csv} to Postgres table 'boots_transactions', just a moment...")
 
     sql = Template("""
         COPY $table (
@@ -99,17 +312,44 @@ def import_csv_to_pg_table(
         UNITS,
         SPEND,
         DISCOUNT)
-        FROM '$csv_path' CSV HEADER;""")
+        FROM STDIN CSV $header;""")
 
     try:
-        cursor.execute(sql.substitute(table=db_config.boots_transactions, csv_path=csv_path))
-        connection.commit()
-        print(f"\nOK, {csv} imported.")
+        load_table = create_load_table(cursor)
+        publish = functools.partial(publish_load_table, load_table)
+        if validate:
+            card_rows = PG_ingest.validate_rows(
+                PG_ingest.read_delimited_rows(csv, encoding, numbered=True),
+                column_types(),
+                f"{csv}.rejects.csv",
+                cursor)
+        else:
+            card_rows = PG_ingest.read_delimited_rows(csv, encoding)
+        if batch_rows:
+            row_count = PG_ingest.copy_rows_in_batches(
+                sql.substitute(table=load_table, header=""),
+                card_rows,
+                csv,
+                connection,
+                cursor,
+                batch_rows,
+                publish)
+        else:
+            row_count = PG_ingest.copy_from_stdin(
+                sql.substitute(table=load_table, header="HEADER"),
+                PG_ingest.CSVRowStream(card_rows),
+                cursor)
+            publish(cursor)
+            connection.commit()
+        print(f"\nOK, {csv} imported ({row_count} rows).")
     except Exception as e:
-        print(f"\n!!! Import failed: {csv_original_name} is not consistent with table fields.")
+        print(f"\n{e}")
+        print(f"\n!!! Import failed: {csv} is not consistent with table fields.")
         print(f"!!! The csv format might not be correct?")
         sys.exit(1)
 
+    return row_count
+
 
 def db_details(host, user):
 
@@ -191,35 +431,48 @@ def main():
     #~ Create connection using psycopg2
     connection, cursor = PG_status.connect_to_postgres(db_config)
 
-    #~ Boots cards come as UTF16 TSV: detect and convert to UTF8 CSV
-    outfile_name = args.input.name.replace(".csv", ".utf-8.csv")
-    with codecs.open(args.input.name, "rb") as input_file:
-        encoding = chardet.detect(input_file.read())
-    if encoding["encoding"] == "UTF-16":
-        print(f"\nInput file {args.input.name} detected as UTF-16: converting to UTF-8.")
-        with codecs.open(args.input.name, "r", encoding="utf-16") as input_file:
-            card_file_contents = input_file.read()
-            utf8_card_file_contents = card_file_contents.replace("\t", ",")
-            with codecs.open(outfile_name, "w", encoding="utf-8") as output_file:
-                output_file.write(utf8_card_file_contents)
-    else:
-        print(f"\nInput file {args.input.name} detected as UTF-8.")
-        with codecs.open(args.input.name, "r") as input_file:
-            card_file_contents = input_file.read()
-            utf8_card_file_contents = card_file_contents.replace("\t", ",")
-            with codecs.open(outfile_name, "w", encoding="utf-8") as output_file:
-                output_file.write(utf8_card_file_contents)
-
     create_table(
         connection,
         cursor)
 
-    import_csv_to_pg_table(
-        outfile_name,
-        args.input.name,
+    if args.upgrade:
+        print(f"\nOK, {db_config.boots_transactions} is up to date.")
+        connection.close()
+        return
+
+    PG_ingest.create_ingest_tables(
         connection,
         cursor)
 
+    import_function = functools.partial(
+        import_csv_to_pg_table,
+        batch_rows=args.batch_rows,
+        validate=args.validate)
+
+    with PG_ingest.indexes_suspended(
+        db_config.boots_transactions,
+        connection,
+        cursor,
+        args.bulk,
+        args.workers):
+        if args.glob:
+            PG_ingest.import_files_in_parallel(
+                import_function,
+                PG_ingest.expand_input_paths(args.glob),
+                "CSV2PG_boots_card",
+                args.workers,
+                args.force,
+                bool(args.batch_rows))
+        else:
+            PG_ingest.import_once(
+                import_function,
+                args.input.name,
+                "CSV2PG_boots_card",
+                connection,
+                cursor,
+                args.force,
+                bool(args.batch_rows))
+
     table_details(
         connection,
         cursor)
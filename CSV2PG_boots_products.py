@@ -4,6 +4,7 @@ import sys
 import os
 import re
 import argparse
+import functools
 from string import Template
 import csv
 
@@ -14,6 +15,7 @@ from psycopg2 import Error
 #~ local imports
 import db_config
 import PG_status
+import PG_ingest
 
 
 def args_setup():
@@ -25,6 +27,7 @@ def args_setup():
         "-i", "--input", type=argparse.FileType("r"), default=sys.stdin,
         metavar="PATH", required=True,
         help="CSV file to import.")
+    PG_ingest.add_ingest_arguments(parser)
 
     args = parser.parse_args()
 
@@ -37,7 +40,13 @@ def create_scrape_table(connection, cursor):
     for the Boots scraper
 
     Some fields are VARCHAR rather than INT to preserve
-    leading 0s"""
+    leading 0s
+
+    PRODUCT_KEY is PRODUCTID as a number (see product_key_expression),
+    to join boots_transactions on.
+
+    SEARCH_VECTOR holds the words of NAME, DETAILS and LONG_DESCRIPTION,
+    for --search (see PG_ingest.add_search_vector)."""
 
     #! PRICE as VARCHAR is a workaround given "£" in price.
     sql = Template("""
@@ -48,80 +57,153 @@ def create_scrape_table(connection, cursor):
         NAME VARCHAR,
         PRICE VARCHAR,
         DETAILS VARCHAR,
-        LONG_DESCRIPTION VARCHAR);""")
+        LONG_DESCRIPTION VARCHAR,
+        PRODUCT_KEY BIGINT GENERATED ALWAYS AS ($product_key) STORED);""")
 
     try:
-        cursor.execute(sql.substitute(table=db_config.boots_products))
+        cursor.execute(sql.substitute(
+            table=db_config.boots_products,
+            product_key=product_key_expression("PRODUCTID")))
         connection.commit()
     except Exception as e:
         print(e)
 
-    #~ build a temp table to deal with duplicates
-    sql = """
-        CREATE TABLE IF NOT EXISTS temp_table (
-        IDX1 INT,
-        PRODUCT_LINK VARCHAR,
-        PRODUCTID INT,
-        NAME VARCHAR,
-        PRICE VARCHAR,
-        DETAILS VARCHAR,
-        LONG_DESCRIPTION VARCHAR);"""
+    add_product_key(
+        db_config.boots_products,
+        "PRODUCTID",
+        connection,
+        cursor)
+
+    PG_ingest.add_search_vector(
+        db_config.boots_products,
+        {"A": ["NAME"], "B": ["DETAILS"], "C": ["LONG_DESCRIPTION"]},
+        connection,
+        cursor)
+
+
+def product_key_expression(column):
+
+    """
+    SQL for the product code in column as a BIGINT, or NULL if it isn't
+    a number. Boots item codes on cards keep their leading zeros, and
+    product ids from scrapes might not, so codes are joined as numbers.
+    boots_transactions and boots_products both use this for PRODUCT_KEY.
+    """
+
+    return f"""CASE WHEN {column} ~ '^[[:space:]]*0*[0-9]{{1,18}}[[:space:]]*$'
+        THEN trim({column})::BIGINT END"""
+
+
+def add_product_key(
+    table,
+    column,
+    connection,
+    cursor):
+
+    """
+    Adds the PRODUCT_KEY column (see product_key_expression) made from
+    column to a table made before it existed (Postgres fills it in for
+    the existing rows), and the index the join uses.
+    """
+
+    sql_column = Template("""
+        ALTER TABLE $table
+        ADD COLUMN IF NOT EXISTS PRODUCT_KEY BIGINT
+        GENERATED ALWAYS AS ($product_key) STORED;""")
+    sql_index = Template("""
+        CREATE INDEX IF NOT EXISTS ${table}_product_key_idx
+        ON $table (PRODUCT_KEY);""")
+
     try:
-        cursor.execute(sql)
+        cursor.execute(sql_column.substitute(
+            table=table,
+            product_key=product_key_expression(column)))
+        cursor.execute(sql_index.substitute(table=table))
         connection.commit()
     except Exception as e:
+        connection.rollback()
         print(e)
 
 
+def scrape_columns():
+
+    """The boots_products columns a scrape CSV has, in order."""
+
+    return "IDX1, PRODUCT_LINK, PRODUCTID, NAME, PRICE, DETAILS, LONG_DESCRIPTION"
+
+
 def import_scrape_csv_to_pg_table(
     csv,
     connection,
-    cursor):
+    cursor,
+    bulk=False):
 
-    """Imports a CSV with columns named from the Boots scraper"""
+    """Imports a CSV with columns named from the Boots scraper.
+    The file is streamed from this machine, so it need not be on the DB host.
 
-    print(f"\nImporting {csv.name} to Postgres table 'boots_products', just a moment...")
+    Rows are COPYed into a temp staging table private to this connection,
+    then merged into boots_products in one INSERT which skips duplicates.
 
-    dirname = os.path.dirname(__file__)
-    csv_path = os.path.join(dirname, csv.name)
+    In bulk mode the UNIQUE constraint on PRODUCTID has been dropped,
+    so ON CONFLICT can't catch duplicates and they are removed in the
+    INSERT itself instead, keeping the first in the file as ON CONFLICT
+    would. Rows without a PRODUCTID are all kept, as they are without
+    bulk."""
+
+    print(f"\nImporting {csv} to Postgres table 'boots_products', just a moment...")
 
     #~ COPY into temp table first, which can deal with dups
     sql = Template("""
-        COPY temp_table (
-        IDX1,
-        PRODUCT_LINK,
-        PRODUCTID,
-        NAME,
-        PRICE,
-        DETAILS,
-        LONG_DESCRIPTION)
-        FROM '$csv_path' CSV HEADER;""")
+        COPY $staging_table ($columns)
+        FROM STDIN CSV HEADER;""")
 
     try:
-        cursor.execute(sql.substitute(csv_path=csv_path))
-        connection.commit()
-        print(f"\n{csv.name} imported to staging area, removing duplicates...")
+        #~ not committed yet, the staging rows and the INSERT below go in together
+        staging_table = PG_ingest.create_staging_table(db_config.boots_products, cursor)
+        PG_ingest.copy_csv_file(
+            sql.substitute(staging_table=staging_table, columns=scrape_columns()),
+            csv,
+            cursor)
+        print(f"\n{csv} imported to staging area, removing duplicates...")
     except Exception as e:
         print(e)
 
-    #~ then INSERT to true table, rejecting dups on productid
+    #~ then INSERT to true table, rejecting dups on productid.
+    #~ PRODUCT_KEY is left out, Postgres fills it in
     sql = Template("""
-        INSERT INTO $table
-        SELECT * FROM temp_table
+        INSERT INTO $table ($columns)
+        SELECT $columns FROM $staging_table
         ON CONFLICT DO NOTHING;""")
+    if bulk:
+        sql = Template("""
+            INSERT INTO $table ($columns)
+            (SELECT DISTINCT ON (staged.PRODUCTID) $columns
+            FROM $staging_table AS staged
+            WHERE staged.PRODUCTID IS NOT NULL
+            AND NOT EXISTS (
+                SELECT 1 FROM $table AS existing
+                WHERE existing.PRODUCTID = staged.PRODUCTID)
+            ORDER BY staged.PRODUCTID, staged.ctid)
+            UNION ALL
+            SELECT $columns FROM $staging_table
+            WHERE PRODUCTID IS NULL;""")
 
     try:
-        cursor.execute(sql.substitute(table=db_config.boots_products))
-        connection.commit()
-        print(f"\nOK, {csv.name} imported.")
-        #~ remove the temp table
-        cursor.execute("""DROP TABLE IF EXISTS temp_table;""")
+        #~ the temp table is dropped by this commit
+        cursor.execute(sql.substitute(
+            table=db_config.boots_products,
+            staging_table=staging_table,
+            columns=scrape_columns()))
+        row_count = cursor.rowcount
         connection.commit()
+        print(f"\nOK, {csv} imported ({row_count} new products).")
     except Exception as e:
-        print(f"\n!!! Import failed: {csv.name} is not consistent with table fields.")
+        print(f"\n!!! Import failed: {csv} is not consistent with table fields.")
         print(f"!!! The csv format might not be correct, or you might be importing to the wrong table?")
         sys.exit(1)
 
+    return row_count
+
 
 def table_details(connection, cursor):
 
@@ -173,11 +255,24 @@ def main():
         connection,
         cursor)
 
-    import_scrape_csv_to_pg_table(
-        args.input,
+    PG_ingest.create_ingest_tables(
         connection,
         cursor)
 
+    with PG_ingest.indexes_suspended(
+        db_config.boots_products,
+        connection,
+        cursor,
+        args.bulk,
+        args.workers):
+        PG_ingest.import_once(
+            functools.partial(import_scrape_csv_to_pg_table, bulk=args.bulk),
+            args.input.name,
+            "CSV2PG_boots_products",
+            connection,
+            cursor,
+            args.force)
+
     table_details(
         connection,
         cursor)
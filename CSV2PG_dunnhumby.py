@@ -4,6 +4,8 @@ import sys
 import os
 import re
 import argparse
+import functools
+import time
 from string import Template
 import csv
 
@@ -11,10 +13,12 @@ import csv
 import pandas as pd
 import psycopg2
 from psycopg2 import Error
+from psycopg2 import errors
 
 #~ local imports
 import db_config
 import PG_status
+import PG_ingest
 
 
 def args_setup():
@@ -24,27 +28,146 @@ def args_setup():
         epilog="Example: python csv2sql.py -i items.csv")
     parser.add_argument(
         "-i", "--input", type=argparse.FileType("r"), default=sys.stdin,
-        metavar="PATH", required=True,
+        metavar="PATH",
         help="CSV file to import.")
+    parser.add_argument(
+        "--split", type=int, default=1,
+        metavar="N",
+        help="Cut one large input file into N pieces and load them concurrently over N connections.")
+    parser.add_argument(
+        "--binary", action="store_true",
+        help="Parse and check rows on this machine and send them with binary COPY, so the server does no text parsing.")
+    parser.add_argument(
+        "--benchmark", action="store_true",
+        help="Time text and binary COPY of the input file into throwaway tables, without importing anything.")
+    parser.add_argument(
+        "--migrate", action="store_true",
+        help="Convert an existing dunn_humby table to the compact layout, report its size and scan time before and after, then exit.")
+    parser.add_argument(
+        "--normalize", action="store_true",
+        help="Split dunn_humby into an items table plus product, customer, basket and store tables, leaving a dunn_humby view for queries, then exit.")
+    PG_ingest.add_ingest_arguments(parser)
+    PG_ingest.add_batch_arguments(parser)
+    PG_ingest.add_validation_arguments(parser)
 
     args = parser.parse_args()
 
     return parser, args
 
 
+def categories():
+
+    """The enum types for the categorical columns, with the labels the
+    Dunn Humby datasets use. A label not listed here is added to its
+    type the first time it is loaded (see publish_load_table).
+
+    Returns:
+        dict:   {type name (prefixed with the table name): [labels]}
+    """
+
+    return {
+        "price_sensitivity": ["LA", "MM", "UM", "XX"],
+        "lifestage": ["YA", "OA", "YF", "OF", "PE", "OT", "XX"],
+        "basket_size": ["S", "M", "L"],
+        "basket_type": ["Small Shop", "Top Up", "Full Shop", "XX"],
+        "mission": ["Fresh", "Grocery", "Mixed", "Non Food", "XX"],
+        "store_format": ["LS", "MS", "SS", "XLS"],
+        "store_region": [
+            "E01", "E02", "E03", "E04", "E05", "N01", "N02", "N03",
+            "S01", "S02", "S03", "W01", "W02"]}
+
+
+def categorical_columns():
+
+    """The columns stored as enums, with the type (from categories) of each."""
+
+    return [
+        ("CUST_PRICE_SENSITIVITY", "price_sensitivity"),
+        ("CUST_LIFESTAGE", "lifestage"),
+        ("BASKET_SIZE", "basket_size"),
+        ("BASKET_PRICE_SENSITIVITY", "price_sensitivity"),
+        ("BASKET_TYPE", "basket_type"),
+        ("BASKET_DOMINANT_MISSION", "mission"),
+        ("STORE_FORMAT", "store_format"),
+        ("STORE_REGION", "store_region")]
+
+
 def create_table(connection, cursor):
 
     """Create a table consistent with the column names
-    for the CSVs in the Dunn Hunby Tesco example datasets"""
+    for the CSVs in the Dunn Hunby Tesco example datasets.
+
+    The layout is kept narrow, as every full scan reads all of it:
+    SHOP_DATE is a DATE, SPEND is a whole number of pence, the small
+    numbers are SMALLINT and the categorical columns are enums.
+    Files are loaded through a table shaped like the CSV (see
+    load_columns) and converted on the way in.
+    If db_config.partition_by says so, the table is partitioned by SHOP_DATE."""
 
+    sql_type = Template("""
+        CREATE TYPE ${table}_$name AS ENUM ($labels);""")
     sql = Template("""
         CREATE TABLE IF NOT EXISTS $table (
+        SHOP_WEEK INT,
+        SHOP_DATE DATE,
+        SHOP_WEEKDAY SMALLINT,
+        SHOP_HOUR SMALLINT,
+        QUANTITY INT,
+        SPEND INT,
+        PROD_CODE VARCHAR,
+        PROD_CODE_10 VARCHAR,
+        PROD_CODE_20 VARCHAR,
+        PROD_CODE_30 VARCHAR,
+        PROD_CODE_40 VARCHAR,
+        CUST_CODE VARCHAR,
+        CUST_PRICE_SENSITIVITY ${table}_price_sensitivity,
+        CUST_LIFESTAGE ${table}_lifestage,
+        BASKET_ID BIGINT,
+        BASKET_SIZE ${table}_basket_size,
+        BASKET_PRICE_SENSITIVITY ${table}_price_sensitivity,
+        BASKET_TYPE ${table}_basket_type,
+        BASKET_DOMINANT_MISSION ${table}_mission,
+        STORE_CODE VARCHAR,
+        STORE_FORMAT ${table}_store_format,
+        STORE_REGION ${table}_store_region)
+        $partitioning;""")
+
+    try:
+        for name, labels in categories().items():
+            cursor.execute(
+                "SELECT 1 FROM pg_type WHERE typname = %s;",
+                (f"{db_config.dunn_humby}_{name}",))
+            if not cursor.fetchone():
+                cursor.execute(sql_type.substitute(
+                    table=db_config.dunn_humby,
+                    name=name,
+                    labels=", ".join(f"'{label}'" for label in labels)))
+        cursor.execute(sql.substitute(
+            table=db_config.dunn_humby,
+            partitioning=PG_ingest.partition_clause(
+                PG_ingest.partition_interval(db_config.dunn_humby),
+                "SHOP_DATE")))
+        connection.commit()
+    except Exception as e:
+        connection.rollback()
+        print(e)
+
+
+def load_columns():
+
+    """Column definitions for the tables files are COPYed into before
+    being converted into dunn_humby, in the same order and types as the
+    CSVs (and as dunn_humby was before it was made compact), except
+    SPEND, which is NUMERIC rather than MONEY, so reading it doesn't
+    depend on the server's lc_monetary."""
+
+    return """
         SHOP_WEEK INT,
         SHOP_DATE INT,
         SHOP_WEEKDAY INT,
         SHOP_HOUR INT,
         QUANTITY INT,
-        SPEND MONEY,
+        SPEND NUMERIC,
         PROD_CODE VARCHAR,
         PROD_CODE_10 VARCHAR,
         PROD_CODE_20 VARCHAR,
@@ -60,27 +183,781 @@ def create_table(connection, cursor):
         BASKET_DOMINANT_MISSION TEXT,
         STORE_CODE VARCHAR,
         STORE_FORMAT VARCHAR,
-        STORE_REGION VARCHAR);""")
+        STORE_REGION VARCHAR"""
+
+
+def create_load_table(cursor):
+
+    """
+    Creates, if this connection doesn't have it yet, a temp table shaped
+    like the CSVs for files to be COPYed into. It is emptied at every
+    commit, by which time its rows have been published to dunn_humby.
+
+    Returns:
+        str:    name of the load table
+    """
+
+    load_table = f"{db_config.dunn_humby}_load"
+    cursor.execute(f"""
+        CREATE TEMP TABLE IF NOT EXISTS {load_table} (
+        {load_columns()})
+        ON COMMIT DELETE ROWS;""")
+
+    return load_table
+
+
+def add_new_labels(load_table, cursor):
+
+    """
+    Adds any categorical values in load_table which their enum types
+    don't have yet. This is done over a separate connection and
+    committed at once, as a new enum label can't be used in the
+    transaction which added it.
+    """
+
+    sql_new_labels = Template("""
+        SELECT DISTINCT $column FROM $load_table
+        WHERE $column <> ''
+        AND $column NOT IN (SELECT unnest(enum_range(NULL::$type))::TEXT);""")
+    sql_add_label = Template("""
+        ALTER TYPE $type ADD VALUE IF NOT EXISTS %s;""")
+
+    label_connection, label_cursor = PG_status.connect_to_postgres(db_config)
+    try:
+        for column, name in categorical_columns():
+            enum_type = f"{db_config.dunn_humby}_{name}"
+            cursor.execute(sql_new_labels.substitute(
+                column=column,
+                load_table=load_table,
+                type=enum_type))
+            for (label,) in cursor.fetchall():
+                print(f"\nAdding new {column} value {label!r} to {enum_type}.")
+                label_cursor.execute(sql_add_label.substitute(type=enum_type), (label,))
+                label_connection.commit()
+    finally:
+        label_connection.close()
+
+
+def converted_rows(load_table):
+
+    """SQL SELECTing the rows in load_table (shaped by load_columns)
+    converted to the compact dunn_humby columns. SPEND is cast to
+    NUMERIC for a table in the original layout being migrated, where
+    it is still MONEY."""
+
+    return Template("""
+        SELECT
+        SHOP_WEEK,
+        to_date(SHOP_DATE::TEXT, 'YYYYMMDD') AS SHOP_DATE,
+        SHOP_WEEKDAY,
+        SHOP_HOUR,
+        QUANTITY,
+        round(SPEND::NUMERIC * 100)::INT AS SPEND,
+        PROD_CODE,
+        PROD_CODE_10,
+        PROD_CODE_20,
+        PROD_CODE_30,
+        PROD_CODE_40,
+        CUST_CODE,
+        NULLIF(CUST_PRICE_SENSITIVITY, '')::${table}_price_sensitivity AS CUST_PRICE_SENSITIVITY,
+        NULLIF(CUST_LIFESTAGE, '')::${table}_lifestage AS CUST_LIFESTAGE,
+        BASKET_ID::BIGINT AS BASKET_ID,
+        NULLIF(BASKET_SIZE, '')::${table}_basket_size AS BASKET_SIZE,
+        NULLIF(BASKET_PRICE_SENSITIVITY, '')::${table}_price_sensitivity AS BASKET_PRICE_SENSITIVITY,
+        NULLIF(BASKET_TYPE, '')::${table}_basket_type AS BASKET_TYPE,
+        NULLIF(BASKET_DOMINANT_MISSION, '')::${table}_mission AS BASKET_DOMINANT_MISSION,
+        STORE_CODE,
+        NULLIF(STORE_FORMAT, '')::${table}_store_format AS STORE_FORMAT,
+        NULLIF(STORE_REGION, '')::${table}_store_region AS STORE_REGION
+        FROM $load_table""").substitute(
+            table=db_config.dunn_humby,
+            load_table=load_table)
+
+
+def publish_load_table(load_table, cursor, summarize=True):
+
+    """
+    Converts the rows in load_table (shaped by load_columns) to the
+    compact types and INSERTs them into dunn_humby, or into its tables
+    if it has been normalized. If a categorical value is new, it is
+    added to its enum and the INSERT is tried again. Any partitions
+    the rows need are added first.
+    With summarize, the rows are added to the daily summary and the
+    basket table too, if there are these.
+    Nothing is committed here.
+    """
+
+    rows = converted_rows(load_table)
+    if is_normalized(cursor):
+        statements = star_inserts(rows)
+        add_partitions(load_table, db_config.dunn_humby_items, cursor)
+    else:
+        statements = [f"INSERT INTO {db_config.dunn_humby} {rows};"]
+        add_partitions(load_table, db_config.dunn_humby, cursor)
+
+    cursor.execute("SAVEPOINT publish_load_table;")
+    try:
+        for statement in statements:
+            cursor.execute(statement)
+    except errors.InvalidTextRepresentation:
+        #~ most likely a label the enum hasn't got yet
+        cursor.execute("ROLLBACK TO SAVEPOINT publish_load_table;")
+        add_new_labels(load_table, cursor)
+        for statement in statements:
+            cursor.execute(statement)
+    cursor.execute("RELEASE SAVEPOINT publish_load_table;")
+
+    if not summarize:
+        return
+    cursor.execute("SELECT to_regclass(%s);", (db_config.dunn_humby_daily_summary,))
+    if cursor.fetchone()[0] is not None:
+        PG_ingest.update_summary(
+            db_config.dunn_humby_daily_summary,
+            summary_key_columns(),
+            summary_rows(rows),
+            cursor)
+    cursor.execute("SELECT to_regclass(%s);", (db_config.dunn_humby_basket_facts,))
+    if cursor.fetchone()[0] is not None:
+        update_basket_table(rows, cursor)
+
+
+def create_summary_table(connection, cursor):
+
+    """
+    Creates dunn_humby_daily_summary, the units, spend (in pence), item
+    and basket counts of each customer in each store on each day, filled
+    from dunn_humby if it already has rows. SHOP_WEEK and SHOP_WEEKDAY
+    follow from SHOP_DATE, and are kept so weeks and weekdays can be
+    summed up too.
+    """
+
+    PG_ingest.create_summary_table(
+        db_config.dunn_humby_daily_summary,
+        """
+        CUST_CODE VARCHAR,
+        SHOP_DATE DATE,
+        STORE_CODE VARCHAR,
+        SHOP_WEEK INT,
+        SHOP_WEEKDAY SMALLINT,
+        UNITS BIGINT,
+        SPEND BIGINT,
+        ITEMS BIGINT,
+        BASKET_KEYS BIGINT[]""",
+        summary_key_columns(),
+        summary_rows(f"SELECT * FROM {db_config.dunn_humby}"),
+        connection,
+        cursor)
+
+
+def summary_key_columns():
+
+    """The columns dunn_humby_daily_summary has a row for each combination of."""
+
+    return ["CUST_CODE", "SHOP_DATE", "STORE_CODE"]
+
+
+def summary_rows(rows):
+
+    """SQL summarizing the rows SELECTed by rows (in the compact
+    dunn_humby columns) as rows of dunn_humby_daily_summary."""
+
+    return Template("""
+        SELECT
+        CUST_CODE,
+        SHOP_DATE,
+        STORE_CODE,
+        min(SHOP_WEEK),
+        min(SHOP_WEEKDAY),
+        SUM(QUANTITY),
+        SUM(SPEND),
+        COUNT(*),
+        array_agg(DISTINCT BASKET_ID)
+        FROM ($rows) AS new_rows
+        GROUP BY CUST_CODE, SHOP_DATE, STORE_CODE""").substitute(rows=rows)
+
+
+def add_partitions(source_table, table, cursor):
+
+    """
+    If table (dunn_humby, or dunn_humby_items if normalized) is
+    partitioned, adds the partitions needed for the SHOP_DATEs in
+    source_table, which can be in either the CSV or compact layout.
+    Nothing is committed here.
+    """
+
+    if not PG_ingest.is_partitioned(table, cursor):
+        return
+
+    cursor.execute(f"SELECT DISTINCT SHOP_DATE::TEXT FROM {source_table};")
+    PG_ingest.create_partitions(
+        table,
+        [shop_date for (shop_date,) in cursor.fetchall() if shop_date],
+        PG_ingest.partition_interval(db_config.dunn_humby),
+        cursor)
+
+
+def dimensions():
+
+    """The dimension tables of the normalized layout, with the code each
+    is looked up by and the attributes stored once per code there
+    rather than on every item.
+
+    Returns:
+        list:   [(table, code column, [attribute columns])]
+    """
+
+    return [
+        (db_config.dunn_humby_products, "PROD_CODE",
+            ["PROD_CODE_10", "PROD_CODE_20", "PROD_CODE_30", "PROD_CODE_40"]),
+        (db_config.dunn_humby_customers, "CUST_CODE",
+            ["CUST_PRICE_SENSITIVITY", "CUST_LIFESTAGE"]),
+        (db_config.dunn_humby_baskets, "BASKET_ID",
+            ["BASKET_SIZE", "BASKET_PRICE_SENSITIVITY", "BASKET_TYPE", "BASKET_DOMINANT_MISSION"]),
+        (db_config.dunn_humby_stores, "STORE_CODE",
+            ["STORE_FORMAT", "STORE_REGION"])]
+
+
+def dimension_ids():
+
+    """The id column in dunn_humby_items which stands for each code
+    looked up in a dimension table."""
+
+    return {
+        "PROD_CODE": "PRODUCT_ID",
+        "CUST_CODE": "CUSTOMER_ID",
+        "STORE_CODE": "STORE_ID"}
+
+
+def create_star_tables(cursor):
+
+    """
+    Creates the normalized layout: a narrow dunn_humby_items fact table
+    holding only numbers, and product, customer, basket and store tables
+    which it refers to by id. Then replaces dunn_humby with a view
+    joining them back together, so queries on dunn_humby still work.
+    dunn_humby must have been moved out of the way first.
+    If db_config.partition_by says so for dunn_humby, the items table
+    is partitioned by SHOP_DATE.
+    Nothing is committed here.
+    """
+
+    #~ items columns are widest first, so no space is lost to alignment padding
+    sql = Template("""
+        CREATE TABLE $products (
+        PRODUCT_ID INT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+        PROD_CODE VARCHAR NOT NULL UNIQUE,
+        PROD_CODE_10 VARCHAR,
+        PROD_CODE_20 VARCHAR,
+        PROD_CODE_30 VARCHAR,
+        PROD_CODE_40 VARCHAR);
+        CREATE TABLE $customers (
+        CUSTOMER_ID INT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+        CUST_CODE VARCHAR NOT NULL UNIQUE,
+        CUST_PRICE_SENSITIVITY ${table}_price_sensitivity,
+        CUST_LIFESTAGE ${table}_lifestage);
+        CREATE TABLE $baskets (
+        BASKET_ID BIGINT PRIMARY KEY,
+        BASKET_SIZE ${table}_basket_size,
+        BASKET_PRICE_SENSITIVITY ${table}_price_sensitivity,
+        BASKET_TYPE ${table}_basket_type,
+        BASKET_DOMINANT_MISSION ${table}_mission);
+        CREATE TABLE $stores (
+        STORE_ID SMALLINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+        STORE_CODE VARCHAR NOT NULL UNIQUE,
+        STORE_FORMAT ${table}_store_format,
+        STORE_REGION ${table}_store_region);
+        CREATE TABLE $items (
+        BASKET_ID BIGINT,
+        SHOP_WEEK INT,
+        SHOP_DATE DATE,
+        QUANTITY INT,
+        SPEND INT,
+        PRODUCT_ID INT,
+        CUSTOMER_ID INT,
+        SHOP_WEEKDAY SMALLINT,
+        SHOP_HOUR SMALLINT,
+        STORE_ID SMALLINT)
+        $partitioning;""")
+
+    cursor.execute(sql.substitute(
+        table=db_config.dunn_humby,
+        items=db_config.dunn_humby_items,
+        products=db_config.dunn_humby_products,
+        customers=db_config.dunn_humby_customers,
+        baskets=db_config.dunn_humby_baskets,
+        stores=db_config.dunn_humby_stores,
+        partitioning=PG_ingest.partition_clause(
+            PG_ingest.partition_interval(db_config.dunn_humby),
+            "SHOP_DATE")))
+
+    create_star_view(cursor)
+
+
+def create_star_view(cursor):
+
+    """
+    Creates the dunn_humby view over the normalized tables.
+    Nothing is committed here.
+    """
+
+    sql = Template("""
+        CREATE VIEW $table AS
+        SELECT
+        items.SHOP_WEEK,
+        items.SHOP_DATE,
+        items.SHOP_WEEKDAY,
+        items.SHOP_HOUR,
+        items.QUANTITY,
+        items.SPEND,
+        products.PROD_CODE,
+        products.PROD_CODE_10,
+        products.PROD_CODE_20,
+        products.PROD_CODE_30,
+        products.PROD_CODE_40,
+        customers.CUST_CODE,
+        customers.CUST_PRICE_SENSITIVITY,
+        customers.CUST_LIFESTAGE,
+        items.BASKET_ID,
+        baskets.BASKET_SIZE,
+        baskets.BASKET_PRICE_SENSITIVITY,
+        baskets.BASKET_TYPE,
+        baskets.BASKET_DOMINANT_MISSION,
+        stores.STORE_CODE,
+        stores.STORE_FORMAT,
+        stores.STORE_REGION
+        FROM $items AS items
+        LEFT JOIN $products AS products ON products.PRODUCT_ID = items.PRODUCT_ID
+        LEFT JOIN $customers AS customers ON customers.CUSTOMER_ID = items.CUSTOMER_ID
+        LEFT JOIN $baskets AS baskets ON baskets.BASKET_ID = items.BASKET_ID
+        LEFT JOIN $stores AS stores ON stores.STORE_ID = items.STORE_ID;""")
+
+    cursor.execute(sql.substitute(
+        table=db_config.dunn_humby,
+        items=db_config.dunn_humby_items,
+        products=db_config.dunn_humby_products,
+        customers=db_config.dunn_humby_customers,
+        baskets=db_config.dunn_humby_baskets,
+        stores=db_config.dunn_humby_stores))
+
+
+def star_inserts(rows):
+
+    """
+    SQL statements which add the rows SELECTed by rows (in the compact
+    dunn_humby columns) to the normalized layout: first any codes the
+    dimension tables haven't got yet, then the items, by id.
+
+    Returns:
+        list:   [SQL statements, to be run in order]
+    """
+
+    #~ the NOT EXISTS is so that codes already present don't use up identity
+    #~ values, ON CONFLICT catches codes added by another load meanwhile
+    sql_dimension = Template("""
+        INSERT INTO $dimension ($code, $attributes)
+        SELECT DISTINCT ON ($code) $code, $attributes
+        FROM ($rows) AS new_rows
+        WHERE $code IS NOT NULL
+        AND NOT EXISTS (
+            SELECT 1 FROM $dimension AS existing
+            WHERE existing.$code = new_rows.$code)
+        ORDER BY $code
+        ON CONFLICT ($code) DO NOTHING;""")
+    sql_items = Template("""
+        INSERT INTO $items
+        SELECT
+        new_rows.BASKET_ID,
+        new_rows.SHOP_WEEK,
+        new_rows.SHOP_DATE,
+        new_rows.QUANTITY,
+        new_rows.SPEND,
+        products.PRODUCT_ID,
+        customers.CUSTOMER_ID,
+        new_rows.SHOP_WEEKDAY,
+        new_rows.SHOP_HOUR,
+        stores.STORE_ID
+        FROM ($rows) AS new_rows
+        LEFT JOIN $products AS products ON products.PROD_CODE = new_rows.PROD_CODE
+        LEFT JOIN $customers AS customers ON customers.CUST_CODE = new_rows.CUST_CODE
+        LEFT JOIN $stores AS stores ON stores.STORE_CODE = new_rows.STORE_CODE;""")
+
+    statements = [
+        sql_dimension.substitute(
+            dimension=dimension,
+            code=code,
+            attributes=", ".join(attributes),
+            rows=rows)
+        for dimension, code, attributes in dimensions()]
+    statements.append(sql_items.substitute(
+        items=db_config.dunn_humby_items,
+        products=db_config.dunn_humby_products,
+        customers=db_config.dunn_humby_customers,
+        stores=db_config.dunn_humby_stores,
+        rows=rows))
+
+    return statements
+
+
+def is_normalized(cursor):
+
+    """True if dunn_humby is the view over the normalized layout."""
+
+    cursor.execute("""
+        SELECT table_type FROM information_schema.tables
+        WHERE table_name = %s;""",
+        (db_config.dunn_humby,))
+    table_type = cursor.fetchone()
+
+    return table_type is not None and table_type[0] == "VIEW"
+
+
+def has_old_layout(cursor):
+
+    """True if dunn_humby is still in its original, wide layout."""
+
+    cursor.execute("""
+        SELECT data_type FROM information_schema.columns
+        WHERE table_name = %s AND column_name = 'shop_date';""",
+        (db_config.dunn_humby,))
+    data_type = cursor.fetchone()
+
+    return data_type is not None and data_type[0] == "integer"
+
+
+def measure_table(table, connection, cursor):
+
+    """
+    Returns:
+        tuple:  (rows, heap bytes, total bytes including indexes
+                and TOAST, best of three full scan times in seconds)
+    """
+
+    #~ a partitioned table is only its partitions, so their sizes are added up
+    cursor.execute(f"ANALYZE {table};")
+    cursor.execute("""
+        SELECT SUM(pg_relation_size(relid)), SUM(pg_total_relation_size(relid))
+        FROM pg_partition_tree(%s);""",
+        (table,))
+    heap_size, total_size = cursor.fetchone()
+
+    scan_times = []
+    for _ in range(3):
+        start = time.perf_counter()
+        cursor.execute(f"SELECT COUNT(*), SUM(QUANTITY) FROM {table};")
+        row_count = cursor.fetchone()[0]
+        scan_times.append(time.perf_counter() - start)
+    connection.commit()
+
+    return row_count, heap_size, total_size, min(scan_times)
+
+
+def migrate_table(connection, cursor):
+
+    """
+    Converts a dunn_humby table in the original layout to the compact
+    one, then reports the size and full scan time before and after.
+    If the conversion fails, the original table is put back.
+    Indexes are rebuilt on the new table afterwards.
+    """
+
+    if not has_old_layout(cursor):
+        print(f"\nOK, {db_config.dunn_humby} already has the compact layout.")
+        return
+
+    old_table = f"{db_config.dunn_humby}_before_migration"
+    print(f"\nMigrating {db_config.dunn_humby} to the compact layout, this rewrites the whole table...")
+
+    before = measure_table(db_config.dunn_humby, connection, cursor)
+    cursor.execute(
+        "SELECT indexdef FROM pg_indexes WHERE tablename = %s;",
+        (db_config.dunn_humby,))
+    index_definitions = [indexdef for (indexdef,) in cursor.fetchall()]
+    cursor.execute(f"ALTER TABLE {db_config.dunn_humby} RENAME TO {old_table};")
+    connection.commit()
+
+    try:
+        create_table(
+            connection,
+            cursor)
+        #~ the rows are the same, so a daily summary stays as it is
+        publish_load_table(old_table, cursor, summarize=False)
+        connection.commit()
+    except Exception as e:
+        connection.rollback()
+        cursor.execute(f"DROP TABLE IF EXISTS {db_config.dunn_humby};")
+        cursor.execute(f"ALTER TABLE {old_table} RENAME TO {db_config.dunn_humby};")
+        connection.commit()
+        print(f"\n!!! Migration failed, {db_config.dunn_humby} has been left as it was:\n{e}")
+        sys.exit(1)
+
+    cursor.execute(f"DROP TABLE {old_table};")
+    connection.commit()
+
+    #~ indexes were made by name on dunn_humby, which now means the new table
+    for indexdef in index_definitions:
+        try:
+            cursor.execute(indexdef)
+            connection.commit()
+        except Exception as e:
+            connection.rollback()
+            print(f"\n!!! Couldn't rebuild index on the new layout:\n{indexdef}\n{e}")
+
+    after = measure_table(db_config.dunn_humby, connection, cursor)
+
+    print_comparison(before, after)
+
+
+def print_comparison(before, after):
+
+    """Prints two measure_table results side by side."""
+
+    print(f"\n{'':16}{'before':>12}{'after':>12}")
+    print(f"{'Rows':16}{before[0]:>12}{after[0]:>12}")
+    print(f"{'Table MB':16}{before[1] / 2**20:>12.1f}{after[1] / 2**20:>12.1f}")
+    print(f"{'Total MB':16}{before[2] / 2**20:>12.1f}{after[2] / 2**20:>12.1f}")
+    print(f"{'Bytes per row':16}{before[1] / max(before[0], 1):>12.1f}{after[1] / max(after[0], 1):>12.1f}")
+    print(f"{'Full scan (s)':16}{before[3]:>12.3f}{after[3]:>12.3f}")
+
+
+def normalize_table(connection, cursor):
+
+    """
+    Moves a compact dunn_humby table into the normalized layout (see
+    create_star_tables) in a single transaction, then compares the old
+    table with the new fact table. From then on, loads go into the
+    normalized tables.
+    """
+
+    if is_normalized(cursor):
+        print(f"\nOK, {db_config.dunn_humby} is already normalized.")
+        return
+    if has_old_layout(cursor):
+        print(f"\n!!! Please convert {db_config.dunn_humby} to the compact layout first, with --migrate.")
+        sys.exit(1)
+
+    old_table = f"{db_config.dunn_humby}_before_normalize"
+    print(f"\nNormalizing {db_config.dunn_humby}, this rewrites the whole table...")
+
+    before = measure_table(db_config.dunn_humby, connection, cursor)
+    cursor.execute(
+        "SELECT indexname FROM pg_indexes WHERE tablename = %s;",
+        (db_config.dunn_humby,))
+    index_names = [indexname for (indexname,) in cursor.fetchall()]
+
+    try:
+        cursor.execute(f"ALTER TABLE {db_config.dunn_humby} RENAME TO {old_table};")
+        create_star_tables(cursor)
+        add_partitions(old_table, db_config.dunn_humby_items, cursor)
+        for statement in star_inserts(f"SELECT * FROM {old_table}"):
+            cursor.execute(statement)
+        cursor.execute(f"DROP TABLE {old_table};")
+        connection.commit()
+    except Exception as e:
+        connection.rollback()
+        print(f"\n!!! Normalizing failed, {db_config.dunn_humby} has been left as it was:\n{e}")
+        sys.exit(1)
+
+    after = measure_table(db_config.dunn_humby_items, connection, cursor)
+    cursor.execute(
+        "SELECT SUM(pg_total_relation_size(table_name::regclass)) FROM unnest(%s) AS table_name;",
+        ([dimension for dimension, _, _ in dimensions()],))
+    dimension_size = cursor.fetchone()[0]
+
+    print(f"\n{db_config.dunn_humby} table before, {db_config.dunn_humby_items} after:")
+    print_comparison(before, after)
+    print(f"{'Dimensions MB':16}{'':>12}{dimension_size / 2**20:>12.1f}")
+    if index_names:
+        print(f"\n!!! Note: these indexes on the old table did not fit the new layout, so were dropped: {', '.join(index_names)}")
+
+
+def partition_table(cursor):
+
+    """
+    Converts dunn_humby, or if it has been normalized the items table
+    under its view, into a table partitioned by SHOP_DATE (see
+    PG_ingest.partition_table). Nothing is committed here.
+
+    Returns:
+        int:    number of partitions, or None if it was already partitioned
+    """
+
+    if has_old_layout(cursor):
+        raise ValueError(f"Please convert {db_config.dunn_humby} to the compact layout first, with CSV2PG_dunnhumby.py --migrate.")
+
+    interval = PG_ingest.partition_interval(db_config.dunn_humby)
+    if not is_normalized(cursor):
+        return PG_ingest.partition_table(db_config.dunn_humby, "SHOP_DATE", interval, cursor)
+
+    #~ the view refers to the items table itself, so it has to be made again
+    if PG_ingest.is_partitioned(db_config.dunn_humby_items, cursor):
+        print(f"\nOK, {db_config.dunn_humby_items} is already partitioned.")
+        return None
+    cursor.execute(f"DROP VIEW {db_config.dunn_humby};")
+    partition_count = PG_ingest.partition_table(db_config.dunn_humby_items, "SHOP_DATE", interval, cursor)
+    create_star_view(cursor)
+
+    return partition_count
+
+
+def create_basket_table(connection, cursor):
+
+    """
+    Creates dunn_humby_basket_facts, one row per basket with where, when
+    and who by it was bought, its item count, units and spend (in pence),
+    and its type and mission. It is filled at once from dunn_humby if
+    that already has rows, then kept up to date by each load.
+    """
+
+    sql = Template("""
+        CREATE TABLE $baskets (
+        BASKET_ID BIGINT PRIMARY KEY,
+        CUST_CODE VARCHAR,
+        STORE_CODE VARCHAR,
+        SHOP_DATE DATE,
+        SHOP_WEEK INT,
+        SHOP_WEEKDAY SMALLINT,
+        SHOP_HOUR SMALLINT,
+        ITEMS INT,
+        UNITS INT,
+        SPEND INT,
+        BASKET_TYPE ${table}_basket_type,
+        BASKET_DOMINANT_MISSION ${table}_mission);
+        CREATE INDEX ${baskets}_customer_idx
+        ON $baskets (CUST_CODE, SHOP_DATE);""")
 
     try:
-        cursor.execute(sql.substitute(table=db_config.dunn_humby))
+        cursor.execute("SELECT to_regclass(%s);", (db_config.dunn_humby_basket_facts,))
+        if cursor.fetchone()[0] is not None:
+            return
+        cursor.execute(sql.substitute(
+            table=db_config.dunn_humby,
+            baskets=db_config.dunn_humby_basket_facts))
+        update_basket_table(f"SELECT * FROM {db_config.dunn_humby}", cursor)
         connection.commit()
+        print(f"\nMade {db_config.dunn_humby_basket_facts} from the rows already loaded.")
     except Exception as e:
+        connection.rollback()
         print(e)
 
 
+def update_basket_table(rows, cursor):
+
+    """
+    Adds the rows SELECTed by rows (in the compact dunn_humby columns)
+    to dunn_humby_basket_facts, in one pass over them. A basket which
+    already has a row, because it was split across loads, has its
+    totals added to.
+    Nothing is committed here.
+    """
+
+    sql = Template("""
+        INSERT INTO $baskets AS baskets
+        SELECT
+        BASKET_ID,
+        min(CUST_CODE),
+        min(STORE_CODE),
+        min(SHOP_DATE),
+        min(SHOP_WEEK),
+        min(SHOP_WEEKDAY),
+        min(SHOP_HOUR),
+        COUNT(*),
+        SUM(QUANTITY),
+        SUM(SPEND),
+        min(BASKET_TYPE),
+        min(BASKET_DOMINANT_MISSION)
+        FROM ($rows) AS new_rows
+        WHERE BASKET_ID IS NOT NULL
+        GROUP BY BASKET_ID
+        ON CONFLICT (BASKET_ID) DO UPDATE SET
+        ITEMS = baskets.ITEMS + EXCLUDED.ITEMS,
+        UNITS = COALESCE(baskets.UNITS + EXCLUDED.UNITS, baskets.UNITS, EXCLUDED.UNITS),
+        SPEND = COALESCE(baskets.SPEND + EXCLUDED.SPEND, baskets.SPEND, EXCLUDED.SPEND);""")
+
+    cursor.execute(sql.substitute(
+        baskets=db_config.dunn_humby_basket_facts,
+        rows=rows))
+
+
+def column_types():
+
+    """The dunn_humby columns in CSV order, with the types they are
+    encoded as for binary COPY (--validate checks some more narrowly,
+    see validation_types). These must match load_columns."""
+
+    return [
+        ("SHOP_WEEK", "int4"),
+        ("SHOP_DATE", "int4"),
+        ("SHOP_WEEKDAY", "int4"),
+        ("SHOP_HOUR", "int4"),
+        ("QUANTITY", "int4"),
+        ("SPEND", "pence"),
+        ("PROD_CODE", "text"),
+        ("PROD_CODE_10", "text"),
+        ("PROD_CODE_20", "text"),
+        ("PROD_CODE_30", "text"),
+        ("PROD_CODE_40", "text"),
+        ("CUST_CODE", "text"),
+        ("CUST_PRICE_SENSITIVITY", "text"),
+        ("CUST_LIFESTAGE", "text"),
+        ("BASKET_ID", "text"),
+        ("BASKET_SIZE", "text"),
+        ("BASKET_PRICE_SENSITIVITY", "text"),
+        ("BASKET_TYPE", "text"),
+        ("BASKET_DOMINANT_MISSION", "text"),
+        ("STORE_CODE", "text"),
+        ("STORE_FORMAT", "text"),
+        ("STORE_REGION", "text")]
+
+
+def validation_types():
+
+    """column_types, with the checks --validate makes narrowed to what
+    converted_rows turns each column into, so a row which passes can't
+    fail the load when it is published: SHOP_DATE must be a real
+    yyyymmdd date, SHOP_WEEKDAY and SHOP_HOUR fit a SMALLINT and
+    BASKET_ID a BIGINT."""
+
+    narrowed = {
+        "SHOP_DATE": "yyyymmdd",
+        "SHOP_WEEKDAY": "int2",
+        "SHOP_HOUR": "int2",
+        "BASKET_ID": "int8"}
+
+    return [(name, narrowed.get(name, pg_type)) for name, pg_type in column_types()]
+
+
 def import_csv_to_pg_table(
     csv,
     connection,
-    cursor):
+    cursor,
+    split=1,
+    batch_rows=None,
+    binary=False,
+    validate=False):
 
     """Imports a CSV with columns named from the Dunn Hunby
-    Tesco example datasets"""
+    Tesco example datasets. The file is streamed from this
+    machine, so it need not be on the DB host.
+
+    Whichever way it is loaded, the file is COPYed into a load table
+    shaped like the CSV, and converted into dunn_humby from there in
+    the same transaction.
+
+    If split is more than 1, the file is cut into that many
+    line-aligned pieces which are loaded over separate connections
+    at the same time, then published to dunn_humby all at once.
 
-    print(f"\nImporting {csv.name} to Postgres table 'dunn_humby', just a moment...")
+    Otherwise, with batch_rows, rows are committed in batches and a rerun
+    after a failure picks up after the last committed batch.
 
-    dirname = os.path.dirname(__file__)
-    csv_path = os.path.join(dirname, csv.name)
+    With binary, rows are parsed and type-checked here and sent using
+    binary COPY instead of CSV.
+
+    With validate, rows are checked here one by one and those which
+    don't fit the table are written to {csv}.rejects.csv instead of
+    failing the import. This goes with batch_rows, but not split or binary."""
+
+    print(f"\nImporting {csv} to Postgres table 'dunn_humby', just a moment...")
 
     sql = Template("""
         COPY $table (
@@ -106,17 +983,113 @@ def import_csv_to_pg_table(
         STORE_CODE,
         STORE_FORMAT,
         STORE_REGION)
-        FROM '$csv_path' CSV HEADER;""")
+        FROM STDIN CSV $header;""")
 
     try:
-        cursor.execute(sql.substitute(table=db_config.dunn_humby, csv_path=csv_path))
-        connection.commit()
-        print(f"\nOK, {csv.name} imported.")
+        load_table = create_load_table(cursor)
+        publish = functools.partial(publish_load_table, load_table)
+        if split > 1:
+            row_count = PG_ingest.copy_file_in_parallel_ranges(
+                Template(sql.safe_substitute(header="")),
+                db_config.dunn_humby,
+                csv,
+                connection,
+                cursor,
+                split,
+                load_columns(),
+                publish_load_table)
+        elif validate:
+            rows = PG_ingest.validate_rows(
+                PG_ingest.read_delimited_rows(csv, "utf-8", numbered=True),
+                validation_types(),
+                f"{csv}.rejects.csv",
+                cursor)
+            if batch_rows:
+                row_count = PG_ingest.copy_rows_in_batches(
+                    sql.substitute(table=load_table, header=""),
+                    rows,
+                    csv,
+                    connection,
+                    cursor,
+                    batch_rows,
+                    publish)
+            else:
+                row_count = PG_ingest.copy_from_stdin(
+                    sql.substitute(table=load_table, header="HEADER"),
+                    PG_ingest.CSVRowStream(rows),
+                    cursor)
+                publish(cursor)
+                connection.commit()
+        elif batch_rows:
+            row_count = PG_ingest.copy_csv_file_in_batches(
+                sql.substitute(table=load_table, header=""),
+                csv,
+                connection,
+                cursor,
+                batch_rows,
+                publish)
+        elif binary:
+            row_count = PG_ingest.copy_csv_file_binary(
+                load_table,
+                column_types(),
+                csv,
+                cursor)
+            publish(cursor)
+            connection.commit()
+        else:
+            row_count = PG_ingest.copy_csv_file(
+                sql.substitute(table=load_table, header="HEADER"),
+                csv,
+                cursor)
+            publish(cursor)
+            connection.commit()
+        print(f"\nOK, {csv} imported ({row_count} rows).")
     except Exception as e:
-        print(f"\n!!! Import failed: {csv.name} is not consistent with table fields.")
+        print(f"\n{e}")
+        print(f"\n!!! Import failed: {csv} is not consistent with table fields.")
         print(f"!!! The csv format might not be correct, or you might be importing to the wrong table?")
         sys.exit(1)
 
+    return row_count
+
+
+def benchmark_copy(
+    csv,
+    connection,
+    cursor):
+
+    """Loads the same file with text and with binary COPY, each into
+    the load table, which is then emptied, and reports how long each
+    took. Nothing is imported."""
+
+    sql = Template("""
+        COPY $table (
+        $columns)
+        FROM STDIN CSV HEADER;""")
+
+    timings = {}
+    for copy_format in ["text", "binary"]:
+        staging_table = create_load_table(cursor)
+        start = time.perf_counter()
+        if copy_format == "text":
+            row_count = PG_ingest.copy_csv_file(
+                sql.substitute(
+                    table=staging_table,
+                    columns=", ".join(name for name, _ in column_types())),
+                csv,
+                cursor)
+        else:
+            row_count = PG_ingest.copy_csv_file_binary(
+                staging_table,
+                column_types(),
+                csv,
+                cursor)
+        timings[copy_format] = time.perf_counter() - start
+        connection.rollback()
+        print(f"\n{copy_format + ' COPY:':13}{row_count} rows in {timings[copy_format]:.2f}s ({row_count / timings[copy_format]:.0f} rows/sec)")
+
+    print(f"\nBinary COPY took {timings['binary'] / timings['text']:.2f}x the time of text COPY.")
+
 
 def db_details(
     connection,
@@ -169,15 +1142,94 @@ def main():
     #~ Create connection using psycopg2
     connection, cursor = PG_status.connect_to_postgres(db_config)
 
+    if args.migrate:
+        migrate_table(
+            connection,
+            cursor)
+        connection.close()
+        return
+
+    if args.normalize:
+        normalize_table(
+            connection,
+            cursor)
+        connection.close()
+        return
+
+    if has_old_layout(cursor):
+        print(f"\n!!! {db_config.dunn_humby} has the original, wide layout. Please convert it first with:")
+        print(f"\npython CSV2PG_dunnhumby.py --migrate")
+        sys.exit(1)
+
     create_table(
         connection,
         cursor)
 
-    import_csv_to_pg_table(
-        args.input,
+    create_summary_table(
         connection,
         cursor)
 
+    create_basket_table(
+        connection,
+        cursor)
+
+    PG_ingest.create_ingest_tables(
+        connection,
+        cursor)
+
+    if args.benchmark:
+        benchmark_copy(
+            args.input.name,
+            connection,
+            cursor)
+        connection.close()
+        return
+
+    if args.split > 1 and (args.batch_rows or args.glob):
+        print("\n!!! --split can't be used together with --batch_rows or --glob.")
+        sys.exit(1)
+    if args.binary and (args.split > 1 or args.batch_rows):
+        print("\n!!! --binary can't be used together with --split or --batch_rows.")
+        sys.exit(1)
+    if args.validate and (args.split > 1 or args.binary):
+        print("\n!!! --validate can't be used together with --split or --binary.")
+        sys.exit(1)
+    import_function = functools.partial(
+        import_csv_to_pg_table,
+        split=args.split,
+        batch_rows=args.batch_rows,
+        binary=args.binary,
+        validate=args.validate)
+
+    #~ once normalized, the items are what --bulk should load quickly
+    fact_table = db_config.dunn_humby
+    if is_normalized(cursor):
+        fact_table = db_config.dunn_humby_items
+
+    with PG_ingest.indexes_suspended(
+        fact_table,
+        connection,
+        cursor,
+        args.bulk,
+        args.workers):
+        if args.glob:
+            PG_ingest.import_files_in_parallel(
+                import_function,
+                PG_ingest.expand_input_paths(args.glob),
+                "CSV2PG_dunnhumby",
+                args.workers,
+                args.force,
+                bool(args.batch_rows))
+        else:
+            PG_ingest.import_once(
+                import_function,
+                args.input.name,
+                "CSV2PG_dunnhumby",
+                connection,
+                cursor,
+                args.force,
+                bool(args.batch_rows))
+
     try:
         db_details(
             connection,
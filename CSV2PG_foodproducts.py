@@ -4,6 +4,7 @@ import sys
 import os
 import re
 import argparse
+import functools
 from string import Template
 import csv
 
@@ -15,6 +16,7 @@ from psycopg2 import Error
 #~ local imports
 import db_config
 import PG_status
+import PG_ingest
 
 def args_setup():
 
@@ -25,6 +27,7 @@ def args_setup():
         "-i", "--input", type=argparse.FileType("r"), default=sys.stdin,
         metavar="PATH", required=True,
         help="CSV file to import.")
+    PG_ingest.add_ingest_arguments(parser)
 
     args = parser.parse_args()
 
@@ -34,7 +37,10 @@ def args_setup():
 def create_table(connection, cursor):
 
     """Create a table consistent with the column names
-    for the food example datasets"""
+    for the food example datasets
+
+    SEARCH_VECTOR holds the words of the descriptions, brand and
+    ingredients, for --search (see PG_ingest.add_search_vector)."""
 
     sql = Template("""
         CREATE TABLE IF NOT EXISTS $table (
@@ -76,63 +82,20 @@ def create_table(connection, cursor):
     except Exception as e:
         print(e)
 
-    #~ build a temp table to deal with duplicates
-    sql = Template("""
-        CREATE TABLE IF NOT EXISTS temp_table (
-        x_id INT,
-        x_descr VARCHAR,
-        x_marketingdescr VARCHAR,
-        x_tilldescr VARCHAR,
-        x_friendlydescr VARCHAR,
-        x_productdescription VARCHAR,
-        x_brand VARCHAR,
-        x_ingredients VARCHAR,
-        x_energyserv FLOAT,
-        x_fatserv FLOAT,
-        x_saturatesserv FLOAT,
-        x_saltserv FLOAT,
-        x_sugarsserv FLOAT,
-        x_proteinserv FLOAT,
-        x_carbohydrateserv FLOAT,
-        x_fibreserv FLOAT,
-        x_energyunit FLOAT,
-        x_fatunit FLOAT,
-        x_saturatesunit FLOAT,
-        x_saltunit FLOAT,
-        x_sugarsunit FLOAT,
-        x_proteinunit FLOAT,
-        x_carbohydrateunit FLOAT,
-        x_fibreunit FLOAT,
-        x_allergens VARCHAR,
-        y_category_id VARCHAR,
-        l1y_division VARCHAR,
-        l2y_group VARCHAR,
-        l3y_department VARCHAR,
-        l4y_class VARCHAR,
-        l5y_subclass VARCHAR);""")
-
-    try:
-        cursor.execute(sql.substitute(table=db_config.food_products))
-        connection.commit()
-    except Exception as e:
-        print(e)
-
-
-def import_csv_to_pg_table(
-    csv,
-    connection,
-    cursor):
+    PG_ingest.add_search_vector(
+        db_config.food_products,
+        {"A": ["x_descr", "x_tilldescr", "x_friendlydescr"],
+         "B": ["x_marketingdescr", "x_productdescription", "x_brand"],
+         "C": ["x_ingredients"]},
+        connection,
+        cursor)
 
-    """Imports a CSV with columns named from the foodproducts.csv
-    Tesco example dataset"""
 
-    print(f"\nImporting {csv.name} to Postgres table 'food_products', just a moment...")
+def csv_columns():
 
-    dirname = os.path.dirname(__file__)
-    csv_path = os.path.join(dirname, csv.name)
+    """The food_products columns a foodproducts CSV has, in order."""
 
-    sql = Template("""
-        COPY temp_table (
+    return """
         x_id,
         x_descr,
         x_marketingdescr,
@@ -163,34 +126,81 @@ def import_csv_to_pg_table(
         l2y_group,
         l3y_department,
         l4y_class,
-        l5y_subclass)
-        FROM '$csv_path' CSV HEADER;""")
+        l5y_subclass"""
+
+
+def import_csv_to_pg_table(
+    csv,
+    connection,
+    cursor,
+    bulk=False):
+
+    """Imports a CSV with columns named from the foodproducts.csv
+    Tesco example dataset. The file is streamed from this
+    machine, so it need not be on the DB host.
+
+    Rows are COPYed into a temp staging table private to this connection,
+    then merged into food_products in one INSERT which skips duplicates.
+
+    In bulk mode the UNIQUE constraint on x_id has been dropped,
+    so ON CONFLICT can't catch duplicates and they are removed in
+    the INSERT itself instead, keeping the first in the file as ON
+    CONFLICT would. Rows without an x_id are all kept, as they are
+    without bulk."""
+
+    print(f"\nImporting {csv} to Postgres table 'food_products', just a moment...")
+
+    sql = Template("""
+        COPY $staging_table ($columns)
+        FROM STDIN CSV HEADER;""")
 
     try:
-        cursor.execute(sql.substitute(csv_path=csv_path))
-        connection.commit()
-        print(f"\n{csv.name} imported to staging area, removing duplicates...")
+        #~ not committed yet, the staging rows and the INSERT below go in together
+        staging_table = PG_ingest.create_staging_table(db_config.food_products, cursor)
+        PG_ingest.copy_csv_file(
+            sql.substitute(staging_table=staging_table, columns=csv_columns()),
+            csv,
+            cursor)
+        print(f"\n{csv} imported to staging area, removing duplicates...")
     except Exception as e:
         print(e)
 
-    #~ then INSERT to true table, rejecting dups on productid
+    #~ then INSERT to true table, rejecting dups on productid.
+    #~ SEARCH_VECTOR is left out, Postgres fills it in
     sql = Template("""
-        INSERT INTO $table
-        SELECT * FROM temp_table
+        INSERT INTO $table ($columns)
+        SELECT $columns FROM $staging_table
         ON CONFLICT DO NOTHING;""")
+    if bulk:
+        sql = Template("""
+            INSERT INTO $table ($columns)
+            (SELECT DISTINCT ON (staged.x_id) $columns
+            FROM $staging_table AS staged
+            WHERE staged.x_id IS NOT NULL
+            AND NOT EXISTS (
+                SELECT 1 FROM $table AS existing
+                WHERE existing.x_id = staged.x_id)
+            ORDER BY staged.x_id, staged.ctid)
+            UNION ALL
+            SELECT $columns FROM $staging_table
+            WHERE x_id IS NULL;""")
 
     try:
-        cursor.execute(sql.substitute(table=db_config.food_products, csv_path=csv_path))
-        connection.commit()
-        print(f"\nOK, {csv.name} imported.")
-        #~ remove the temp table
-        cursor.execute("""DROP TABLE IF EXISTS temp_table;""")
+        #~ the temp table is dropped by this commit
+        cursor.execute(sql.substitute(
+            table=db_config.food_products,
+            staging_table=staging_table,
+            columns=csv_columns()))
+        row_count = cursor.rowcount
         connection.commit()
+        print(f"\nOK, {csv} imported ({row_count} new products).")
     except Exception as e:
-        print(f"\n!!! Import failed: {csv.name} is not consistent with table fields.")
+        print(f"\n!!! Import failed: {csv} is not consistent with table fields.")
         print(f"!!! The csv format might not be correct?")
         sys.exit(1)
 
+    return row_count
+
 
 def table_details(
     connection,
@@ -249,11 +259,24 @@ def main():
         connection,
         cursor)
 
-    import_csv_to_pg_table(
-        args.input,
+    PG_ingest.create_ingest_tables(
         connection,
         cursor)
 
+    with PG_ingest.indexes_suspended(
+        db_config.food_products,
+        connection,
+        cursor,
+        args.bulk,
+        args.workers):
+        PG_ingest.import_once(
+            functools.partial(import_csv_to_pg_table, bulk=args.bulk),
+            args.input.name,
+            "CSV2PG_foodproducts",
+            connection,
+            cursor,
+            args.force)
+
     table_details(
         connection,
         cursor)
@@ -5,6 +5,7 @@ import os
 import subprocess
 import re
 import argparse
+import functools
 from string import Template
 import csv
 import codecs
@@ -18,6 +19,7 @@ from psycopg2 import Error
 #~ local imports
 import db_config
 import PG_status
+import PG_ingest
 
 
 def args_setup():
@@ -27,8 +29,10 @@ def args_setup():
         epilog="Example: python tesco_card_JSON2PG.py -i tescos_card1.csv")
     parser.add_argument(
         "-i", "--input", type=argparse.FileType("r"), default=sys.stdin,
-        metavar="PATH", required=True,
-        help="JSON file to import.")
+        metavar="PATH",
+        help="CSV file to import.")
+    PG_ingest.add_ingest_arguments(parser)
+    PG_ingest.add_batch_arguments(parser)
 
     args = parser.parse_args()
 
@@ -45,6 +49,8 @@ def create_table(connection, cursor):
     1. customerid   2. basketid   3. storeid   4. timestamp
     (customerid is hash generated since there is no ID in tesco jsons)
     See tesco_card_JSON2CSV.py for more details
+    If db_config.partition_by says so, the table is partitioned by time_stamp.
+    product_id is filled in afterwards, by PG_tesco_table_builder.py.
     """
 
     sql = Template("""
@@ -58,11 +64,16 @@ def create_table(connection, cursor):
         channel VARCHAR,
         weight_in_grams VARCHAR,
         item_selling_price FLOAT,
-        volume_in_litres VARCHAR
-        );""")
+        volume_in_litres VARCHAR,
+        product_id INT
+        ) $partitioning;""")
 
     try:
-        cursor.execute(sql.substitute(table=db_config.tesco_transactions))
+        cursor.execute(sql.substitute(
+            table=db_config.tesco_transactions,
+            partitioning=PG_ingest.partition_clause(
+                PG_ingest.partition_interval(db_config.tesco_transactions),
+                "time_stamp")))
         connection.commit()
     except Exception as e:
         print(e)
@@ -71,18 +82,21 @@ def create_table(connection, cursor):
 def import_csv_to_pg_table(
     csv,
     connection,
-    cursor):
+    cursor,
+    batch_rows=None):
 
     """
     Imports a CSV with columns consistent with Tesco loyalty card JSON fields.
     This is generated using the script tesco_card_JSON2CSV.py
     See function "create_table" for the fields we are extracting and making into columns.
+    The file is streamed from this machine, so it need not be on the DB host.
+    With batch_rows, rows are committed in batches and a rerun after a
+    failure picks up after the last committed batch.
+    If tesco_transactions is partitioned, the file is read through for
+    its dates first, to add any partitions they need.
     """
 
-    print(f"\nImporting Tescos Card {csv.name} to Postgres table 'tesco_transactions', just a moment...")
-
-    dirname = os.path.dirname(__file__)
-    csv_path = os.path.join(dirname, csv.name)
+    print(f"\nImporting Tescos Card {csv} to Postgres table 'tesco_transactions', just a moment...")
 
     sql = Template("""
         COPY $table (
@@ -96,17 +110,35 @@ def import_csv_to_pg_table(
         weight_in_grams,
         item_selling_price,
         volume_in_litres)
-        FROM '$csv_path' CSV HEADER;""")
+        FROM STDIN CSV $header;""")
 
     try:
-        cursor.execute(sql.substitute(table=db_config.tesco_transactions, csv_path=csv_path))
-        connection.commit()
-        print(f"\nOK, {csv.name} imported.")
+        PG_ingest.create_partitions_for_rows(
+            db_config.tesco_transactions,
+            PG_ingest.read_delimited_rows(csv, "utf-8"),
+            2,
+            cursor)
+        if batch_rows:
+            row_count = PG_ingest.copy_csv_file_in_batches(
+                sql.substitute(table=db_config.tesco_transactions, header=""),
+                csv,
+                connection,
+                cursor,
+                batch_rows)
+        else:
+            row_count = PG_ingest.copy_csv_file(
+                sql.substitute(table=db_config.tesco_transactions, header="HEADER"),
+                csv,
+                cursor)
+            connection.commit()
+        print(f"\nOK, {csv} imported ({row_count} rows).")
     except Exception as e:
-        print(f"\n!!! Import failed: {csv.name} is not consistent with table fields.")
+        print(f"\n!!! Import failed: {csv} is not consistent with table fields.")
         print(f"!!! The csv format might not be correct?")
         sys.exit(1)
 
+    return row_count
+
 #! refactored to PG_status
 def db_details(host, user):
 
@@ -192,11 +224,38 @@ def main():
         connection,
         cursor)
 
-    import_csv_to_pg_table(
-        args.input,
+    PG_ingest.create_ingest_tables(
         connection,
         cursor)
 
+    import_function = functools.partial(
+        import_csv_to_pg_table,
+        batch_rows=args.batch_rows)
+
+    with PG_ingest.indexes_suspended(
+        db_config.tesco_transactions,
+        connection,
+        cursor,
+        args.bulk,
+        args.workers):
+        if args.glob:
+            PG_ingest.import_files_in_parallel(
+                import_function,
+                PG_ingest.expand_input_paths(args.glob),
+                "CSV2PG_tesco_card",
+                args.workers,
+                args.force,
+                bool(args.batch_rows))
+        else:
+            PG_ingest.import_once(
+                import_function,
+                args.input.name,
+                "CSV2PG_tesco_card",
+                connection,
+                cursor,
+                args.force,
+                bool(args.batch_rows))
+
     table_details(
         connection,
         cursor)
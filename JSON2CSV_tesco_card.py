@@ -1,9 +1,19 @@
+
+#~ Standard library imports
 import json
 import csv
 import argparse
 from collections import OrderedDict
 import sys
+import os
+import glob
+import time
+import shutil
 import hashlib
+import multiprocessing
+
+#~ 3rd party imports
+import ijson
 
 
 def args_setup():
@@ -13,14 +23,28 @@ def args_setup():
         epilog="Example: python JSON2CSV.py -i clubcard_42.json")
     parser.add_argument(
         "-i", "--input", type=argparse.FileType("r"), default=sys.stdin,
-        metavar="PATH", required=True,
+        metavar="PATH",
         help="JSON file to convert to CSV.")
+    parser.add_argument(
+        "--glob", action="store",
+        metavar="PATTERN",
+        help="Directory, or quoted glob pattern, of JSON files to convert in parallel. Example: 'exports/*.json'")
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count(),
+        metavar="N",
+        help="Number of files to convert at once with --glob (default: number of CPUs).")
+    parser.add_argument(
+        "--combined", action="store",
+        metavar="PATH",
+        help="With --glob, also write every converted row to this one CSV.")
 
     args = parser.parse_args()
 
-    return parser, args
+    if len(sys.argv) < 2:
+        parser.print_help(sys.stderr)
+        sys.exit(1)
 
-parser, args = args_setup()
+    return parser, args
 
 
 def generate_hash_field(hash_input):
@@ -37,7 +61,21 @@ def generate_hash_field(hash_input):
     return _hash_hex
 
 
-def json_items_to_csv_file(json_file):
+def first_purchase_events(events):
+
+    """
+    Passes ijson parse events through until the first list in the
+    "Purchase" nest ends, as only Purchase[0] holds the transactions.
+    Items of any later lists would otherwise match the same prefix.
+    """
+
+    for prefix, event, value in events:
+        yield prefix, event, value
+        if prefix == "Purchase.item" and event == "end_array":
+            return
+
+
+def transaction_items(json_file):
 
     """
     Does the JSON nest-diving to create a single row per item.
@@ -45,65 +83,199 @@ def json_items_to_csv_file(json_file):
     customerId, etc, so those are extracted from upper nests and
     reinserted for each product.
 
+    The JSON is parsed incrementally, one transaction at a time, so
+    memory use does not grow with the size of the export.
+
     Args:       incoming JSON file
-                hex identifier from generate_hash_id()
-    Rets:       Nothing, outputs a csv file names after the incoming json
+    Yields:     dict for each item, customerId, basketId, timeStamp and
+                storeId followed by the product fields
     """
 
-    print(f"Converting transaction items to CSV rows.")
+    with open(json_file, "rb") as json_infile:
+        #~ The "Purchase" nest is a >>list<< of >>list<<s of transactions,
+        #~ and only the first of them is read.
+        #~ use_float gives the same numbers json.load would, rather than Decimals
+        transactions = ijson.items(
+            first_purchase_events(ijson.parse(json_infile, use_float=True)),
+            "Purchase.item.item")
+
+        customerId = None
+        for transaction in transactions:
+            storeId = transaction["storeId"]
+            timeStamp = transaction["timeStamp"]
+            #~ Tesco card JSONs do not have a unique and persistent user identifier:
+            #~ Here we assign one by hashing their 1st transaction metadata,
+            #~ which should be unique and immutable
+            if customerId is None:
+                customerId = generate_hash_field(storeId + timeStamp)
+                print(f"\nAssigning hash as customer identifier: {customerId}")
+            #~ generate basket identifier hash
+            basketId = generate_hash_field(storeId + timeStamp)
+            #~ The "product" nest is a >>dict<< of items in the transaction
+            for item in transaction["product"]:
+                _this_item = {}
+                #~ add extra fields, from hashes and containing nest
+                _this_item["customerId"] = customerId
+                _this_item["basketId"] = basketId
+                _this_item["timeStamp"] = timeStamp
+                _this_item["storeId"] = storeId
+                #~ bring in the actual product details nest (6 fields)
+                _this_item.update(item)
+                yield _this_item
+
+
+def csv_file_name(json_file):
+
+    """
+    The CSV a JSON export is converted to: the same name, with a .csv
+    extension in place of whatever it had.
+    """
+
+    return os.path.splitext(json_file)[0] + ".csv"
+
+
+def json_items_to_csv_file(json_file):
+
+    """
+    Writes one CSV row per transaction item, as they are read from the JSON.
+    The column names are taken from the first item.
+
+    Args:       incoming JSON file
+    Rets:       the csv file written, named after the incoming json,
+                and the number of rows in it
+    """
+
+    outfile_name = csv_file_name(json_file)
+    #~ eg a .csv matched by --glob 'dir/*', which would be written over
+    if os.path.abspath(outfile_name) == os.path.abspath(json_file):
+        raise ValueError(f"{json_file} would be written over by its own CSV, skipping it.")
 
-    items = []
-
-    with open(json_file) as json_infile:
-        data = json.load(json_infile)
-
-    #~ Tesco card JSONs do not have a unique and persistent user identifier:
-    #~ Here we assign one by hashing their 1st transaction metadata,
-    #~ which should be unique and immutable
-    transaction1_store_id = data["Purchase"][0][0]["storeId"]
-    transaction1_timestamp = data["Purchase"][0][0]["timeStamp"]
-    customerId = generate_hash_field(transaction1_store_id + transaction1_timestamp)
-    print(f"\nAssigning hash as customer identifier: {customerId}")
-
-    #~ The "Purchase" nest is a >>list<< of transactions
-    for transaction in data["Purchase"][0]:
-        storeId = transaction["storeId"]
-        timeStamp = transaction["timeStamp"]
-        #~ generate basket identifier hash
-        basketId = generate_hash_field(storeId + timeStamp)
-        #~ The "product" nest is a >>dict<< of items in the transaction
-        for item in transaction["product"]:
-            _this_item = {}
-            #~ add extra fields, from hashes and containing nest
-            _this_item["customerId"] = customerId
-            _this_item["basketId"] = basketId
-            _this_item["timeStamp"] = timeStamp
-            _this_item["storeId"] = storeId
-            #~ bring in the actual product details nest (6 fields)
-            _this_item.update(item)
-            #~ add the whole lot to our item list
-            items.append(_this_item)
-
-    outfile_name = args.input.name.replace(".json", ".csv")
+    print(f"Converting transaction items to CSV rows.")
 
+    row_count = 0
     with open(outfile_name, "w") as csv_outfile:
 
         #~ create the csv writer object
         csv_writer = csv.writer(csv_outfile)
 
-        #~ write the header / column names
-        csv_writer.writerow(_this_item.keys())
-
-        for item in items:
+        for item in transaction_items(json_file):
+            if row_count == 0:
+                #~ write the header / column names
+                csv_writer.writerow(item.keys())
             #~ write row
             csv_writer.writerow(item.values())
+            row_count += 1
+
+    print(f"OK, JSON {json_file} converted to CSV {outfile_name}")
+
+    return outfile_name, row_count
+
+
+def _convert_in_worker(json_file):
+
+    """
+    Pool worker: converts one file, catching failures so that one bad
+    export doesn't stop the rest.
+
+    Returns:
+        tuple:  (json file, csv file or None, rows, seconds, error or None)
+    """
+
+    start = time.perf_counter()
+    try:
+        outfile_name, row_count = json_items_to_csv_file(json_file)
+        error = None
+    except Exception as e:
+        outfile_name, row_count, error = None, 0, e
+        #~ don't leave a half written CSV to be mistaken for a good one,
+        #~ but never remove the export itself
+        half_written = csv_file_name(json_file)
+        if os.path.abspath(half_written) != os.path.abspath(json_file) and os.path.exists(half_written):
+            os.remove(half_written)
+
+    return json_file, outfile_name, row_count, time.perf_counter() - start, error
+
+
+def combine_csv_files(csv_files, combined_name):
+
+    """
+    Concatenates CSVs with the same columns into one, keeping only the
+    first header.
+    """
+
+    with open(combined_name, "w") as combined_outfile:
+        for file_number, csv_file in enumerate(csv_files):
+            with open(csv_file) as csv_infile:
+                header = csv_infile.readline()
+                if file_number == 0:
+                    combined_outfile.write(header)
+                shutil.copyfileobj(csv_infile, combined_outfile)
+
+    print(f"\nOK, {len(csv_files)} CSVs combined into {combined_name}")
+
+
+def convert_files_in_parallel(
+    json_files,
+    workers,
+    combined_name=None):
+
+    """
+    Converts many JSON exports at once, one per worker process, reporting
+    each as it finishes. Each export gets its own CSV as usual, and with
+    combined_name those are also joined into one CSV, in input file order.
+
+    Returns:
+        list:   [json files which failed]
+    """
+
+    print(f"\nConverting {len(json_files)} files with {workers} workers...")
+
+    start = time.perf_counter()
+    results = {}
+    with multiprocessing.Pool(workers) as pool:
+        for done, result in enumerate(pool.imap_unordered(_convert_in_worker, json_files), start=1):
+            json_file, outfile_name, row_count, seconds, error = result
+            results[json_file] = result
+            if error is None:
+                print(f"[{done}/{len(json_files)}] OK      {json_file}: {row_count} rows in {seconds:.1f}s")
+            else:
+                print(f"[{done}/{len(json_files)}] FAILED  {json_file}: {error}")
+
+    failed = [json_file for json_file in json_files if results[json_file][4] is not None]
+    total_rows = sum(result[2] for result in results.values())
+    print(f"\n{len(json_files) - len(failed)} of {len(json_files)} files converted, {total_rows} rows in {time.perf_counter() - start:.1f}s.")
+    for json_file in failed:
+        print(f"!!! Failed: {json_file}")
+
+    if combined_name:
+        combine_csv_files(
+            [results[json_file][1] for json_file in json_files if json_file not in failed],
+            combined_name)
 
-    print(f"OK, JSON {args.input.name} converted to CSV {outfile_name}")
+    return failed
 
 
 def main():
 
-    json_items_to_csv_file(args.input.name)
+    parser, args = args_setup()
+
+    if args.glob:
+        pattern = args.glob
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, "*.json")
+        json_files = sorted(path for path in glob.glob(pattern) if os.path.isfile(path))
+        failed = convert_files_in_parallel(
+            json_files,
+            args.workers,
+            args.combined)
+        if failed:
+            sys.exit(1)
+    else:
+        try:
+            json_items_to_csv_file(args.input.name)
+        except ValueError as e:
+            print(f"\n!!! {e}")
+            sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,180 @@
+
+#~ Standard library imports
+import sys
+import argparse
+import functools
+import itertools
+from string import Template
+
+#~ 3rd party imports
+import psycopg2
+from psycopg2 import Error
+
+#~ local imports
+import db_config
+import PG_status
+import PG_ingest
+import CSV2PG_tesco_card
+import JSON2CSV_tesco_card
+
+
+def args_setup():
+
+    parser = argparse.ArgumentParser(
+        description="Postgres DB Importer: Tesco Clubcard JSON exports, without converting to CSV first.",
+        epilog="Example: python JSON2PG_tesco_card.py -i clubcard_42.json")
+    parser.add_argument(
+        "-i", "--input", type=argparse.FileType("r"), default=sys.stdin,
+        metavar="PATH",
+        help="JSON file to import.")
+    PG_ingest.add_ingest_arguments(parser)
+    PG_ingest.add_batch_arguments(parser)
+
+    args = parser.parse_args()
+
+    return parser, args
+
+
+def json_rows(json_file):
+
+    """
+    The rows JSON2CSV_tesco_card.py would write to CSV for this export,
+    header first, generated as the JSON is read.
+
+    Yields:
+        list:   column names, then the values for each item
+    """
+
+    items = JSON2CSV_tesco_card.transaction_items(json_file)
+    first_item = next(items, None)
+    if first_item is None:
+        return
+
+    yield list(first_item.keys())
+    for item in itertools.chain([first_item], items):
+        yield list(item.values())
+
+
+def import_json_to_pg_table(
+    json_file,
+    connection,
+    cursor,
+    batch_rows=None):
+
+    """
+    Imports a Tesco Clubcard JSON export straight into tesco_transactions.
+    Items are flattened as JSON2CSV_tesco_card.py does, and streamed into
+    COPY as they are read, so no CSV is written to disk.
+    With batch_rows, rows are committed in batches and a rerun after a
+    failure picks up after the last committed batch.
+    If tesco_transactions is partitioned, the export is read through for
+    its dates first, to add any partitions they need.
+    """
+
+    print(f"\nImporting Tescos Card {json_file} to Postgres table 'tesco_transactions', just a moment...")
+
+    sql = Template("""
+        COPY $table (
+        customer_id,
+        basket_id,
+        time_stamp,
+        store_id,
+        product_name,
+        quantity,
+        channel,
+        weight_in_grams,
+        item_selling_price,
+        volume_in_litres)
+        FROM STDIN CSV $header;""")
+
+    try:
+        PG_ingest.create_partitions_for_rows(
+            db_config.tesco_transactions,
+            json_rows(json_file),
+            2,
+            cursor)
+        if batch_rows:
+            row_count = PG_ingest.copy_rows_in_batches(
+                sql.substitute(table=db_config.tesco_transactions, header=""),
+                json_rows(json_file),
+                json_file,
+                connection,
+                cursor,
+                batch_rows)
+        else:
+            row_count = PG_ingest.copy_from_stdin(
+                sql.substitute(table=db_config.tesco_transactions, header="HEADER"),
+                PG_ingest.CSVRowStream(json_rows(json_file)),
+                cursor)
+            connection.commit()
+        print(f"\nOK, {json_file} imported ({row_count} rows).")
+    except Exception as e:
+        print(f"\n!!! Import failed: {json_file} is not consistent with table fields.")
+        print(f"!!! Is it a Tesco Clubcard JSON export?")
+        sys.exit(1)
+
+    return row_count
+
+
+def main():
+
+    if len(sys.argv) < 2:
+        print("\nPostgres DB Importer: Tesco Clubcard JSON exports.")
+        print("Please provide an input file, for example:")
+        print("\npython JSON2PG_tesco_card.py -i clubcard_42.json")
+        sys.exit(1)
+
+    parser, args = args_setup()
+
+    #~ Create connection using psycopg2
+    connection, cursor = PG_status.connect_to_postgres(db_config)
+
+    CSV2PG_tesco_card.create_table(
+        connection,
+        cursor)
+
+    PG_ingest.create_ingest_tables(
+        connection,
+        cursor)
+
+    import_function = functools.partial(
+        import_json_to_pg_table,
+        batch_rows=args.batch_rows)
+
+    with PG_ingest.indexes_suspended(
+        db_config.tesco_transactions,
+        connection,
+        cursor,
+        args.bulk,
+        args.workers):
+        if args.glob:
+            PG_ingest.import_files_in_parallel(
+                import_function,
+                PG_ingest.expand_input_paths(args.glob, ".json"),
+                "JSON2PG_tesco_card",
+                args.workers,
+                args.force,
+                bool(args.batch_rows))
+        else:
+            PG_ingest.import_once(
+                import_function,
+                args.input.name,
+                "JSON2PG_tesco_card",
+                connection,
+                cursor,
+                args.force,
+                bool(args.batch_rows))
+
+    CSV2PG_tesco_card.table_details(
+        connection,
+        cursor)
+
+    connection.close()
+
+
+if __name__ == "__main__":
+
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("OK, stopping.")
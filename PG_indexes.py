@@ -0,0 +1,536 @@
+"""
+Index building for the transaction tables.
+
+The composite B-tree indexes are derived from the WHERE clauses of the
+query templates in queries.py (boots_transactions) and
+PG_querier_dunnhumby.py (dunn_humby), so that every filter combination
+the queriers can run is answered from the leading columns of one index.
+
+Where a table's rows are stored in close to date order, as they are when
+card exports are loaded as they arrive, its date column gets a BRIN
+index instead for the templates which filter on the date alone. BRIN
+keeps only the date range of each block of rows, so it is a tiny
+fraction of the size of a B-tree.
+"""
+
+#~ Standard library imports
+import os
+import re
+import ast
+import time
+import hashlib
+import multiprocessing.pool
+from string import Template
+
+#~ local imports
+import db_config
+import PG_status
+import PG_ingest
+import CSV2PG_dunnhumby
+
+
+def query_sources():
+
+    """
+    The querier source files the indexes are derived from.
+
+    Returns:
+        dict:   {table queried: source file}
+    """
+
+    return {
+        db_config.boots_transactions: "queries.py",
+        db_config.dunn_humby: "PG_querier_dunnhumby.py"}
+
+
+def date_columns():
+
+    """The shop date column of each transaction table."""
+
+    return {
+        db_config.boots_transactions: "DATE2",
+        db_config.tesco_transactions: "time_stamp",
+        db_config.dunn_humby: "SHOP_DATE"}
+
+
+def indexed_table(table, cursor):
+
+    """
+    The table which holds the rows of table, to put indexes on. This is
+    table itself, except for the normalized dunn_humby, which is a view
+    whose items are in dunn_humby_items with ids in place of codes.
+
+    Returns:
+        str:    table name
+        dict:   {filtered column: column indexed in its place}
+    """
+
+    if table == db_config.dunn_humby and CSV2PG_dunnhumby.is_normalized(cursor):
+        return db_config.dunn_humby_items, CSV2PG_dunnhumby.dimension_ids()
+
+    return table, {}
+
+
+def column_correlation(table, column, cursor):
+
+    """
+    How closely the order of column follows the order rows are stored
+    in, from pg_stats: 1 or -1 when they are in step, 0 when unrelated.
+    For a partitioned table this is taken partition by partition, since
+    that is where a BRIN index looks, and averaged by rows. The table is
+    ANALYZEd first if it has no statistics for column.
+
+    Returns:
+        float:  absolute correlation, or None if table has no rows
+    """
+
+    sql_correlation = """
+        SELECT SUM(abs(pg_stats.correlation) * pg_class.reltuples) / NULLIF(SUM(pg_class.reltuples), 0)
+        FROM pg_partition_tree(%s) AS tree
+        JOIN pg_class ON pg_class.oid = tree.relid
+        JOIN pg_stats ON pg_stats.schemaname = 'public'
+            AND pg_stats.tablename = pg_class.relname
+            AND pg_stats.attname = lower(%s)
+            AND NOT pg_stats.inherited
+        WHERE tree.isleaf;"""
+
+    cursor.execute(sql_correlation, (table, column))
+    correlation = cursor.fetchone()[0]
+    if correlation is None:
+        cursor.execute(f"ANALYZE {table} ({column});")
+        cursor.execute(sql_correlation, (table, column))
+        correlation = cursor.fetchone()[0]
+
+    return correlation
+
+
+def template_filters(source_file):
+
+    """
+    Reads the SQL templates out of a querier's source, without running
+    it, and picks out the columns each filters on. Only templates which
+    select FROM $table count, not the information_schema lookups.
+
+    Returns:
+        list:   [(template name, {(column, operator)})], in source order
+    """
+
+    source_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), source_file)
+    with open(source_path) as source:
+        tree = ast.parse(source.read())
+
+    templates = []
+    for function in tree.body:
+        if not isinstance(function, ast.FunctionDef):
+            continue
+        filters = set()
+        for node in ast.walk(function):
+            if not (isinstance(node, ast.Constant) and isinstance(node.value, str)):
+                continue
+            if "WHERE" not in node.value or "FROM $table" not in node.value:
+                continue
+            where = node.value.split("WHERE", 1)[1]
+            filters.update(
+                (column.upper(), operator)
+                for column, operator in re.findall(r"(\w+)\s*(=|>=|<=|<|>)\s*'", where))
+        if filters:
+            templates.append((f"{source_file}:{function.name}", filters))
+
+    return templates
+
+
+def _serves(index_columns, equal_columns, range_column):
+
+    """True if index_columns leads with equal_columns, in any order,
+    followed by range_column if there is one."""
+
+    if set(index_columns[:len(equal_columns)]) != equal_columns:
+        return False
+    if range_column is None:
+        return True
+
+    return len(index_columns) > len(equal_columns) and index_columns[len(equal_columns)] == range_column
+
+
+def plan_indexes(templates, renames=None):
+
+    """
+    Chooses the composite B-tree indexes for a table's query templates.
+    A template is served by an index which starts with its equality
+    columns, in any order, followed by its range column if it has one.
+
+    A column which is ever filtered by range (a date) is planned as a
+    range column every time, so it always comes last and one index
+    serves both a date and a date range.
+
+    Templates are taken fewest filters first. If one can't be served
+    by an index planned already, an index made up only of its equality
+    columns is lengthened to serve it, since the shorter templates can
+    still use its leading columns, otherwise a new index is added.
+
+    renames maps filtered columns to the columns indexed in their place.
+
+    Returns:
+        list:   [[index columns, [template names served]]]
+    """
+
+    renames = renames or {}
+    ranged = {
+        renames.get(column, column)
+        for _, filters in templates
+        for column, operator in filters if operator != "="}
+
+    filter_sets = []
+    for name, filters in templates:
+        columns = {renames.get(column, column) for column, _ in filters}
+        range_columns = sorted(columns & ranged)
+        #~ B-tree can only range over one column, the others are checked row by row
+        filter_sets.append((name, columns - ranged, range_columns[0] if range_columns else None))
+
+    plan = []
+    for name, equal_columns, range_column in sorted(
+            filter_sets, key=lambda filter_set: (len(filter_set[1]) + bool(filter_set[2]), filter_set[0])):
+        served_by = next(
+            (index for index in plan if _serves(index[0], equal_columns, range_column)),
+            None)
+        if served_by is None:
+            extendable = [index for index in plan if set(index[0]) <= equal_columns]
+            if extendable:
+                served_by = max(extendable, key=lambda index: len(index[0]))
+            else:
+                served_by = [[], []]
+                plan.append(served_by)
+            served_by[0] = served_by[0] + sorted(equal_columns - set(served_by[0]))
+            if range_column:
+                served_by[0].append(range_column)
+        served_by[1].append(name)
+
+    return plan
+
+
+def index_name(table, columns, method="btree"):
+
+    """A name for the index, hashed if it would be over Postgres' 63 characters."""
+
+    suffix = "idx" if method == "btree" else f"{method}_idx"
+    name = f"{table}_{'_'.join(columns)}_{suffix}".lower()
+    if len(name) > 63:
+        digest = hashlib.md5(name.encode()).hexdigest()[:8]
+        name = f"{table[:50]}_{digest}_{suffix}".lower()
+
+    return name
+
+
+def existing_indexes(table, cursor):
+
+    """
+    Returns:
+        list:   [(columns, index name, method, valid)] for the indexes
+                table has already, method being btree, brin etc
+    """
+
+    cursor.execute("""
+        SELECT array_agg(attribute.attname ORDER BY key.position),
+        index_class.relname, access_method.amname, pg_index.indisvalid
+        FROM pg_index
+        JOIN pg_class AS index_class ON index_class.oid = pg_index.indexrelid
+        JOIN pg_am AS access_method ON access_method.oid = index_class.relam
+        CROSS JOIN unnest(pg_index.indkey) WITH ORDINALITY AS key (attnum, position)
+        JOIN pg_attribute AS attribute
+            ON attribute.attrelid = pg_index.indrelid AND attribute.attnum = key.attnum
+        WHERE pg_index.indrelid = %s::regclass
+        GROUP BY index_class.relname, access_method.amname, pg_index.indisvalid;""",
+        (table,))
+
+    return [
+        (tuple(column.upper() for column in columns), name, method, valid)
+        for columns, name, method, valid in cursor.fetchall()]
+
+
+def index_statements(
+    table,
+    columns,
+    method,
+    concurrently,
+    cursor):
+
+    """
+    The SQL to build one index. Postgres can't build an index on a
+    partitioned table CONCURRENTLY, so in that case it is declared on
+    the parent alone first, then built CONCURRENTLY on each partition
+    and attached, which makes the parent index valid once all are in.
+
+    Returns:
+        list:   [statements to run first]
+        list:   [(table or partition, [statements to build its part])]
+    """
+
+    name = index_name(table, columns, method)
+    sql = Template("""
+        CREATE INDEX $concurrently IF NOT EXISTS $name
+        ON $only $table USING $method ($columns);""")
+    sql_attach = Template("""
+        ALTER INDEX $name ATTACH PARTITION $partition_index;""")
+
+    if not (concurrently and PG_ingest.is_partitioned(table, cursor)):
+        return [], [(table, [sql.substitute(
+            concurrently="CONCURRENTLY" if concurrently else "",
+            name=name,
+            only="",
+            table=table,
+            method=method,
+            columns=", ".join(columns))])]
+
+    cursor.execute(
+        "SELECT inhrelid::regclass::TEXT FROM pg_inherits WHERE inhparent = %s::regclass ORDER BY 1;",
+        (table,))
+    partitions = [partition for (partition,) in cursor.fetchall()]
+
+    partition_statements = []
+    for partition in partitions:
+        partition_index = index_name(partition, columns, method)
+        partition_statements.append((partition, [
+            sql.substitute(
+                concurrently="CONCURRENTLY",
+                name=partition_index,
+                only="",
+                table=partition,
+                method=method,
+                columns=", ".join(columns)),
+            sql_attach.substitute(name=name, partition_index=partition_index)]))
+
+    return [sql.substitute(
+        concurrently="",
+        name=name,
+        only="ONLY",
+        table=table,
+        method=method,
+        columns=", ".join(columns))], partition_statements
+
+
+def _build_indexes(statements):
+
+    """
+    ThreadPool task: runs statements building indexes, in order, on a
+    connection of its own and outside a transaction, as CONCURRENTLY
+    needs. A statement which fails is reported and the rest still run.
+
+    Returns:
+        list:   [error message for each statement which failed]
+    """
+
+    connection, cursor = PG_status.connect_to_postgres(db_config)
+    connection.autocommit = True
+    cursor.execute(
+        "SET maintenance_work_mem = %s;",
+        (db_config.bulk_maintenance_work_mem,))
+
+    failures = []
+    for statement in statements:
+        try:
+            cursor.execute(statement)
+        except Exception as e:
+            failures.append(f"{statement.strip()}\n{e}")
+    connection.close()
+
+    return failures
+
+
+def build_indexes(workers=1, concurrently=False):
+
+    """
+    Plans the indexes for each querier (see plan_indexes), prints which
+    templates each one serves, and builds those which aren't there yet,
+    up to workers at a time.
+
+    A date column whose correlation (see column_correlation) is at least
+    db_config.brin_min_correlation gets a BRIN index, and the templates
+    filtering on that date alone are left to it rather than a B-tree.
+    This goes for tesco_transactions too, which has no querier.
+
+    With concurrently, the tables can still be loaded while their indexes
+    build. Two CONCURRENTLY builds on one table would wait for each
+    other, so each table (or partition) has its indexes built one after
+    another, and the workers take different tables or partitions.
+    """
+
+    #~ Create connection using psycopg2
+    connection, cursor = PG_status.connect_to_postgres(db_config)
+
+    builds = []
+    for queried_table, date_column in date_columns().items():
+        table, renames = indexed_table(queried_table, cursor)
+        cursor.execute("SELECT to_regclass(%s);", (table,))
+        if cursor.fetchone()[0] is None:
+            print(f"\n{table} doesn't exist yet, skipping its indexes.")
+            continue
+
+        source_file = query_sources().get(queried_table)
+        templates = template_filters(source_file) if source_file else []
+        existing = existing_indexes(table, cursor)
+        plan = []
+
+        correlation = column_correlation(table, date_column, cursor)
+        if correlation is None:
+            print(f"\n{table} is empty, so {date_column} is indexed with a B-tree.")
+        elif correlation < db_config.brin_min_correlation:
+            print(f"\n{table}.{date_column} correlation with storage order is {correlation:.3f}, "
+                  f"under {db_config.brin_min_correlation}, so it is indexed with a B-tree.")
+        else:
+            print(f"\n{table}.{date_column} correlation with storage order is {correlation:.3f}, "
+                  f"so it gets a BRIN index.")
+            date_only = [
+                name for name, filters in templates
+                if {column for column, _ in filters} == {date_column.upper()}]
+            templates = [(name, filters) for name, filters in templates if name not in date_only]
+            plan.append(([date_column.upper()], date_only or ["(date range queries)"], "brin"))
+
+        plan += [
+            (columns, template_names, "btree")
+            for columns, template_names in plan_indexes(templates, renames)]
+
+        print(f"\nIndexes on {table}" + (f" for the templates in {source_file}:" if source_file else ":"))
+        for columns, template_names, method in plan:
+            covering = next(
+                ((name, valid) for existing_columns, name, existing_method, valid in existing
+                 if existing_method == method and existing_columns[:len(columns)] == tuple(columns)),
+                None)
+            print(f"\n  {'BRIN' if method == 'brin' else 'B-tree'} ({', '.join(columns)})")
+            print("  serves: " + "\n          ".join(template_names))
+            if covering is None:
+                builds.append((table, columns, method))
+            elif covering[1]:
+                print(f"  already there as {covering[0]}")
+            else:
+                print(f"  !!! {covering[0]} is INVALID, from a build that failed. Drop it to build it again.")
+    connection.commit()
+
+    if not builds:
+        print("\nOK, no indexes to build.")
+        return
+
+    print(f"\nBuilding {len(builds)} indexes{' CONCURRENTLY' if concurrently else ''}, {workers} at a time...")
+    start = time.perf_counter()
+    first_statements = []
+    tasks = {}
+    for table, columns, method in builds:
+        first, steps = index_statements(table, columns, method, concurrently, cursor)
+        first_statements.extend(first)
+        for relation, statements in steps:
+            tasks.setdefault(relation if concurrently else len(tasks), []).extend(statements)
+    connection.commit()
+
+    failures = _build_indexes(first_statements)
+    with multiprocessing.pool.ThreadPool(max(1, workers)) as pool:
+        for task_failures in pool.map(_build_indexes, tasks.values()):
+            failures.extend(task_failures)
+    for error in failures:
+        print(f"\n!!! Could not build index:\n{error}")
+    if failures and concurrently:
+        print(f"\n!!! A CONCURRENTLY build that fails leaves an INVALID index behind, drop it before trying again.")
+
+    if failures:
+        print(f"\nIndex builds finished in {time.perf_counter() - start:.1f}s, {len(failures)} statements failed.")
+    else:
+        print(f"\nOK, {len(builds)} indexes built in {time.perf_counter() - start:.1f}s.")
+
+
+def compare_brin(table, column, cursor):
+
+    """
+    Builds a BRIN and a B-tree index on column side by side, in a
+    transaction which is rolled back afterwards, and times a one day
+    lookup on several dates with each of them alone. Other indexes
+    leading with column are set aside while timing, so they don't
+    stand in. Building the indexes locks the table against writes until
+    it is done, and the DROP INDEX which sets the others aside takes an
+    ACCESS EXCLUSIVE lock, so while each index is timed the table can't
+    be read either.
+
+    Returns:
+        dict:   {method: (size in bytes, mean lookup time in seconds)}
+    """
+
+    sql_index = Template("""
+        CREATE INDEX $name ON $table USING $method ($column);""")
+    sql_lookup = Template("""
+        SELECT COUNT(*) FROM $table
+        WHERE $column >= %s AND $column < %s::DATE + 1;""")
+
+    cursor.execute(f"SELECT min({column})::DATE, max({column})::DATE FROM {table};")
+    first_day, last_day = cursor.fetchone()
+    if first_day is None:
+        return {}
+    days = sorted({first_day + (last_day - first_day) * step / 4 for step in range(5)})
+
+    names = {}
+    for method in ("brin", "btree"):
+        names[method] = f"{table}_{column}_compare_{method}".lower()
+        cursor.execute(sql_index.substitute(
+            name=names[method],
+            table=table,
+            method=method,
+            column=column))
+    others = [
+        name for columns, name, _, _ in existing_indexes(table, cursor)
+        if columns[0] == column.upper() and name not in names.values()]
+    cursor.execute("SET LOCAL enable_seqscan = off;")
+
+    results = {}
+    for method, name in names.items():
+        cursor.execute(
+            "SELECT SUM(pg_relation_size(relid)) FROM pg_partition_tree(%s);",
+            (name,))
+        size = cursor.fetchone()[0]
+        cursor.execute("SAVEPOINT compare_brin;")
+        for other in others + [other for other in names.values() if other != name]:
+            cursor.execute(f"DROP INDEX {other};")
+        lookup_times = []
+        for day in days:
+            #~ best of three, so the first read from disk doesn't count
+            day_times = []
+            for _ in range(3):
+                start = time.perf_counter()
+                cursor.execute(sql_lookup.substitute(table=table, column=column), (day, day))
+                cursor.fetchone()
+                day_times.append(time.perf_counter() - start)
+            lookup_times.append(min(day_times))
+        cursor.execute("ROLLBACK TO SAVEPOINT compare_brin;")
+        results[method] = size, sum(lookup_times) / len(lookup_times)
+
+    return results
+
+
+def brin_report():
+
+    """
+    For the date column of each transaction table, prints its
+    correlation with storage order and compares a BRIN index on it with
+    a B-tree (see compare_brin), without keeping either.
+    """
+
+    #~ Create connection using psycopg2
+    connection, cursor = PG_status.connect_to_postgres(db_config)
+
+    for queried_table, date_column in date_columns().items():
+        table, _ = indexed_table(queried_table, cursor)
+        cursor.execute("SELECT to_regclass(%s);", (table,))
+        if cursor.fetchone()[0] is None:
+            continue
+
+        correlation = column_correlation(table, date_column, cursor)
+        connection.commit()
+        print(f"\n{table}.{date_column}:")
+        if correlation is None:
+            print("  no rows yet.")
+            continue
+        try:
+            results = compare_brin(table, date_column, cursor)
+        finally:
+            connection.rollback()
+
+        choice = "BRIN" if correlation >= db_config.brin_min_correlation else "B-tree"
+        print(f"  correlation with storage order {correlation:.3f}, --build_indexes would use {choice}")
+        print(f"  {'':18}{'BRIN':>12}{'B-tree':>12}")
+        print(f"  {'Size KB':18}{results['brin'][0] / 1024:>12.1f}{results['btree'][0] / 1024:>12.1f}")
+        print(f"  {'Day lookup (ms)':18}{results['brin'][1] * 1000:>12.2f}{results['btree'][1] * 1000:>12.2f}")
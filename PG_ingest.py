@@ -0,0 +1,1748 @@
+"""
+Shared ingestion helpers for the CSV2PG loaders.
+
+Data is streamed from the client with COPY ... FROM STDIN, so input
+files do not need to be on the same machine as the Postgres server.
+"""
+
+#~ Standard library imports
+import os
+import sys
+import io
+import re
+import csv
+import glob
+import time
+import mmap
+import uuid
+import codecs
+import struct
+import hashlib
+import decimal
+import datetime
+import operator
+import itertools
+import functools
+import contextlib
+import multiprocessing
+import multiprocessing.pool
+from string import Template
+
+#~ 3rd party imports
+import chardet
+import numpy as np
+import pandas as pd
+from psycopg2 import errors
+
+#~ local imports
+import db_config
+import PG_status
+
+
+def add_ingest_arguments(parser):
+
+    """
+    Adds the command line options shared by all of the CSV2PG loaders.
+    """
+
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count(),
+        metavar="N",
+        help="Number of files to import at once when using --glob, and indexes to rebuild at once with --bulk (default: number of CPUs).")
+    parser.add_argument(
+        "--bulk", action="store_true",
+        help="Drop the table's indexes and unique constraints for the load, then rebuild them and ANALYZE.")
+    parser.add_argument(
+        "--force", action="store_true",
+        help="Import files even if the ingestion manifest says they have been imported before.")
+
+
+def add_batch_arguments(parser):
+
+    """
+    Adds the options for the transaction loaders: loading many files at
+    once in several processes, and loading in checkpointed batches.
+    """
+
+    parser.add_argument(
+        "--glob", action="store",
+        metavar="PATTERN",
+        help="Directory, or quoted glob pattern, of files to import in parallel. Example: 'exports/*.csv'")
+    parser.add_argument(
+        "--batch_rows", type=int,
+        metavar="N",
+        help="Commit every N rows and checkpoint progress, so a failed load can resume where it stopped.")
+
+
+def add_validation_arguments(parser):
+
+    """
+    Adds the option to check rows before loading them, for loaders
+    which know the types of their columns.
+    """
+
+    parser.add_argument(
+        "--validate", action="store_true",
+        help="Check every row against the table's columns, load the good rows and write the bad ones, with reasons, to INPUT.rejects.csv.")
+
+
+def copy_from_stdin(
+    sql,
+    input_file,
+    cursor,
+    chunk_size=None):
+
+    """
+    Streams an open file (or any object with a read() method) into
+    a COPY ... FROM STDIN statement. psycopg2 pulls chunk_size bytes
+    at a time, so memory use stays flat however big the input is.
+
+    Returns:
+        int:    number of rows copied
+    """
+
+    if chunk_size is None:
+        chunk_size = db_config.copy_chunk_size
+
+    cursor.copy_expert(sql, input_file, size=chunk_size)
+
+    return cursor.rowcount
+
+
+def copy_csv_file(
+    sql,
+    csv_path,
+    cursor):
+
+    """
+    Opens a CSV on the client machine and streams it to the server.
+    The file is read as raw bytes so no decoding happens client-side.
+
+    Returns:
+        int:    number of rows copied
+    """
+
+    with open(csv_path, "rb") as csv_file:
+        return copy_from_stdin(sql, csv_file, cursor)
+
+
+def detect_encoding(
+    input_path,
+    sample_size=64 * 1024):
+
+    """
+    Works out the text encoding of a file from its first sample_size
+    bytes, rather than reading the whole thing. A byte order mark
+    settles it straight away, otherwise chardet guesses from the sample.
+
+    Returns:
+        str:    encoding name that Python's open() understands
+    """
+
+    with open(input_path, "rb") as input_file:
+        sample = input_file.read(sample_size)
+
+    if sample.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return "utf-16"
+    if sample.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+
+    encoding = chardet.detect(sample)["encoding"]
+    #~ ascii is a subset of utf-8, and the sample might not have
+    #~ reached any non-ascii characters further into the file.
+    if encoding is None or encoding.lower() == "ascii":
+        return "utf-8"
+
+    return encoding
+
+
+def read_delimited_rows(
+    input_path,
+    encoding,
+    numbered=False):
+
+    """
+    Generator of rows from a tab or comma separated file, decoded
+    incrementally so only one buffer of the file is held at a time.
+    The delimiter is taken from the header line: tabs if there are
+    any, commas otherwise.
+
+    With numbered, each row comes with the line of the file it starts
+    on, which is not its row number if a quoted field has a newline.
+
+    Yields:
+        list:   fields of one row, header first
+                (or with numbered, tuple: (line number, fields))
+    """
+
+    with open(input_path, "r", encoding=encoding, newline="") as input_file:
+        header = input_file.readline()
+        delimiter = "\t" if "\t" in header else ","
+        input_file.seek(0)
+        reader = csv.reader(input_file, delimiter=delimiter)
+        if not numbered:
+            yield from reader
+            return
+        line_number = 1
+        for row in reader:
+            yield line_number, row
+            line_number = reader.line_num + 1
+
+
+def _check_int(value, bits):
+
+    number = int(value)
+    if not -2 ** (bits - 1) <= number < 2 ** (bits - 1):
+        raise ValueError("out of range")
+
+
+def _money_checker(cursor):
+
+    """
+    Returns a money check which accepts what the server will: an
+    optional sign and the server's currency symbol (either way round),
+    digits with optional thousands separators and up to two decimal
+    places. float() would also take nan, inf, 1e5 and 1_000, which
+    Postgres doesn't. The check raises ValueError for anything else.
+    """
+
+    #~ the symbol depends on the server's lc_monetary, eg $ or £
+    cursor.execute("SELECT 0::money::text;")
+    symbol = re.escape(re.sub(r"[\d.,\s-]", "", cursor.fetchone()[0]) or "$")
+    money = re.compile(
+        rf"\s*(?:[-+]?(?:{symbol})?|{symbol}[-+])\s*(?:\d{{1,3}}(?:,\d{{3}})+|\d+)(?:\.\d{{1,2}})?\s*")
+
+    def _check_money(value):
+        if not money.fullmatch(value):
+            raise ValueError("not money")
+
+    return _check_money
+
+
+def _check_pence(value):
+
+    #~ a plain decimal amount, which is whole pence once rounded as
+    #~ round(value * 100)::INT does on the server, and fits an INT
+    if not re.fullmatch(r"\s*[-+]?(?:\d+\.?\d*|\.\d+)\s*", value):
+        raise ValueError("not a number")
+    pence = (decimal.Decimal(value.strip()) * 100).to_integral_value(decimal.ROUND_HALF_UP)
+    if not -2 ** 31 <= pence < 2 ** 31:
+        raise ValueError("out of range")
+
+
+def _check_time(value):
+
+    match = re.fullmatch(r"\s*(\d{1,2}):(\d{2})(?::(\d{2})(?:\.\d+)?)?\s*", value)
+    if not match or int(match[1]) > 24 or int(match[2]) > 59 or int(match[3] or 0) > 60:
+        raise ValueError("not a time")
+
+
+def _check_yyyymmdd(value):
+
+    #~ a date written as a number, as to_date(value, 'YYYYMMDD') reads it
+    if not re.fullmatch(r"\s*\d{8}\s*", value):
+        raise ValueError("not yyyymmdd")
+    datetime.datetime.strptime(value.strip(), "%Y%m%d")
+
+
+def _date_checker(cursor):
+
+    """
+    Returns a date check which accepts what the server will: ISO and
+    yyyymmdd dates, and slashed dates in the order of its DateStyle.
+    The check returns the date, or raises ValueError.
+    """
+
+    cursor.execute("SHOW DateStyle;")
+    date_style = cursor.fetchone()[0]
+    slashed = "%d/%m/%Y" if "DMY" in date_style else "%Y/%m/%d" if "YMD" in date_style else "%m/%d/%Y"
+
+    def _check_date(value):
+        for date_format in ("%Y-%m-%d", "%Y%m%d", slashed):
+            try:
+                return datetime.datetime.strptime(value.strip(), date_format).date()
+            except ValueError:
+                pass
+        raise ValueError("not a date")
+
+    return _check_date
+
+
+def validate_rows(
+    rows,
+    columns,
+    reject_path,
+    cursor):
+
+    """
+    Filters rows, passing on those that fit a table's columns and
+    writing the others to a reject CSV, so one bad row doesn't fail the
+    whole COPY. Each reject has the line of the input it starts on (the
+    header is line 1), the reason, and then the fields as they were read.
+
+    rows are (line number, fields), as read_delimited_rows gives them
+    with numbered=True.
+
+    columns is a list of (column name, type) in file order, where type
+    is one of int2, int4, int8, real, money, pence, date, yyyymmdd, time
+    or text. yyyymmdd is for dates kept as numbers, eg 20070410, and
+    pence for plain decimal amounts which are stored as whole pence.
+    Empty fields are loaded as NULL, so they always pass.
+
+    Returns:
+        generator:  fields of each good row, header first
+    """
+
+    checks = {
+        "int2": functools.partial(_check_int, bits=16),
+        "int4": functools.partial(_check_int, bits=32),
+        "int8": functools.partial(_check_int, bits=64),
+        "real": float,
+        "money": _money_checker(cursor),
+        "pence": _check_pence,
+        "date": _date_checker(cursor),
+        "yyyymmdd": _check_yyyymmdd,
+        "time": _check_time}
+    column_checks = [
+        (column_number, name, pg_type, checks[pg_type])
+        for column_number, (name, pg_type) in enumerate(columns)
+        if pg_type != "text"]
+
+    #~ a reject file from an earlier run is out of date
+    if os.path.exists(reject_path):
+        os.remove(reject_path)
+
+    #~ the checks are set up above, rather than when the first row is
+    #~ asked for, as by then the cursor is busy with COPY
+    return _validated_rows(rows, columns, column_checks, reject_path)
+
+
+def _validated_rows(
+    rows,
+    columns,
+    column_checks,
+    reject_path):
+
+    """Generator behind validate_rows."""
+
+    reject_file = None
+    reject_count = 0
+    rows = iter(rows)
+    header = next(rows, None)
+    if header is None:
+        return
+    yield header[1]
+    for line_number, row in rows:
+        reasons = []
+        if len(row) != len(columns):
+            reasons.append(f"expected {len(columns)} fields, found {len(row)}")
+        else:
+            for column_number, name, pg_type, check in column_checks:
+                value = row[column_number]
+                if value == "":
+                    continue
+                try:
+                    check(value)
+                except ValueError:
+                    reasons.append(f"{name} {value!r} is not {pg_type}")
+        if not reasons:
+            yield row
+            continue
+        if reject_file is None:
+            reject_file = open(reject_path, "w", newline="")
+            reject_writer = csv.writer(reject_file)
+            reject_writer.writerow(["line", "reason"] + [name for name, _ in columns])
+        reject_writer.writerow([line_number, "; ".join(reasons)] + row)
+        reject_count += 1
+
+    if reject_file is not None:
+        reject_file.close()
+        print(f"\n!!! {reject_count} rows rejected, see {reject_path}")
+
+
+class CSVRowStream:
+
+    """
+    A read-only file-like object which writes rows out as UTF-8 CSV
+    on demand, so that rows from a generator can be piped into
+    copy_from_stdin without an intermediate file. Quoting is done by
+    the csv module, so fields containing commas or quotes survive.
+    """
+
+    def __init__(self, rows):
+
+        self.rows = iter(rows)
+        self.text_buffer = io.StringIO()
+        self.writer = csv.writer(self.text_buffer, lineterminator="\n")
+        self.pending = b""
+        self.exhausted = False
+
+    def read(self, size=-1):
+
+        #~ format rows until there is at least size bytes to hand out
+        while not self.exhausted and (size < 0 or len(self.pending) < size):
+            for row in self.rows:
+                self.writer.writerow(row)
+                if self.text_buffer.tell() >= max(size, 0):
+                    break
+            else:
+                self.exhausted = True
+            self.pending += self.text_buffer.getvalue().encode("utf-8")
+            self.text_buffer.seek(0)
+            self.text_buffer.truncate()
+
+        if size < 0:
+            size = len(self.pending)
+        chunk = self.pending[:size]
+        self.pending = self.pending[size:]
+
+        return chunk
+
+
+class ChunkStream:
+
+    """
+    A read-only file-like object over an iterator of bytes chunks, so
+    that generated data can be handed to copy_from_stdin.
+    """
+
+    def __init__(self, chunks):
+
+        self.chunks = iter(chunks)
+        self.pending = b""
+        self.position = 0
+
+    def read(self, size=-1):
+
+        while size < 0 or len(self.pending) - self.position < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.pending = self.pending[self.position:] + chunk
+            self.position = 0
+
+        end = len(self.pending) if size < 0 else self.position + size
+        chunk = self.pending[self.position:end]
+        self.position += len(chunk)
+
+        return chunk
+
+
+def _binary_fields(values, pg_type):
+
+    """
+    Encodes one column of a chunk of rows as binary COPY fields, each a
+    4 byte length followed by the value. Numbers are packed with numpy
+    for the whole column at once.
+
+    Returns:
+        list:   bytes for each row
+    """
+
+    null = values.isna().to_numpy()
+
+    if pg_type in ("int2", "int4", "int8"):
+        width = {"int2": 2, "int4": 4, "int8": 8}[pg_type]
+        packed = np.empty(len(values), dtype=[("length", ">i4"), ("value", f">i{width}")])
+        packed["length"] = width
+        packed["value"] = values.fillna(0).to_numpy(dtype=f">i{width}")
+        fields = packed.view(f"V{4 + width}").tolist()
+    elif pg_type == "pence":
+        #~ a NUMERIC to 2 decimal places: weight 1 and three base 10000
+        #~ digits, eg 1234.56 is 0000 1234 5600. Leading zero digits are
+        #~ fine, the server strips them
+        pence = _parse_pence(values).to_numpy()
+        pounds = np.abs(pence) // 100
+        packed = np.empty(len(values), dtype=[
+            ("length", ">i4"), ("ndigits", ">i2"), ("weight", ">i2"),
+            ("sign", ">u2"), ("dscale", ">i2"), ("digits", ">i2", 3)])
+        packed["length"] = 14
+        packed["ndigits"] = 3
+        packed["weight"] = 1
+        packed["sign"] = np.where(pence < 0, 0x4000, 0)
+        packed["dscale"] = 2
+        packed["digits"] = np.stack(
+            [pounds // 10000, pounds % 10000, np.abs(pence) % 100 * 100], axis=1)
+        fields = packed.view("V18").tolist()
+    elif pg_type == "text":
+        encoded = list(map(str.encode, values.to_numpy(dtype=object, na_value="")))
+        lengths = np.fromiter(map(len, encoded), dtype=">i4", count=len(encoded))
+        fields = list(map(operator.add, lengths.view("V4").tolist(), encoded))
+    else:
+        raise ValueError(f"No binary COPY encoding for type {pg_type}")
+
+    #~ a length of -1 means NULL
+    for row in np.flatnonzero(null):
+        fields[row] = b"\xff\xff\xff\xff"
+
+    return fields
+
+
+def _parse_pence(values):
+
+    """
+    Parses a column of plain decimal amounts to whole pence, rounding
+    half away from zero as round() on a NUMERIC does, so no server
+    locale (as with MONEY) or float rounding is involved. Missing
+    values come out as 0, for the caller to send as NULL.
+
+    Returns:
+        Series: int64 pence
+    """
+
+    parts = values.str.extract(r"^\s*([-+]?)(\d*)(?:\.(\d*))?\s*$")
+    bad = values.notna() & (parts[1].isna() | (parts[1].fillna("") + parts[2].fillna("") == ""))
+    if bad.any():
+        raise ValueError(f"column {values.name}: {values[bad].iloc[0]!r} is not a number")
+    #~ an INT of pence is at most 8 digits of pounds, checked before
+    #~ int64 could overflow
+    digits = parts[1].fillna("").str.lstrip("0")
+    if (digits.str.len() > 8).any():
+        raise ValueError(f"column {values.name}: {values[digits.str.len() > 8].iloc[0]!r} is out of range")
+    pounds = digits.replace("", "0").astype("int64")
+    fraction = parts[2].fillna("").str.ljust(3, "0")
+    pence = pounds * 100 + fraction.str[:2].astype("int64") + (fraction.str[2].astype("int64") >= 5)
+    pence = pence.where(parts[0] != "-", -pence)
+    out_of_range = (pence < -2 ** 31) | (pence >= 2 ** 31)
+    if out_of_range.any():
+        raise ValueError(f"column {values.name}: {values[out_of_range].iloc[0]!r} is out of range")
+
+    return pence
+
+
+def binary_copy_chunks(
+    csv_path,
+    columns,
+    chunk_rows=100000):
+
+    """
+    Generator of PostgreSQL binary COPY data from a CSV with a header.
+    Rows are parsed by pandas chunk_rows at a time into the types given
+    in columns, so bad values are caught here, with the rows they are
+    in, and the server has no text to parse.
+
+    columns is a list of (column name, type) in file order, where type
+    is one of int2, int4, int8, pence or text. pence is a plain decimal
+    amount, sent as a NUMERIC to 2 decimal places (see _parse_pence).
+
+    Yields:
+        bytes:  binary COPY data, header first and trailer last
+    """
+
+    pandas_types = {
+        "int2": "Int16", "int4": "Int32", "int8": "Int64",
+        "pence": str, "text": str}
+
+    yield b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+
+    tuple_header = struct.pack(">h", len(columns))
+    chunks = pd.read_csv(
+        csv_path,
+        header=0,
+        names=[name for name, _ in columns],
+        dtype={name: pandas_types[pg_type] for name, pg_type in columns},
+        keep_default_na=False,
+        na_values=[""],
+        chunksize=chunk_rows)
+
+    first_row = 1
+    while True:
+        try:
+            chunk = next(chunks, None)
+        except ValueError as e:
+            raise ValueError(f"{csv_path}, rows from {first_row}: {e}")
+        if chunk is None:
+            break
+        try:
+            column_fields = [
+                _binary_fields(chunk[name], pg_type) for name, pg_type in columns]
+        except ValueError as e:
+            raise ValueError(f"{csv_path}, rows from {first_row}: {e}")
+        yield b"".join(itertools.chain.from_iterable(
+            zip(itertools.repeat(tuple_header), *column_fields)))
+        first_row += len(chunk)
+
+    yield struct.pack(">h", -1)
+
+
+def copy_csv_file_binary(
+    table,
+    columns,
+    csv_path,
+    cursor):
+
+    """
+    Loads a CSV using binary COPY, parsing and checking it on this
+    machine (see binary_copy_chunks) so the server does no text parsing.
+
+    Returns:
+        int:    number of rows copied
+    """
+
+    sql = Template("""
+        COPY $table ($columns)
+        FROM STDIN (FORMAT BINARY);""")
+
+    return copy_from_stdin(
+        sql.substitute(
+            table=table,
+            columns=", ".join(name for name, _ in columns)),
+        ChunkStream(binary_copy_chunks(csv_path, columns)),
+        cursor)
+
+
+def create_staging_table(table, cursor):
+
+    """
+    Creates a TEMP table shaped like table, to COPY into before merging.
+    Temp tables are private to the connection, so concurrent loads can't
+    clash, aren't written to the WAL, and are dropped at commit.
+
+    Returns:
+        str:    name of the staging table
+    """
+
+    staging_table = f"{table}_staging"
+
+    sql = Template("""
+        CREATE TEMP TABLE $staging_table
+        (LIKE $table INCLUDING DEFAULTS)
+        ON COMMIT DROP;""")
+
+    cursor.execute(sql.substitute(staging_table=staging_table, table=table))
+
+    return staging_table
+
+
+def partition_interval(table):
+
+    """
+    The interval table is set to be partitioned by in
+    db_config.partition_by: "month", "week" or None.
+    """
+
+    interval = db_config.partition_by.get(table)
+    if interval not in (None, "month", "week"):
+        raise ValueError(f"db_config.partition_by for {table} should be 'month', 'week' or None, not {interval!r}.")
+
+    return interval
+
+
+def partition_clause(interval, column):
+
+    """The PARTITION BY for a CREATE TABLE, or nothing if interval is None."""
+
+    if interval is None:
+        return ""
+
+    return f"PARTITION BY RANGE ({column})"
+
+
+def is_partitioned(table, cursor):
+
+    """True if table exists and is partitioned."""
+
+    cursor.execute(
+        "SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s);",
+        (table,))
+
+    return cursor.fetchone() is not None
+
+
+def partition_bounds(table, day, interval):
+
+    """
+    The partition of table a day falls in. Monthly partitions are named
+    like boots_transactions_y2021m02, weekly ones by ISO week, like
+    boots_transactions_y2021w07, and weeks start on Monday.
+
+    Returns:
+        tuple:  (partition name, first day, day after the last)
+    """
+
+    if interval == "month":
+        start = day.replace(day=1)
+        end = (start + datetime.timedelta(days=32)).replace(day=1)
+        return f"{table}_y{start:%Y}m{start:%m}", start, end
+
+    start = day - datetime.timedelta(days=day.weekday())
+    iso_year, iso_week, _ = start.isocalendar()
+
+    return f"{table}_y{iso_year}w{iso_week:02d}", start, start + datetime.timedelta(days=7)
+
+
+def create_partitions(
+    table,
+    dates,
+    interval,
+    cursor):
+
+    """
+    Creates the partitions of table which dates fall in and which it
+    doesn't have yet. dates are strings as they come in the input,
+    dates or timestamps; those which aren't are skipped, and left for
+    COPY or --validate to deal with.
+
+    Nothing is committed here, so the partitions go in with the rows
+    which needed them, or not at all. Until then, other loads into
+    table wait for this one.
+
+    Returns:
+        list:   names of the partitions created
+    """
+
+    if interval is None:
+        raise ValueError(f"{table} is partitioned, but db_config.partition_by has no interval for it.")
+
+    parse_date = _date_checker(cursor)
+    partitions = set()
+    for value in dates:
+        try:
+            partitions.add(partition_bounds(
+                table,
+                parse_date(re.split(r"[ T]", value.strip())[0]),
+                interval))
+        except ValueError:
+            pass
+
+    cursor.execute(
+        "SELECT inhrelid::regclass::TEXT FROM pg_inherits WHERE inhparent = %s::regclass;",
+        (table,))
+    existing = {partition for (partition,) in cursor.fetchall()}
+
+    sql = Template("""
+        CREATE TABLE IF NOT EXISTS $partition
+        PARTITION OF $table
+        FOR VALUES FROM ('$start') TO ('$end');""")
+
+    created = []
+    for partition, start, end in sorted(partitions):
+        if partition in existing:
+            continue
+        #~ a concurrent load may have just made the same partition
+        cursor.execute("SAVEPOINT create_partition;")
+        try:
+            cursor.execute(sql.substitute(
+                partition=partition,
+                table=table,
+                start=start,
+                end=end))
+            created.append(partition)
+        except (errors.DuplicateTable, errors.UniqueViolation):
+            cursor.execute("ROLLBACK TO SAVEPOINT create_partition;")
+        cursor.execute("RELEASE SAVEPOINT create_partition;")
+
+    if created:
+        print(f"\nAdding {len(created)} partitions to {table}: {', '.join(created)}")
+
+    return created
+
+
+def create_partitions_for_rows(
+    table,
+    rows,
+    column_number,
+    cursor):
+
+    """
+    If table is partitioned, creates the partitions needed for the dates
+    in one column of rows (header first), before they are COPYed in.
+    This reads rows through, so they must be read again for the COPY.
+
+    Returns:
+        list:   names of the partitions created
+    """
+
+    if not is_partitioned(table, cursor):
+        return []
+
+    rows = iter(rows)
+    next(rows, None)
+    dates = {row[column_number] for row in rows if len(row) > column_number}
+
+    return create_partitions(
+        table,
+        dates,
+        partition_interval(table),
+        cursor)
+
+
+def partition_table(
+    table,
+    column,
+    interval,
+    cursor):
+
+    """
+    Converts an existing table into one partitioned by range of its
+    date column, with a partition for each month or week it has rows
+    in. Rows are copied across, the indexes are made again on the new
+    table (and so on every partition), and the old table is dropped.
+    Anything depending on the old table, such as a view, must be
+    dropped first. Nothing is committed here.
+
+    Returns:
+        int:    number of partitions, or None if table was already partitioned
+    """
+
+    if is_partitioned(table, cursor):
+        print(f"\nOK, {table} is already partitioned.")
+        return None
+
+    old_table = f"{table}_unpartitioned"
+    print(f"\nPartitioning {table} by {interval}, this rewrites the whole table...")
+
+    cursor.execute(
+        "SELECT indexdef FROM pg_indexes WHERE tablename = %s;",
+        (table,))
+    index_definitions = [indexdef for (indexdef,) in cursor.fetchall()]
+    #~ generated columns can't be copied, the new table computes them again
+    cursor.execute("""
+        SELECT column_name FROM information_schema.columns
+        WHERE table_name = %s AND is_generated = 'NEVER'
+        ORDER BY ordinal_position;""",
+        (table,))
+    columns = ", ".join(column_name for (column_name,) in cursor.fetchall())
+
+    sql_create = Template("""
+        ALTER TABLE $table RENAME TO $old_table;
+        CREATE TABLE $table
+        (LIKE $old_table INCLUDING DEFAULTS INCLUDING GENERATED INCLUDING CONSTRAINTS)
+        $partitioning;""")
+    sql_dates = Template("""
+        SELECT DISTINCT to_char($column, 'YYYY-MM-DD') FROM $old_table;""")
+    sql_copy = Template("""
+        INSERT INTO $table ($columns)
+        SELECT $columns FROM $old_table;
+        DROP TABLE $old_table;""")
+
+    cursor.execute(sql_create.substitute(
+        table=table,
+        old_table=old_table,
+        partitioning=partition_clause(interval, column)))
+    cursor.execute(sql_dates.substitute(column=column, old_table=old_table))
+    create_partitions(
+        table,
+        [day for (day,) in cursor.fetchall() if day],
+        interval,
+        cursor)
+    cursor.execute(sql_copy.substitute(
+        table=table,
+        columns=columns,
+        old_table=old_table))
+    #~ the old indexes went with the old table, so their names are free
+    for indexdef in index_definitions:
+        cursor.execute(indexdef)
+
+    cursor.execute(
+        "SELECT COUNT(*) FROM pg_inherits WHERE inhparent = %s::regclass;",
+        (table,))
+    partition_count = cursor.fetchone()[0]
+    print(f"OK, {table} is partitioned by {interval} into {partition_count} partitions.")
+
+    return partition_count
+
+
+def add_search_vector(
+    table,
+    weighted_columns,
+    connection,
+    cursor):
+
+    """
+    Adds a SEARCH_VECTOR column to table, the words of its text columns
+    as a tsvector kept up to date by Postgres, with a GIN index so
+    products can be found by words without reading every description.
+    weighted_columns is {weight: [columns]}, weights A (most important)
+    to D, so matches in a name can rank above matches in ingredients.
+    Filling the column in rewrites a table which has rows already.
+    """
+
+    sql_column = Template("""
+        ALTER TABLE $table
+        ADD COLUMN IF NOT EXISTS SEARCH_VECTOR tsvector
+        GENERATED ALWAYS AS ($search_vector) STORED;""")
+    sql_index = Template("""
+        CREATE INDEX IF NOT EXISTS ${table}_search_idx
+        ON $table USING GIN (SEARCH_VECTOR);""")
+
+    search_vector = " || ".join(
+        "setweight(to_tsvector('{language}', {text}), '{weight}')".format(
+            language=db_config.search_language,
+            text=" || ' ' || ".join(f"coalesce({column}, '')" for column in columns),
+            weight=weight)
+        for weight, columns in weighted_columns.items())
+
+    try:
+        cursor.execute(sql_column.substitute(table=table, search_vector=search_vector))
+        cursor.execute(sql_index.substitute(table=table))
+        connection.commit()
+    except Exception as e:
+        connection.rollback()
+        print(e)
+
+
+def create_ingest_tables(connection, cursor):
+
+    """
+    Create the ingestion manifest, a record of every file that has been
+    loaded, keyed by a hash of the file's contents. The index on path,
+    size and modification time lets an unchanged file be recognised
+    without reading it again.
+
+    Also create the checkpoint table, which records how far through
+    each file a batched load has committed, so it can be resumed.
+    """
+
+    sql = Template("""
+        CREATE TABLE IF NOT EXISTS $table (
+        content_hash VARCHAR PRIMARY KEY,
+        loader VARCHAR,
+        file_path VARCHAR,
+        byte_size BIGINT,
+        modified_ns BIGINT,
+        row_count BIGINT,
+        duration_seconds REAL,
+        ingested_at TIMESTAMP DEFAULT now());
+        CREATE INDEX IF NOT EXISTS ${table}_file_idx
+        ON $table (file_path, byte_size, modified_ns);
+        CREATE TABLE IF NOT EXISTS $checkpoint_table (
+        file_path VARCHAR,
+        byte_size BIGINT,
+        modified_ns BIGINT,
+        byte_offset BIGINT,
+        row_count BIGINT,
+        updated_at TIMESTAMP DEFAULT now(),
+        PRIMARY KEY (file_path, byte_size, modified_ns));""")
+
+    try:
+        cursor.execute(sql.substitute(
+            table=db_config.ingest_manifest,
+            checkpoint_table=db_config.ingest_checkpoints))
+        connection.commit()
+    except Exception as e:
+        connection.rollback()
+        print(e)
+
+
+def create_summary_table(
+    summary,
+    columns,
+    key_columns,
+    summary_rows,
+    connection,
+    cursor):
+
+    """
+    Creates a per-customer daily summary table, which --count and
+    --spend queries can be answered from instead of the item rows.
+    columns are its column definitions: the key columns (and any which
+    only depend on them), then UNITS, SPEND, ITEMS (item rows) and
+    BASKET_KEYS, an array of the distinct baskets. BASKETS, their
+    count, is added here.
+
+    If the table is new, it is filled at once from summary_rows, SQL
+    summarizing the rows already loaded (see update_summary).
+    """
+
+    sql = Template("""
+        CREATE TABLE $summary (
+        $columns,
+        BASKETS INT GENERATED ALWAYS AS (cardinality(BASKET_KEYS)) STORED,
+        UNIQUE NULLS NOT DISTINCT ($key_columns));""")
+
+    try:
+        cursor.execute("SELECT to_regclass(%s);", (summary,))
+        if cursor.fetchone()[0] is not None:
+            return
+        cursor.execute(sql.substitute(
+            summary=summary,
+            columns=columns,
+            key_columns=", ".join(key_columns)))
+        update_summary(summary, key_columns, summary_rows, cursor)
+        connection.commit()
+        print(f"\nMade {summary} from the rows already loaded.")
+    except Exception as e:
+        connection.rollback()
+        print(e)
+
+
+def update_summary(
+    summary,
+    key_columns,
+    summary_rows,
+    cursor):
+
+    """
+    Adds newly loaded rows to a summary table (see create_summary_table).
+    summary_rows is SQL SELECTing them grouped by key_columns, with
+    their totals, in the summary's column order. Totals are added to
+    those of rows loaded before, and basket keys merged, so a basket
+    split across two loads is still counted once.
+    Nothing is committed here: it should go in with the rows it adds.
+    """
+
+    sql = Template("""
+        INSERT INTO $summary AS summary
+        $summary_rows
+        ON CONFLICT ($key_columns) DO UPDATE SET
+        UNITS = COALESCE(summary.UNITS + EXCLUDED.UNITS, summary.UNITS, EXCLUDED.UNITS),
+        SPEND = COALESCE(summary.SPEND + EXCLUDED.SPEND, summary.SPEND, EXCLUDED.SPEND),
+        ITEMS = summary.ITEMS + EXCLUDED.ITEMS,
+        BASKET_KEYS = ARRAY(
+            SELECT DISTINCT unnest(summary.BASKET_KEYS || EXCLUDED.BASKET_KEYS));""")
+
+    cursor.execute(sql.substitute(
+        summary=summary,
+        summary_rows=summary_rows,
+        key_columns=", ".join(key_columns)))
+
+
+def hash_file(input_path):
+
+    """
+    SHA-256 of a file's contents, read in copy_chunk_size pieces.
+
+    Returns:
+        str:    hex digest
+    """
+
+    content_hash = hashlib.sha256()
+    with open(input_path, "rb") as input_file:
+        for chunk in iter(functools.partial(input_file.read, db_config.copy_chunk_size), b""):
+            content_hash.update(chunk)
+
+    return content_hash.hexdigest()
+
+
+def import_once(
+    import_function,
+    input_path,
+    loader,
+    connection,
+    cursor,
+    force=False,
+    checkpointed=False):
+
+    """
+    Runs a loader's import_function on input_path, unless the manifest
+    shows the same content has already been loaded. A file whose path,
+    size and modification time match the manifest is skipped without
+    being read; otherwise it is hashed and looked up by content.
+
+    The manifest row is written before the import starts, in the same
+    transaction, so it is committed by the loader along with the data
+    (and disappears with it if the import fails).
+
+    A checkpointed import commits as it goes, so the manifest row is
+    written at the end instead, in the transaction which clears the
+    file's checkpoint. While a file has a checkpoint, importing it
+    without batches is refused, as it would repeat the rows already in.
+
+    Returns:
+        int:    rows loaded, or None if the file was skipped
+    """
+
+    file_stat = os.stat(input_path)
+    file_path = os.path.abspath(input_path)
+
+    sql_find_file = Template("""
+        SELECT loader, ingested_at, row_count FROM $table
+        WHERE file_path = %s AND byte_size = %s AND modified_ns = %s;""")
+    sql_find_hash = Template("""
+        SELECT loader, ingested_at, row_count FROM $table
+        WHERE content_hash = %s;""")
+    sql_record = Template("""
+        INSERT INTO $table (content_hash, loader, file_path, byte_size, modified_ns)
+        VALUES (%s, %s, %s, %s, %s)
+        ON CONFLICT (content_hash) DO UPDATE SET
+        loader = EXCLUDED.loader,
+        file_path = EXCLUDED.file_path,
+        byte_size = EXCLUDED.byte_size,
+        modified_ns = EXCLUDED.modified_ns,
+        row_count = NULL,
+        duration_seconds = NULL,
+        ingested_at = now();""")
+    sql_finish = Template("""
+        UPDATE $table SET row_count = %s, duration_seconds = %s
+        WHERE content_hash = %s;""")
+
+    #~ loading in one go after a batched load stopped part way would
+    #~ load the batches it committed a second time
+    if not checkpointed:
+        byte_offset, checkpoint_rows = read_checkpoint(input_path, cursor)
+        if byte_offset is not None or checkpoint_rows:
+            connection.rollback()
+            print(f"\n!!! {input_path} has a batched load which stopped after {checkpoint_rows} rows were committed.")
+            print(f"!!! Run again with --batch_rows to resume it, rather than load those rows twice.")
+            sys.exit(1)
+
+    if not force:
+        cursor.execute(
+            sql_find_file.substitute(table=db_config.ingest_manifest),
+            (file_path, file_stat.st_size, file_stat.st_mtime_ns))
+        previous = cursor.fetchone()
+    else:
+        previous = None
+
+    if previous is None:
+        content_hash = hash_file(input_path)
+        if not force:
+            cursor.execute(
+                sql_find_hash.substitute(table=db_config.ingest_manifest),
+                (content_hash,))
+            previous = cursor.fetchone()
+
+    if previous is not None:
+        connection.rollback()
+        loader_name, ingested_at, row_count = previous
+        print(f"\nSkipping {input_path}: already imported by {loader_name} on {ingested_at:%Y-%m-%d %H:%M} ({row_count} rows).")
+        print("Use --force to import it again.")
+        return None
+
+    start = time.perf_counter()
+    if not checkpointed:
+        cursor.execute(
+            sql_record.substitute(table=db_config.ingest_manifest),
+            (content_hash, loader, file_path, file_stat.st_size, file_stat.st_mtime_ns))
+
+    row_count = import_function(input_path, connection, cursor)
+
+    if checkpointed:
+        clear_checkpoint(input_path, cursor)
+        cursor.execute(
+            sql_record.substitute(table=db_config.ingest_manifest),
+            (content_hash, loader, file_path, file_stat.st_size, file_stat.st_mtime_ns))
+    cursor.execute(
+        sql_finish.substitute(table=db_config.ingest_manifest),
+        (row_count, time.perf_counter() - start, content_hash))
+    connection.commit()
+
+    return row_count
+
+
+def _file_identity(input_path):
+
+    """(absolute path, size, modification time) of a file, to key checkpoints."""
+
+    file_stat = os.stat(input_path)
+
+    return os.path.abspath(input_path), file_stat.st_size, file_stat.st_mtime_ns
+
+
+def read_checkpoint(input_path, cursor):
+
+    """
+    Finds how far a previous batched load of this file got. If the file
+    has changed since, its old checkpoint no longer matches.
+
+    Returns:
+        tuple:  (byte offset or None, rows already loaded)
+    """
+
+    sql = Template("""
+        SELECT byte_offset, row_count FROM $table
+        WHERE file_path = %s AND byte_size = %s AND modified_ns = %s;""")
+
+    cursor.execute(
+        sql.substitute(table=db_config.ingest_checkpoints),
+        _file_identity(input_path))
+    checkpoint = cursor.fetchone()
+
+    return checkpoint if checkpoint is not None else (None, 0)
+
+
+def save_checkpoint(
+    input_path,
+    byte_offset,
+    row_count,
+    cursor):
+
+    """Records progress through a file. Not committed here: it should
+    go in the same transaction as the batch it describes."""
+
+    sql = Template("""
+        INSERT INTO $table (file_path, byte_size, modified_ns, byte_offset, row_count)
+        VALUES (%s, %s, %s, %s, %s)
+        ON CONFLICT (file_path, byte_size, modified_ns) DO UPDATE SET
+        byte_offset = EXCLUDED.byte_offset,
+        row_count = EXCLUDED.row_count,
+        updated_at = now();""")
+
+    cursor.execute(
+        sql.substitute(table=db_config.ingest_checkpoints),
+        _file_identity(input_path) + (byte_offset, row_count))
+
+
+def clear_checkpoint(input_path, cursor):
+
+    """Removes a file's checkpoint once it is fully loaded. Not committed here."""
+
+    sql = Template("""
+        DELETE FROM $table
+        WHERE file_path = %s AND byte_size = %s AND modified_ns = %s;""")
+
+    cursor.execute(
+        sql.substitute(table=db_config.ingest_checkpoints),
+        _file_identity(input_path))
+
+
+class LineBatchReader:
+
+    """
+    A read-only file-like object over the next max_lines lines of an
+    open binary file, from its current position. Afterwards the file is
+    left positioned at the start of the following line.
+    """
+
+    def __init__(self, input_file, max_lines):
+
+        self.input_file = input_file
+        self.lines_left = max_lines
+
+    def read(self, size=-1):
+
+        if self.lines_left == 0:
+            return b""
+        if size < 0:
+            size = db_config.copy_chunk_size
+
+        chunk = self.input_file.read(size)
+        newline_count = chunk.count(b"\n")
+        if newline_count < self.lines_left:
+            self.lines_left -= newline_count
+            if not chunk:
+                self.lines_left = 0
+            return chunk
+
+        #~ the batch ends inside this chunk: cut it and step the file back
+        end = -1
+        for _ in range(self.lines_left):
+            end = chunk.index(b"\n", end + 1)
+        self.input_file.seek(end + 1 - len(chunk), os.SEEK_CUR)
+        self.lines_left = 0
+
+        return chunk[:end + 1]
+
+
+def copy_csv_file_in_batches(
+    sql,
+    csv_path,
+    connection,
+    cursor,
+    batch_rows,
+    after_copy=None):
+
+    """
+    COPYs a CSV with a header line in batches of batch_rows lines. Each
+    batch is committed along with a checkpoint of the byte offset it
+    reached, so if the load fails, a rerun starts from the last commit
+    rather than from the beginning. Like split loads, this assumes no
+    quoted field contains a newline.
+
+    sql is COPY ... FROM STDIN without HEADER. after_copy, if given, is
+    called with the cursor after each batch is COPYed and before it is
+    committed, for loads which COPY into a staging table first.
+
+    Returns:
+        int:    rows loaded in total, including by earlier runs
+    """
+
+    byte_offset, row_count = read_checkpoint(csv_path, cursor)
+    connection.commit()
+
+    with open(csv_path, "rb") as csv_file:
+        csv_file.readline()
+        if byte_offset is not None:
+            print(f"\nResuming {csv_path} from byte {byte_offset}, {row_count} rows already loaded.")
+            csv_file.seek(byte_offset)
+
+        while True:
+            try:
+                batch_row_count = copy_from_stdin(
+                    sql,
+                    LineBatchReader(csv_file, batch_rows),
+                    cursor)
+                if batch_row_count == 0:
+                    break
+                if after_copy:
+                    after_copy(cursor)
+                row_count += batch_row_count
+                save_checkpoint(csv_path, csv_file.tell(), row_count, cursor)
+                connection.commit()
+            except Exception:
+                connection.rollback()
+                print(f"\n!!! Load stopped: {row_count} rows of {csv_path} are committed. Run again with --batch_rows to resume from there.")
+                raise
+            print(f"Committed {row_count} rows ({csv_file.tell()} bytes).")
+
+    return row_count
+
+
+def copy_rows_in_batches(
+    sql,
+    rows,
+    input_path,
+    connection,
+    cursor,
+    batch_rows,
+    after_copy=None):
+
+    """
+    As copy_csv_file_in_batches, for files which have to be decoded as
+    they are read (so byte offsets are no use). The checkpoint is a
+    count of rows instead, and a rerun skips that many rows of the
+    input without sending them to Postgres.
+
+    rows is an iterator of rows, header first. after_copy is as for
+    copy_csv_file_in_batches.
+
+    Returns:
+        int:    rows loaded in total, including by earlier runs
+    """
+
+    _, row_count = read_checkpoint(input_path, cursor)
+    connection.commit()
+
+    rows = iter(rows)
+    next(rows, None)
+    if row_count:
+        print(f"\nResuming {input_path} after the {row_count} rows already loaded.")
+        next(itertools.islice(rows, row_count, row_count), None)
+
+    while True:
+        try:
+            batch_row_count = copy_from_stdin(
+                sql,
+                CSVRowStream(itertools.islice(rows, batch_rows)),
+                cursor)
+            if batch_row_count == 0:
+                break
+            if after_copy:
+                after_copy(cursor)
+            row_count += batch_row_count
+            save_checkpoint(input_path, None, row_count, cursor)
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            print(f"\n!!! Load stopped: {row_count} rows of {input_path} are committed. Run again with --batch_rows to resume from there.")
+            raise
+        print(f"Committed {row_count} rows.")
+
+    return row_count
+
+
+def expand_input_paths(path_or_pattern, extension=".csv"):
+
+    """
+    Turns a directory or glob pattern into a sorted list of files.
+    A directory means every file directly inside it with the given
+    extension (CSVs by default).
+
+    Returns:
+        list:   [file paths]
+    """
+
+    if os.path.isdir(path_or_pattern):
+        path_or_pattern = os.path.join(path_or_pattern, "*" + extension)
+
+    return sorted(
+        path for path in glob.glob(path_or_pattern)
+        if os.path.isfile(path))
+
+
+def _open_worker_connection():
+
+    """Pool initializer: each worker process holds its own connection."""
+
+    global worker_connection, worker_cursor
+    worker_connection, worker_cursor = PG_status.connect_to_postgres(db_config)
+
+
+def _import_in_worker(
+    import_function,
+    loader,
+    force,
+    checkpointed,
+    input_path):
+
+    """
+    Runs one loader import inside a pool worker and reports how it went.
+    The loaders sys.exit() when an import fails, so SystemExit is
+    caught here as well: it should fail the file, not the worker.
+
+    Returns:
+        tuple:  (path, status, rows, seconds)
+    """
+
+    start = time.perf_counter()
+    try:
+        row_count = import_once(
+            import_function,
+            input_path,
+            loader,
+            worker_connection,
+            worker_cursor,
+            force,
+            checkpointed)
+        status = "OK" if row_count is not None else "SKIPPED"
+    except (Exception, SystemExit):
+        worker_connection.rollback()
+        row_count = 0
+        status = "FAILED"
+
+    return input_path, status, row_count or 0, time.perf_counter() - start
+
+
+def import_files_in_parallel(
+    import_function,
+    input_paths,
+    loader,
+    workers,
+    force=False,
+    checkpointed=False):
+
+    """
+    Spreads input files over a pool of worker processes, each with its
+    own Postgres connection. import_function is a loader's
+    import_csv_to_pg_table, called as (path, connection, cursor) and
+    returning the number of rows loaded. Files already in the
+    ingestion manifest are skipped unless force is set.
+
+    Returns:
+        list:   [(path, status, rows, seconds)] in order of completion
+    """
+
+    if len(input_paths) == 0:
+        print("\n!!! No input files matched.")
+        return []
+
+    workers = max(1, min(workers, len(input_paths)))
+    print(f"\nImporting {len(input_paths)} files using {workers} workers...")
+
+    results = []
+    start = time.perf_counter()
+    with multiprocessing.Pool(workers, initializer=_open_worker_connection) as pool:
+        for result in pool.imap_unordered(
+                functools.partial(_import_in_worker, import_function, loader, force, checkpointed),
+                input_paths):
+            input_path, status, row_count, seconds = result
+            print(f"[{len(results) + 1}/{len(input_paths)}] {status:7} {input_path}: {row_count} rows in {seconds:.1f}s")
+            results.append(result)
+    elapsed = time.perf_counter() - start
+
+    imported = [result[0] for result in results if result[1] == "OK"]
+    skipped = [result[0] for result in results if result[1] == "SKIPPED"]
+    failures = [result[0] for result in results if result[1] == "FAILED"]
+    total_rows = sum(result[2] for result in results)
+    print(f"\n{len(imported)} of {len(results)} files imported ({len(skipped)} skipped as already imported), {total_rows} rows in {elapsed:.1f}s ({total_rows / elapsed:.0f} rows/sec).")
+    if failures:
+        print("!!! These files failed to import:")
+        print(*failures, sep="\n")
+
+    return results
+
+
+def split_file_on_newlines(
+    input_path,
+    parts):
+
+    """
+    Divides a file (after its header line) into roughly equal byte
+    ranges that each start and end on a line boundary. The file is
+    mmapped, so only the few bytes around each cut are actually read.
+    Note that this assumes no quoted field contains a newline.
+
+    Returns:
+        list:   [(start byte, end byte)]
+    """
+
+    with open(input_path, "rb") as input_file:
+        if os.fstat(input_file.fileno()).st_size == 0:
+            return []
+        with mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            file_size = len(mapped)
+            header_end = mapped.find(b"\n") + 1
+            if header_end == 0:
+                return []
+            boundaries = [header_end]
+            for part in range(1, parts):
+                guess = header_end + (file_size - header_end) * part // parts
+                if guess < boundaries[-1]:
+                    continue
+                newline = mapped.find(b"\n", guess)
+                if newline == -1:
+                    break
+                boundaries.append(newline + 1)
+            boundaries.append(file_size)
+
+    return [
+        (start, end) for start, end in zip(boundaries, boundaries[1:])
+        if end > start]
+
+
+class FileRangeReader:
+
+    """
+    A read-only file-like object over bytes start to end of a file,
+    so that one slice of a file can be handed to copy_from_stdin.
+    """
+
+    def __init__(self, input_file, start, end):
+
+        self.input_file = input_file
+        self.input_file.seek(start)
+        self.remaining = end - start
+
+    def read(self, size=-1):
+
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        chunk = self.input_file.read(size)
+        self.remaining -= len(chunk)
+
+        return chunk
+
+
+def _copy_range_in_worker(
+    copy_sql,
+    table,
+    staging_columns,
+    staging_table,
+    input_path,
+    byte_range):
+
+    """
+    Pool task: COPYs one byte range of a file into its own UNLOGGED
+    staging table, shaped like the target table unless staging_columns
+    are given, and commits.
+
+    Returns:
+        tuple:  (staging table, succeeded, rows)
+    """
+
+    sql_staging_table = Template("""
+        CREATE UNLOGGED TABLE $staging_table
+        ($columns);""")
+
+    try:
+        worker_cursor.execute(sql_staging_table.substitute(
+            staging_table=staging_table,
+            columns=staging_columns or f"LIKE {table} INCLUDING DEFAULTS"))
+        with open(input_path, "rb") as input_file:
+            row_count = copy_from_stdin(
+                copy_sql.substitute(table=staging_table),
+                FileRangeReader(input_file, *byte_range),
+                worker_cursor)
+        worker_connection.commit()
+    except Exception as e:
+        worker_connection.rollback()
+        print(f"\n!!! Problem loading bytes {byte_range[0]}-{byte_range[1]} of {input_path}:\n{e}")
+        return staging_table, False, 0
+
+    return staging_table, True, row_count
+
+
+def copy_file_in_parallel_ranges(
+    copy_sql,
+    table,
+    input_path,
+    connection,
+    cursor,
+    workers,
+    staging_columns=None,
+    publish=None):
+
+    """
+    Loads one large CSV over several connections at once. The file is
+    cut into line-aligned byte ranges, each range is COPYed into its own
+    UNLOGGED staging table by a pool worker, and if every range loads,
+    the staging tables are moved into the target table in a single
+    transaction. Either all of the file is published, or none of it.
+
+    copy_sql is a Template for COPY $table (...) FROM STDIN, without
+    HEADER since only the first range would contain it.
+
+    For tables which are loaded through a differently shaped staging
+    table, staging_columns gives its column definitions, and publish is
+    called with (staging table, cursor) to move each one into table.
+
+    Returns:
+        int:    number of rows loaded
+    """
+
+    byte_ranges = split_file_on_newlines(input_path, workers)
+    load_id = uuid.uuid4().hex[:8]
+    staging_tables = [
+        f"{table}_stage_{load_id}_{part}" for part in range(len(byte_ranges))]
+
+    print(f"\nSplit {input_path} into {len(byte_ranges)} ranges, loading in parallel...")
+
+    start = time.perf_counter()
+    with multiprocessing.Pool(len(byte_ranges) or 1, initializer=_open_worker_connection) as pool:
+        results = pool.starmap(
+            functools.partial(_copy_range_in_worker, copy_sql, table, staging_columns),
+            zip(staging_tables, [input_path] * len(byte_ranges), byte_ranges))
+
+    sql_publish = Template("""
+        INSERT INTO $table
+        SELECT * FROM $staging_table;""")
+    sql_drop = Template("""
+        DROP TABLE IF EXISTS $staging_table;""")
+
+    all_succeeded = all(succeeded for _, succeeded, _ in results)
+    row_count = 0
+    try:
+        if all_succeeded:
+            for staging_table, _, staging_row_count in results:
+                if publish:
+                    publish(staging_table, cursor)
+                else:
+                    cursor.execute(sql_publish.substitute(
+                        table=table,
+                        staging_table=staging_table))
+                row_count += staging_row_count
+            connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        #~ staging tables go whether or not the publish worked. Roll back
+        #~ first, so a failed load's manifest row (see import_once) isn't
+        #~ committed with the drops
+        connection.rollback()
+        for staging_table in staging_tables:
+            cursor.execute(sql_drop.substitute(staging_table=staging_table))
+        connection.commit()
+
+    if not all_succeeded:
+        raise RuntimeError(f"{input_path} was not loaded: some ranges failed, so nothing was published.")
+
+    elapsed = time.perf_counter() - start
+    print(f"\nPublished {row_count} rows to {table} in {elapsed:.1f}s ({row_count / elapsed:.0f} rows/sec).")
+
+    return row_count
+
+
+def _rebuild_index(statements):
+
+    """
+    ThreadPool task: runs the statements rebuilding one index on a
+    connection of its own, so several indexes can build at once.
+
+    Returns:
+        str:    error message, or None if it worked
+    """
+
+    connection, cursor = PG_status.connect_to_postgres(db_config)
+    try:
+        cursor.execute(
+            "SET maintenance_work_mem = %s;",
+            (db_config.bulk_maintenance_work_mem,))
+        for statement in statements:
+            cursor.execute(statement)
+        connection.commit()
+    except Exception as e:
+        connection.rollback()
+        return f"{statements[0]}\n{e}"
+    finally:
+        connection.close()
+
+
+@contextlib.contextmanager
+def indexes_suspended(
+    table,
+    connection,
+    cursor,
+    enabled=True,
+    workers=1):
+
+    """
+    Context manager for bulk loads. The definitions of the table's
+    indexes and unique constraints are recorded, then they are dropped
+    so COPY doesn't pay for index maintenance on every row. On the way
+    out, whether the load worked or not, they are rebuilt in parallel
+    with a larger maintenance_work_mem and the table is ANALYZEd.
+
+    Unique constraints are rebuilt as a unique index first and then
+    attached, so they can build alongside the plain indexes. If the
+    load let in duplicates the constraint can't come back: each index
+    or constraint which couldn't be rebuilt is named, with the SQL to
+    restore it, and the loader exits non-zero.
+    """
+
+    if not enabled:
+        yield
+        return
+
+    sql_indexes = """
+        SELECT index_class.relname, pg_get_indexdef(index_class.oid), constraint_.conname
+        FROM pg_index
+        JOIN pg_class AS index_class ON index_class.oid = pg_index.indexrelid
+        LEFT JOIN pg_constraint AS constraint_ ON constraint_.conindid = pg_index.indexrelid
+        WHERE pg_index.indrelid = %s::regclass
+        AND NOT pg_index.indisprimary
+        AND (constraint_.contype IS NULL OR constraint_.contype = 'u');"""
+    sql_drop_index = Template("""
+        DROP INDEX $index;""")
+    sql_drop_constraint = Template("""
+        ALTER TABLE $table DROP CONSTRAINT $constraint;""")
+    sql_attach_constraint = Template("""
+        ALTER TABLE $table ADD CONSTRAINT $constraint UNIQUE USING INDEX $index;""")
+
+    cursor.execute(sql_indexes, (table,))
+    indexes = cursor.fetchall()
+    for index, _, constraint in indexes:
+        if constraint:
+            cursor.execute(sql_drop_constraint.substitute(table=table, constraint=constraint))
+        else:
+            cursor.execute(sql_drop_index.substitute(index=index))
+    connection.commit()
+    print(f"\nBulk mode: dropped {len(indexes)} indexes on {table} for the load.")
+
+    try:
+        yield
+    finally:
+        #~ a failed COPY leaves the transaction aborted
+        connection.rollback()
+
+        rebuilds = []
+        for index, index_definition, constraint in indexes:
+            #~ an index on a partitioned table is defined ON ONLY the parent,
+            #~ made again without ONLY it is built on every partition too
+            statements = [index_definition.replace(" ON ONLY ", " ON ", 1)]
+            if constraint:
+                statements.append(sql_attach_constraint.substitute(
+                    table=table,
+                    constraint=constraint,
+                    index=index))
+            rebuilds.append(statements)
+
+        print(f"\nBulk mode: rebuilding {len(rebuilds)} indexes on {table}...")
+        start = time.perf_counter()
+        failures = []
+        if rebuilds:
+            with multiprocessing.pool.ThreadPool(max(1, min(workers, len(rebuilds)))) as pool:
+                errors = pool.map(_rebuild_index, rebuilds)
+            failures = [
+                (index, constraint, statements, error)
+                for (index, _, constraint), statements, error in zip(indexes, rebuilds, errors)
+                if error]
+        cursor.execute(Template("ANALYZE $table;").substitute(table=table))
+        connection.commit()
+
+        #~ the table must not be left quietly without its indexes,
+        #~ least of all without a UNIQUE constraint the loaders rely on
+        if failures:
+            for index, constraint, statements, error in failures:
+                if constraint:
+                    print(f"\n!!! Could not restore UNIQUE constraint {constraint} on {table},")
+                    print(f"!!! so {table} can now take duplicates. Remove them, then run:")
+                else:
+                    print(f"\n!!! Could not rebuild index {index} on {table}. Fix the cause, then run:")
+                for statement in statements:
+                    print(f"{statement.strip().rstrip(';')};")
+                #~ the error starts with the statement which failed
+                print(error.split("\n", 1)[-1].strip())
+            sys.exit(1)
+        print(f"Bulk mode: indexes rebuilt and {table} analyzed in {time.perf_counter() - start:.1f}s.")
@@ -47,6 +47,15 @@ def args_setup():
     parser.add_argument(
         "--join", action = "store_true",
         help = "Return card transaction items from your query, JOINed with product information.")
+    parser.add_argument(
+        "--search", action = "store",
+        help = "Find products by words, best matches first, eg: \"sugar free\". With --join, return their card transactions instead.")
+    parser.add_argument(
+        "--limit", type = int, default = 20,
+        help = "Number of products to return with --search (default 20).")
+    parser.add_argument(
+        "--check_join", action = "store_true",
+        help = "Report how many card items have a match in the product table for --join, and which don't.")
     parser.add_argument(
         "--write_csv", action = "store",
         help = "Write the results to a CSV file (specify the filename).")
@@ -85,7 +94,9 @@ def write_to_csv(filename, records, join=False,):
         "ITEM_DESCRIPTION","POINTS_ADJUSTMENT",
         "POINTS_ITEM","UNITS",
         "SPEND",
-        "DISCOUNT",]
+        "DISCOUNT",
+        "STORE_CODE",
+        "PRODUCT_KEY",]
 
     join_fields = [
         "index",
@@ -94,7 +105,9 @@ def write_to_csv(filename, records, join=False,):
         "name",
         "PDP_productPrice",
         "details",
-        "long_description",]
+        "long_description",
+        "product_key",
+        "search_vector",]
 
     if join:
         fields.extend(join_fields)
@@ -154,6 +167,136 @@ def db_details(
         print(e)
 
 
+def search_products(cursor):
+
+    """
+    Finds the products whose name, details or long description have the
+    words in --search (in any form, eg "sugar free" finds "Sugar-Free"),
+    using the GIN index on SEARCH_VECTOR, and returns them best match
+    first. Quoted phrases, "or" and -word work as in web searches.
+
+    With --join, it is the card transactions of those products which are
+    returned, with the product details, narrowed by --customer, --date
+    and --store, or their count or total spend.
+    """
+
+    sql_products = Template("""
+        SELECT PRODUCTID, NAME, PRICE, ts_rank(SEARCH_VECTOR, query) AS rank
+        FROM $product_table, websearch_to_tsquery(%s, %s) AS query
+        WHERE SEARCH_VECTOR @@ query
+        ORDER BY rank DESC, NAME
+        LIMIT %s;""")
+    sql_transactions = Template("""
+        SELECT $record_type FROM $card_table
+        JOIN $product_table
+        ON $card_table.PRODUCT_KEY = $product_table.PRODUCT_KEY
+        WHERE $product_table.SEARCH_VECTOR @@ websearch_to_tsquery(%s, %s)
+        $filters
+        $order;""")
+
+    search = (db_config.search_language, args.search)
+
+    if not args.join:
+        cursor.execute(
+            sql_products.substitute(product_table = db_config.boots_products),
+            search + (args.limit,))
+        result = cursor.fetchall()
+        if write_csv:
+            with open(args.write_csv, "w") as file:
+                write = csv.writer(file)
+                write.writerow(["productid", "name", "price", "rank"])
+                write.writerows(result)
+            print(f"OK, written {len(result)} products to {file.name}.")
+        else:
+            for product_id, name, price, rank in result:
+                print(f"{rank:.3f}  {product_id}  {name}  {price}")
+        return None
+
+    filters = []
+    parameters = list(search)
+    if args.customer:
+        filters.append("AND ID = %s")
+        parameters.append(args.customer)
+    if date:
+        filters.append("AND DATE2 = %s")
+        parameters.append(date)
+    if start_date:
+        filters.append("AND DATE2 >= %s AND DATE2 <= %s")
+        parameters.extend([start_date, end_date])
+    if args.store:
+        filters.append("AND STORE_CODE = %s")
+        parameters.append(args.store)
+    order = ""
+    if record_type == "*":
+        order = f"ORDER BY ts_rank({db_config.boots_products}.SEARCH_VECTOR, websearch_to_tsquery(%s, %s)) DESC, DATE2"
+        parameters.extend(search)
+
+    cursor.execute(
+        sql_transactions.substitute(
+            record_type = record_type,
+            card_table = db_config.boots_transactions,
+            product_table = db_config.boots_products,
+            filters = "\n        ".join(filters),
+            order = order),
+        parameters)
+    result = cursor.fetchall()
+
+    return output_type(record_type, result, write_csv,)
+
+
+def check_join(
+    cursor,
+    connection,):
+
+    """
+    Reports how well card items match products for --join, which joins
+    them on PRODUCT_KEY: how many item codes and transactions have a
+    product, the most bought codes which don't, and any products which
+    share a key (which would repeat their transactions in a join).
+    """
+
+    sql_items = Template("""
+        SELECT items.ITEM_CODE, items.item_rows, EXISTS (
+            SELECT 1 FROM $product_table AS products
+            WHERE products.PRODUCT_KEY = items.PRODUCT_KEY)
+        FROM (
+            SELECT ITEM_CODE, PRODUCT_KEY, COUNT(*) AS item_rows
+            FROM $card_table
+            GROUP BY ITEM_CODE, PRODUCT_KEY) AS items
+        ORDER BY items.item_rows DESC;""")
+    sql_shared_keys = Template("""
+        SELECT PRODUCT_KEY, string_agg(PRODUCTID, ', ')
+        FROM $product_table
+        WHERE PRODUCT_KEY IS NOT NULL
+        GROUP BY PRODUCT_KEY
+        HAVING COUNT(*) > 1;""")
+
+    try:
+        cursor.execute(sql_items.substitute(
+            card_table = db_config.boots_transactions,
+            product_table = db_config.boots_products))
+        items = cursor.fetchall()
+        cursor.execute(sql_shared_keys.substitute(product_table = db_config.boots_products))
+        shared_keys = cursor.fetchall()
+    except Exception as e:
+        print(e)
+        return
+
+    unmatched = [(item_code, item_rows) for item_code, item_rows, matched in items if not matched]
+    total_rows = sum(item_rows for _, item_rows, _ in items)
+    unmatched_rows = sum(item_rows for _, item_rows in unmatched)
+    print(f"\nItem codes:          {len(items) - len(unmatched)} of {len(items)} match a product")
+    print(f"Transactions:        {total_rows - unmatched_rows} of {total_rows} match a product")
+    if unmatched:
+        print(f"\nMost bought item codes without a product:")
+        for item_code, item_rows in unmatched[:20]:
+            print(f"  {item_code!s:20}{item_rows:>10}")
+    if shared_keys:
+        print(f"\n!!! These products share a PRODUCT_KEY, so --join repeats their transactions:")
+        for product_key, product_ids in shared_keys:
+            print(f"  {product_key}: {product_ids}")
+
+
 def arg_triggers():
 
     #~ date range trigger
@@ -189,14 +332,43 @@ def arg_triggers():
     if args.spend:
         record_type = "SUM(SPEND)"
 
-    #~ store numbers are in a VARCHAR field with brackets around,
-    #~ so we want to add those brackets to avoid erroneous
-    #~ substring matching, say, 786 with 1786
-    store_w_brackets = None
-    if args.store:
-        store_w_brackets = "(" + args.store + ")"
+    #~ stores are looked up by the number taken from the brackets
+    #~ in the STORE field, so 786 can't match 1786
+    if args.store and not args.store.isdigit():
+        print(f"\n!!! Please provide the store number only, eg: --store 6565")
+        sys.exit(1)
+
+    if args.search and args.product:
+        print(f"\n!!! Please provide either --search or --product, not both.")
+        sys.exit(1)
+
+    return date, start_date, end_date, join, write_csv, record_type
+
+
+def summary_source(record_type, cursor):
+
+    """
+    Counts and spend which don't involve products can be summed from
+    boots_daily_summary, which has a row per customer, store and day,
+    rather than from every item row. It has the same ID, DATE2 and
+    STORE_CODE columns, so the query templates work on either.
+
+    Returns:
+        tuple:  (table, record_type) to query, which are the ones given
+                if the summary can't answer the query
+    """
+
+    summary_record_types = {
+        "COUNT(*)": "COALESCE(SUM(ITEMS), 0)",
+        "SUM(SPEND)": "SUM(SPEND)"}
+
+    if record_type not in summary_record_types or args.join or args.product:
+        return db_config.boots_transactions, record_type
+    cursor.execute("SELECT to_regclass(%s);", (db_config.boots_daily_summary,))
+    if cursor.fetchone()[0] is None:
+        return db_config.boots_transactions, record_type
 
-    return date, start_date, end_date, join, write_csv, record_type, store_w_brackets
+    return db_config.boots_daily_summary, summary_record_types[record_type]
 
 
 #~ main ############################################
@@ -204,6 +376,20 @@ def main():
 
     try:
 
+        if args.check_join:
+            connection, cursor = PG_status.connect_to_postgres(db_config)
+            check_join(
+                cursor,
+                connection,)
+            connection.close()
+            sys.exit(0)
+
+        if args.search:
+            connection, cursor = PG_status.connect_to_postgres(db_config)
+            records = search_products(cursor)
+            connection.close()
+            return records
+
         #~ Return some DB details if no query args are given
         if args.details or not any([
             args.product,
@@ -297,6 +483,7 @@ def main():
         #~ Create connection using psycopg2
         connection, cursor = PG_status.connect_to_postgres(db_config)
         try:
+            table, query_record_type = summary_source(record_type, cursor)
             #~ modify the sql template with our args
             cursor.execute(sql.substitute(
                 customer = args.customer,
@@ -305,10 +492,10 @@ def main():
                 start_date = start_date,
                 end_date = end_date,
                 store = args.store,
-                record_type = record_type,
+                record_type = query_record_type,
                 card_table = db_config.boots_transactions,
                 product_table = db_config.boots_products,
-                table = db_config.boots_transactions,))
+                table = table,))
             #~ submit the query
             result = cursor.fetchall()
             connection.close()
@@ -336,12 +523,12 @@ if __name__ == "__main__":
 
     #~ we need to fiddle a little with the args
     (date, start_date, end_date, join,
-     write_csv, record_type, store_w_brackets,) = arg_triggers()
+     write_csv, record_type,) = arg_triggers()
 
     ####~ main runner
     records = main()
     ################~
 
-    if args.write_csv:
+    if args.write_csv and records is not None:
         write_to_csv(args.write_csv, records, write_csv,)
 
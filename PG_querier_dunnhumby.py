@@ -45,6 +45,9 @@ def args_setup():
     parser.add_argument(
         "--basket", action="store",
         help="Basket ID. Format: 123450123456789")
+    parser.add_argument(
+        "--baskets", action="store_true",
+        help="Return one record per basket, rather than per item (not with --product).")
     parser.add_argument(
         "--count", action="store_true",
         help="Return total record counts.")
@@ -69,6 +72,58 @@ def output_type(record_type, result):
         print(result[0][0])
 
 
+def summary_source(record_type, cursor):
+
+    """
+    Counts and spend for customers and days can be summed from
+    dunn_humby_daily_summary, which has a row per customer, store and
+    day, rather than from every item row. It has the same CUST_CODE,
+    SHOP_DATE, SHOP_WEEK and SHOP_WEEKDAY columns, so the query
+    templates for those work on either.
+
+    Returns:
+        tuple:  (table, record_type) to query, which are the ones given
+                if the summary can't answer the query
+    """
+
+    summary_record_types = {
+        "COUNT(*)": "COALESCE(SUM(ITEMS), 0)",
+        "SUM(SPEND) / 100.0": "SUM(SPEND) / 100.0"}
+
+    if record_type not in summary_record_types:
+        return "dunn_humby", record_type
+    cursor.execute("SELECT to_regclass(%s);", (db_config.dunn_humby_daily_summary,))
+    if cursor.fetchone()[0] is None:
+        return "dunn_humby", record_type
+
+    return db_config.dunn_humby_daily_summary, summary_record_types[record_type]
+
+
+def basket_source(record_type, cursor):
+
+    """
+    A basket's item count and spend are in its row of
+    dunn_humby_basket_facts, so can be looked up rather than summed
+    from its items.
+
+    Returns:
+        tuple:  (table, record_type) to query, which are the ones given
+                if the basket table can't answer the query
+    """
+
+    basket_record_types = {
+        "COUNT(*)": "COALESCE(SUM(ITEMS), 0)",
+        "SUM(SPEND) / 100.0": "SUM(SPEND) / 100.0"}
+
+    if record_type not in basket_record_types:
+        return "dunn_humby", record_type
+    cursor.execute("SELECT to_regclass(%s);", (db_config.dunn_humby_basket_facts,))
+    if cursor.fetchone()[0] is None:
+        return "dunn_humby", record_type
+
+    return db_config.dunn_humby_basket_facts, basket_record_types[record_type]
+
+
 #~ QUERIES FUNCTIONS start =======================
 def all_records_from_product(
     product,
@@ -94,6 +149,7 @@ def all_records_from_product(
 def all_records_from_hour(
     hour,
     record_type,
+    table,
     cursor,
     connection):
 
@@ -104,7 +160,7 @@ def all_records_from_hour(
     try:
         cursor.execute(sql.substitute(
             record_type=record_type,
-            table="dunn_humby",
+            table=table,
             hour=hour))
         result = cursor.fetchall()
         output_type(record_type, result)
@@ -115,6 +171,7 @@ def all_records_from_hour(
 def all_records_from_date(
     date,
     record_type,
+    table,
     cursor,
     connection):
 
@@ -125,7 +182,7 @@ def all_records_from_date(
     try:
         cursor.execute(sql.substitute(
             record_type=record_type,
-            table="dunn_humby",
+            table=table,
             date=date))
         result = cursor.fetchall()
         output_type(record_type, result)
@@ -136,6 +193,7 @@ def all_records_from_date(
 def all_records_from_week(
     week,
     record_type,
+    table,
     cursor,
     connection):
 
@@ -146,7 +204,7 @@ def all_records_from_week(
     try:
         cursor.execute(sql.substitute(
             record_type=record_type,
-            table="dunn_humby",
+            table=table,
             week=week))
         result = cursor.fetchall()
         output_type(record_type, result)
@@ -157,6 +215,7 @@ def all_records_from_week(
 def all_records_from_weekday(
     weekday,
     record_type,
+    table,
     cursor,
     connection):
 
@@ -167,7 +226,7 @@ def all_records_from_weekday(
     try:
         cursor.execute(sql.substitute(
             record_type=record_type,
-            table="dunn_humby",
+            table=table,
             weekday=weekday))
         result = cursor.fetchall()
         output_type(record_type, result)
@@ -178,6 +237,7 @@ def all_records_from_weekday(
 def customer_records_all(
     customer,
     record_type,
+    table,
     cursor,
     connection):
 
@@ -188,7 +248,7 @@ def customer_records_all(
     try:
         cursor.execute(sql.substitute(
             record_type=record_type,
-            table="dunn_humby",
+            table=table,
             customer=customer))
         result = cursor.fetchall()
         output_type(record_type, result)
@@ -200,6 +260,7 @@ def customer_records_from_date(
     customer,
     date,
     record_type,
+    table,
     cursor,
     connection):
 
@@ -211,7 +272,7 @@ def customer_records_from_date(
     try:
         cursor.execute(sql.substitute(
             record_type=record_type,
-            table="dunn_humby",
+            table=table,
             customer=customer,
             date=date))
         result = cursor.fetchall()
@@ -224,6 +285,7 @@ def customer_records_from_week(
     customer,
     week,
     record_type,
+    table,
     cursor,
     connection):
 
@@ -235,7 +297,7 @@ def customer_records_from_week(
     try:
         cursor.execute(sql.substitute(
             record_type=record_type,
-            table="dunn_humby",
+            table=table,
             customer=customer,
             week=week))
         result = cursor.fetchall()
@@ -248,6 +310,7 @@ def customer_records_from_weekday(
     customer,
     weekday,
     record_type,
+    table,
     cursor,
     connection):
 
@@ -259,7 +322,7 @@ def customer_records_from_weekday(
     try:
         cursor.execute(sql.substitute(
             record_type=record_type,
-            table="dunn_humby",
+            table=table,
             customer=customer,
             weekday=weekday))
         result = cursor.fetchall()
@@ -354,6 +417,7 @@ def customer_records_for_product_from_weekday(
 def basket_all_records(
     basket,
     record_type,
+    table,
     cursor,
     connection):
 
@@ -364,7 +428,7 @@ def basket_all_records(
     try:
         cursor.execute(sql.substitute(
             record_type=record_type,
-            table="dunn_humby",
+            table=table,
             basket=basket))
         result = cursor.fetchall()
         output_type(record_type, result)
@@ -474,7 +538,26 @@ def main():
         if args.count:
             record_type = "COUNT(*)"
         if args.spend:
-            record_type = "SUM(SPEND)"
+            #~ SPEND is stored in pence
+            record_type = "SUM(SPEND) / 100.0"
+
+        #~ queries without a product, hour or basket can use the daily summary
+        table, summary_record_type = summary_source(record_type, cursor)
+        basket_table, basket_record_type = basket_source(record_type, cursor)
+        hour_table, hour_record_type = "dunn_humby", record_type
+
+        #~ with --baskets, the same queries are made on the basket table,
+        #~ which has a row per basket, so COUNT(*) counts baskets
+        if args.baskets:
+            if args.product:
+                print(f"\n!!! --baskets can't be used together with --product.")
+                sys.exit(1)
+            cursor.execute("SELECT to_regclass(%s);", (db_config.dunn_humby_basket_facts,))
+            if cursor.fetchone()[0] is None:
+                print(f"\n!!! There is no {db_config.dunn_humby_basket_facts} table yet, it is made by the next CSV2PG_dunnhumby.py load.")
+                sys.exit(1)
+            table = hour_table = basket_table = db_config.dunn_humby_basket_facts
+            summary_record_type = hour_record_type = basket_record_type = record_type
 
     #~ three args ========================
         if args.customer and args.date and args.product:
@@ -516,7 +599,8 @@ def main():
             customer_records_from_date(
                 args.customer,
                 args.date,
-                record_type,
+                summary_record_type,
+                table,
                 cursor,
                 connection)
             connection.close()
@@ -526,7 +610,8 @@ def main():
             customer_records_from_week(
                 args.customer,
                 args.week,
-                record_type,
+                summary_record_type,
+                table,
                 cursor,
                 connection)
             connection.close()
@@ -536,7 +621,8 @@ def main():
             customer_records_from_weekday(
                 args.customer,
                 args.weekday,
-                record_type,
+                summary_record_type,
+                table,
                 cursor,
                 connection)
             connection.close()
@@ -546,7 +632,8 @@ def main():
         if args.customer:
             customer_records_all(
                 args.customer,
-                record_type,
+                summary_record_type,
+                table,
                 cursor,
                 connection)
             connection.close()
@@ -564,7 +651,8 @@ def main():
         if args.hour:
             all_records_from_hour(
                 args.hour,
-                record_type,
+                hour_record_type,
+                hour_table,
                 cursor,
                 connection)
             connection.close()
@@ -573,7 +661,8 @@ def main():
         if args.date:
             all_records_from_date(
                 args.date,
-                record_type,
+                summary_record_type,
+                table,
                 cursor,
                 connection)
             connection.close()
@@ -582,7 +671,8 @@ def main():
         if args.week:
             all_records_from_week(
                 args.week,
-                record_type,
+                summary_record_type,
+                table,
                 cursor,
                 connection)
             connection.close()
@@ -591,7 +681,8 @@ def main():
         if args.weekday:
             all_records_from_weekday(
                 args.weekday,
-                record_type,
+                summary_record_type,
+                table,
                 cursor,
                 connection)
             connection.close()
@@ -600,7 +691,8 @@ def main():
         if args.basket:
             basket_all_records(
                 args.basket,
-                record_type,
+                basket_record_type,
+                basket_table,
                 cursor,
                 connection)
             connection.close()
@@ -0,0 +1,130 @@
+
+#~ Standard library imports
+import sys
+import traceback
+from string import Template
+import argparse
+import csv
+
+#~ local imports
+import db_config
+import PG_status
+import CSV2PG_foodproducts
+
+
+def args_setup():
+
+    parser = argparse.ArgumentParser(
+        description = "PostgreSQL DB Querier: food_products",
+        epilog = "Example: python PG_querier_foodproducts.py --search \"wholemeal bread\"")
+    parser.add_argument(
+        "--details", action = "store_true",
+        help = "Provide food_products table information.")
+    parser.add_argument(
+        "--search", action = "store",
+        help = "Find products by words, best matches first, eg: \"low fat yoghurt\".")
+    parser.add_argument(
+        "--limit", type = int, default = 20,
+        help = "Number of products to return (default 20).")
+    parser.add_argument(
+        "--write_csv", action = "store",
+        metavar = "PATH",
+        help = "Write the products found to a CSV file.")
+
+    args = parser.parse_args()
+
+    return parser, args
+
+
+def search_products(search, limit, cursor):
+
+    """
+    Finds the food products whose descriptions, brand or ingredients
+    have the words in search (in any form, eg "yoghurts" finds
+    "Yoghurt"), using the GIN index on SEARCH_VECTOR. Words in the
+    descriptions count for more than those in the brand and marketing
+    text, and those more than ingredients.
+
+    Returns:
+        list:   (x_id, x_descr, x_brand, energy, sugars and salt per
+                serving, rank) for each product, best match first
+    """
+
+    sql = Template("""
+        SELECT x_id, x_descr, x_brand,
+        x_energyserv, x_sugarsserv, x_saltserv,
+        ts_rank(SEARCH_VECTOR, query) AS rank
+        FROM $table, websearch_to_tsquery(%s, %s) AS query
+        WHERE SEARCH_VECTOR @@ query
+        ORDER BY rank DESC, x_descr
+        LIMIT %s;""")
+
+    cursor.execute(
+        sql.substitute(table = db_config.food_products),
+        (db_config.search_language, search, limit))
+
+    return cursor.fetchall()
+
+
+def write_to_csv(path, products):
+
+    fields = [
+        "x_id",
+        "x_descr",
+        "x_brand",
+        "x_energyserv",
+        "x_sugarsserv",
+        "x_saltserv",
+        "rank",]
+
+    with open(path, "w") as file:
+        write = csv.writer(file)
+        write.writerow(fields)
+        write.writerows(products)
+    print(f"OK, written {len(products)} products to {file.name}.")
+
+
+def main():
+
+    try:
+
+        parser, args = args_setup()
+        if len(sys.argv) < 2:
+            parser.print_help(sys.stderr)
+            sys.exit(1)
+
+        connection, cursor = PG_status.connect_to_postgres(db_config)
+
+        if args.details or not args.search:
+            CSV2PG_foodproducts.table_details(
+                connection,
+                cursor)
+            connection.close()
+            sys.exit(0)
+
+        products = search_products(
+            args.search,
+            args.limit,
+            cursor)
+        connection.close()
+
+        if args.write_csv:
+            write_to_csv(args.write_csv, products)
+        else:
+            for x_id, descr, brand, energy, sugars, salt, rank in products:
+                print(f"{rank:.3f}  {x_id}  {descr}  ({brand})  energy {energy}, sugars {sugars}, salt {salt}")
+
+    except KeyboardInterrupt:
+        print("OK, stopping.")
+        try:
+            connection.close()
+        except Exception as e:
+            print(e)
+
+    except Exception:
+        traceback.print_exc(file = sys.stdout)
+
+
+if __name__ == "__main__":
+
+    main()
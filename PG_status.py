@@ -5,6 +5,7 @@ import os
 import subprocess
 import re
 import argparse
+import datetime
 from string import Template
 import csv
 import codecs
@@ -17,10 +18,13 @@ from psycopg2 import Error
 
 #~ local imports
 import db_config
+import PG_ingest
+import PG_indexes
 import CSV2PG_tesco_card
 import CSV2PG_boots_card
 import CSV2PG_boots_products
 import CSV2PG_foodproducts
+import CSV2PG_dunnhumby
 
 
 def args_setup():
@@ -40,6 +44,26 @@ def args_setup():
     parser.add_argument(
         "--drop_column", action = "store", nargs = 2,
         help = "Delete column from table (specify both). Be careful, this operation is permanent.")
+    parser.add_argument(
+        "--partition", action = "store_true",
+        help = "Partition the transaction tables set to be partitioned in db_config.partition_by, if they aren't yet.")
+    parser.add_argument(
+        "--detach_before", action = "store", nargs = 2,
+        metavar = ("TABLE", "YYYY-MM-DD"),
+        help = "Detach the partitions of a table which end before a date. They are kept as tables of their own.")
+    parser.add_argument(
+        "--build_indexes", "--build-indexes", action = "store_true",
+        help = "Build the indexes the query templates need, printing which templates each one serves.")
+    parser.add_argument(
+        "--workers", type = int, default = 1,
+        metavar = "N",
+        help = "Indexes to build at the same time, with --build_indexes.")
+    parser.add_argument(
+        "--concurrently", action = "store_true",
+        help = "Build indexes CONCURRENTLY, so the tables can still be written to meanwhile.")
+    parser.add_argument(
+        "--brin_report", action = "store_true",
+        help = "Compare BRIN and B-tree indexes on each transaction table's date column, without keeping either. Each table can't be read or written while it is compared.")
 
     args = parser.parse_args()
 
@@ -122,9 +146,13 @@ def table_details(cursor):
     connection, cursor = connect_to_postgres(db_config)
 
     try:
+        #~ partitions are left out, they are listed under their table's name
         cursor.execute(f"""
             SELECT * FROM information_schema.tables
-            WHERE table_schema = 'public';""")
+            WHERE table_schema = 'public'
+            AND NOT EXISTS (
+                SELECT 1 FROM pg_class
+                WHERE relname = table_name AND relispartition);""")
         result = cursor.fetchall()
     except Exception as e:
         print("!!! Problem getting table details:", e)
@@ -160,8 +188,18 @@ def drop_table(table):
 
     sql = Template(f"""DROP TABLE IF EXISTS $table;""")
 
+    #~ summaries would be out of date without their table's rows,
+    #~ so go too. They are made again by the next load.
+    summaries = {
+        db_config.boots_transactions: [db_config.boots_daily_summary],
+        db_config.dunn_humby: [
+            db_config.dunn_humby_daily_summary,
+            db_config.dunn_humby_basket_facts]}
+
     try:
         cursor.execute(sql.substitute(table=table))
+        for summary in summaries.get(table, []):
+            cursor.execute(sql.substitute(table=summary))
         connection.commit()
         print(f"OK, table '{table}' dropped.")
     except Exception as e:
@@ -196,6 +234,120 @@ def drop_column(table, column):
         print("!!! Problem dropping column:", e)
 
 
+def partition_tables():
+
+    """
+    Converts each transaction table which db_config.partition_by
+    has an interval for, and which isn't partitioned yet, into a
+    partitioned table. Each is done in a transaction of its own,
+    so a failure leaves that table as it was.
+    """
+
+    #~ Create connection using psycopg2
+    connection, cursor = connect_to_postgres(db_config)
+
+    for table in [db_config.boots_transactions, db_config.tesco_transactions, db_config.dunn_humby]:
+        interval = PG_ingest.partition_interval(table)
+        if interval is None:
+            print(f"\n{table} is not set to be partitioned in db_config.partition_by.")
+            continue
+        cursor.execute("SELECT to_regclass(%s);", (table,))
+        if cursor.fetchone()[0] is None:
+            print(f"\n{table} doesn't exist yet, it will be partitioned when it is made.")
+            continue
+        try:
+            if table == db_config.dunn_humby:
+                CSV2PG_dunnhumby.partition_table(cursor)
+            else:
+                PG_ingest.partition_table(table, PG_indexes.date_columns()[table], interval, cursor)
+            connection.commit()
+        except Exception as e:
+            connection.rollback()
+            print(f"\n!!! Problem partitioning {table}, it has been left as it was:\n{e}")
+
+
+def detach_partitions(table, before):
+
+    """
+    Detaches the partitions of table whose dates all fall before the
+    date before. Detaching only changes the catalog, and is done
+    CONCURRENTLY, so queries and loads on table carry on meanwhile.
+    The partitions are left as ordinary tables, to be archived or
+    removed with --drop_table. Their days are taken out of the table's
+    daily summary and basket table, if it has these.
+    """
+
+    summaries = {
+        db_config.boots_transactions: [
+            (db_config.boots_daily_summary, "DATE2")],
+        db_config.dunn_humby: [
+            (db_config.dunn_humby_daily_summary, "SHOP_DATE"),
+            (db_config.dunn_humby_basket_facts, "SHOP_DATE")]}
+
+    try:
+        before = datetime.date.fromisoformat(before)
+    except ValueError:
+        print(f"\n!!! {before} is not a date, please give it as YYYY-MM-DD.")
+        return 1
+
+    #~ Create connection using psycopg2
+    connection, cursor = connect_to_postgres(db_config)
+    #~ DETACH ... CONCURRENTLY can't be run inside a transaction
+    connection.autocommit = True
+
+    table_summaries = summaries.get(table, [])
+    #~ the normalized dunn_humby is a view, its rows are in the items table
+    if table == db_config.dunn_humby and CSV2PG_dunnhumby.is_normalized(cursor):
+        table = db_config.dunn_humby_items
+
+    if not PG_ingest.is_partitioned(table, cursor):
+        print(f"\n!!! {table} is not a partitioned table.")
+        return 1
+
+    cursor.execute("""
+        SELECT partition.relname, pg_get_expr(partition.relpartbound, partition.oid)
+        FROM pg_inherits
+        JOIN pg_class AS partition ON partition.oid = pg_inherits.inhrelid
+        WHERE pg_inherits.inhparent = %s::regclass
+        ORDER BY partition.relname;""",
+        (table,))
+    partitions = cursor.fetchall()
+
+    sql = Template("""
+        ALTER TABLE $table DETACH PARTITION $partition CONCURRENTLY;""")
+
+    sql_summary = Template("""
+        DELETE FROM $summary
+        WHERE $date_column >= %s AND $date_column < %s;""")
+
+    detached = []
+    for partition, bounds in partitions:
+        #~ eg FOR VALUES FROM ('2021-02-01') TO ('2021-03-01')
+        start = re.search(r"FROM \('(\d{4}-\d{2}-\d{2})", bounds)
+        end = re.search(r"TO \('(\d{4}-\d{2}-\d{2})", bounds)
+        if end is None or datetime.date.fromisoformat(end[1]) > before:
+            continue
+        try:
+            cursor.execute(sql.substitute(table=table, partition=partition))
+            detached.append(partition)
+        except Exception as e:
+            print(f"\n!!! Problem detaching {partition}:\n{e}")
+            continue
+        if start is None:
+            continue
+        for summary, date_column in table_summaries:
+            cursor.execute("SELECT to_regclass(%s);", (summary,))
+            if cursor.fetchone()[0] is not None:
+                cursor.execute(
+                    sql_summary.substitute(summary=summary, date_column=date_column),
+                    (start[1], end[1]))
+
+    if detached:
+        print(f"\nOK, detached {len(detached)} partitions from {table}: {', '.join(detached)}")
+    else:
+        print(f"\nNo partitions of {table} end before {before}.")
+
+
 def main():
 
     parser, args = args_setup()
@@ -236,6 +388,18 @@ def main():
     if args.drop_table:
         drop_table(args.drop_table)
 
+    if args.partition:
+        partition_tables()
+
+    if args.detach_before:
+        detach_partitions(args.detach_before[0], args.detach_before[1])
+
+    if args.build_indexes:
+        PG_indexes.build_indexes(args.workers, args.concurrently)
+
+    if args.brin_report:
+        PG_indexes.brin_report()
+
 
 if __name__ == "__main__":
 
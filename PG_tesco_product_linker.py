@@ -0,0 +1,245 @@
+
+#~ Standard library imports
+import sys
+from string import Template
+import argparse
+
+#~ local imports
+import db_config
+import PG_status
+import PG_tesco_table_builder
+
+
+def args_setup():
+
+    parser = argparse.ArgumentParser(
+        description = "PostgreSQL: Tesco Product to food_products Linker",
+        epilog = "Example: python PG_tesco_product_linker.py")
+    parser.add_argument(
+        "--retry", action = "store_true",
+        help = "Try again to link the names no food product was found for, eg after importing more food products.")
+    parser.add_argument(
+        "--min_similarity", type = float, default = db_config.link_min_similarity,
+        help = f"How alike (0 to 1) a name and description must be to link (default {db_config.link_min_similarity}).")
+
+    args = parser.parse_args()
+
+    return parser, args
+
+
+def create_link_table(connection, cursor):
+
+    """
+    Create the table of links from Tesco products to food_products,
+    one row per tesco_products product_id. x_id is the food product
+    linked to, matched_on the food_products column its description was
+    in (x_tilldescr or x_descr) and score their trigram similarity.
+    Names which matched nothing have a row with x_id NULL, so they
+    aren't tried again unless asked (--retry).
+
+    Also adds pg_trgm and the trigram GIN indexes on x_tilldescr and
+    x_descr the matching looks names up with.
+    """
+
+    sql_extension = """
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;"""
+    sql_table = Template("""
+        CREATE TABLE IF NOT EXISTS $table (
+        product_id INT PRIMARY KEY,
+        product_name VARCHAR,
+        x_id INT,
+        matched_on VARCHAR,
+        score REAL,
+        linked_at TIMESTAMPTZ DEFAULT now());
+        CREATE INDEX IF NOT EXISTS ${table}_x_id_idx
+        ON $table (x_id);""")
+    sql_indexes = Template("""
+        CREATE INDEX IF NOT EXISTS ${food_table}_tilldescr_trgm_idx
+        ON $food_table USING GIN (x_tilldescr gin_trgm_ops);
+        CREATE INDEX IF NOT EXISTS ${food_table}_descr_trgm_idx
+        ON $food_table USING GIN (x_descr gin_trgm_ops);""")
+
+    try:
+        cursor.execute(sql_extension)
+        cursor.execute(sql_table.substitute(table=db_config.tesco_food_links))
+        cursor.execute(sql_indexes.substitute(food_table=db_config.food_products))
+        connection.commit()
+    except Exception as e:
+        connection.rollback()
+        print(e)
+        print(f"\n!!! Linking needs the pg_trgm extension and a {db_config.food_products} table.")
+        print(f"!!! Import food products with CSV2PG_foodproducts.py first.")
+        sys.exit(1)
+
+
+def link_products(
+    connection,
+    cursor,
+    min_similarity,
+    retry=False):
+
+    """
+    Links Tesco product names to food_products, a batch of names
+    (link_batch_size in db_config) per transaction, so a stopped run
+    keeps the batches it finished and the next carries on from there.
+
+    Only names without a row in the link table are matched, or with
+    retry, those whose row has no food product yet. Each is compared
+    with the x_tilldescr and x_descr of the food products which the
+    trigram indexes find are at least min_similarity alike, and the
+    most alike is kept, whichever column it is in.
+
+    Returns:
+        tuple:  (names looked at, names linked)
+    """
+
+    #~ %% is pg_trgm's % ("similar to", escaped for psycopg2), which uses
+    #~ similarity_threshold and the GIN indexes
+    sql_names = Template("""
+        SELECT product_id, product_name FROM $products AS products
+        WHERE product_name IS NOT NULL
+        AND product_id > %s
+        AND NOT EXISTS (
+            SELECT 1 FROM $table AS links
+            WHERE links.product_id = products.product_id)
+        ORDER BY product_id
+        LIMIT %s""")
+    if retry:
+        sql_names = Template("""
+            SELECT product_id, product_name FROM $table
+            WHERE x_id IS NULL
+            AND product_id > %s
+            ORDER BY product_id
+            LIMIT %s""")
+    sql_link = Template("""
+        WITH names AS ($names)
+        INSERT INTO $table (product_id, product_name, x_id, matched_on, score)
+        SELECT names.product_id, names.product_name, best.x_id, best.matched_on, best.score
+        FROM names
+        LEFT JOIN LATERAL (
+            SELECT x_id, matched_on, score FROM (
+                SELECT x_id, 'x_tilldescr' AS matched_on,
+                similarity(x_tilldescr, names.product_name) AS score
+                FROM $food_table WHERE x_tilldescr %% names.product_name
+                UNION ALL
+                SELECT x_id, 'x_descr' AS matched_on,
+                similarity(x_descr, names.product_name) AS score
+                FROM $food_table WHERE x_descr %% names.product_name
+            ) AS candidates
+            ORDER BY score DESC, x_id
+            LIMIT 1
+        ) AS best ON true
+        ON CONFLICT (product_id) DO UPDATE SET
+        x_id = EXCLUDED.x_id,
+        matched_on = EXCLUDED.matched_on,
+        score = EXCLUDED.score,
+        linked_at = now()
+        RETURNING product_id, x_id;""")
+
+    sql = sql_link.substitute(
+        names=sql_names.substitute(
+            table=db_config.tesco_food_links,
+            products=db_config.tesco_products),
+        table=db_config.tesco_food_links,
+        food_table=db_config.food_products)
+
+    name_count = 0
+    link_count = 0
+    last_id = 0
+    try:
+        while True:
+            cursor.execute(
+                "SELECT set_config('pg_trgm.similarity_threshold', %s, true);",
+                (str(min_similarity),))
+            cursor.execute(sql, (last_id, db_config.link_batch_size))
+            result = cursor.fetchall()
+            connection.commit()
+            if not result:
+                break
+            last_id = max(product_id for product_id, x_id in result)
+            name_count += len(result)
+            link_count += sum(1 for product_id, x_id in result if x_id is not None)
+            print(f"{name_count} names looked at, {link_count} linked...")
+    except KeyboardInterrupt:
+        connection.rollback()
+        print(f"\nOK, stopping. The {name_count} names looked at so far are kept.")
+        raise
+    except Exception as e:
+        connection.rollback()
+        print(e)
+
+    return name_count, link_count
+
+
+def link_details(connection, cursor):
+
+    """
+    Return how many Tesco products are linked to a food product, and how
+    closely, and how many transactions that covers.
+    """
+
+    sql_links = Template("""
+        SELECT COUNT(*), COUNT(x_id),
+        COUNT(*) FILTER (WHERE score >= 0.6),
+        round(avg(score)::numeric, 2)
+        FROM $table;""")
+    sql_products = Template("""
+        SELECT COUNT(*) FROM $products;""")
+    sql_transactions = Template("""
+        SELECT COUNT(*), COUNT(links.x_id)
+        FROM $transactions AS transactions
+        LEFT JOIN $table AS links
+        ON links.product_id = transactions.product_id;""")
+
+    try:
+        cursor.execute(sql_products.substitute(products=db_config.tesco_products))
+        product_count = cursor.fetchone()[0]
+        cursor.execute(sql_links.substitute(table=db_config.tesco_food_links))
+        tried, linked, close, average = cursor.fetchone()
+        cursor.execute(sql_transactions.substitute(
+            table=db_config.tesco_food_links,
+            transactions=db_config.tesco_transactions))
+        transaction_count, transactions_linked = cursor.fetchone()
+        print(f"\n{db_config.tesco_food_links} details:")
+        print(f"Products:            {product_count}")
+        print(f"Not yet looked at:   {product_count - tried}")
+        print(f"Linked:              {linked} (average score {average})")
+        print(f"Score 0.6 or more:   {close}")
+        print(f"No match found:      {tried - linked}")
+        print(f"Transactions linked: {transactions_linked} of {transaction_count}")
+    except Exception as e:
+        connection.rollback()
+        print(e)
+
+
+def main():
+
+    parser, args = args_setup()
+
+    #~ Create connection using psycopg2
+    connection, cursor = PG_status.connect_to_postgres(db_config)
+
+    #~ names come from tesco_products, so bring it up to date first
+    PG_tesco_table_builder.create_product_table(connection, cursor,)
+    PG_tesco_table_builder.populate_product_table_from_transaction_table(connection, cursor,)
+
+    create_link_table(connection, cursor,)
+
+    name_count, link_count = link_products(
+        connection,
+        cursor,
+        args.min_similarity,
+        args.retry)
+    print(f"\nOK, {name_count} names looked at, {link_count} linked to a food product.")
+
+    link_details(connection, cursor,)
+
+    connection.close()
+
+
+if __name__ == "__main__":
+
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("OK, stopping.")
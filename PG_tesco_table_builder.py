@@ -35,18 +35,52 @@ def create_product_table(connection, cursor):
     from the tesco transaction table, being assigned an integer
     as a product ID. There is only one useful field in the transaction
     data: the product name. Other fields are either not used or inaccurate.
+
+    product_id is taken from a sequence. A table made before this
+    has its products without an id given one.
+
+    tesco_transactions gets a product_id column too, if it hasn't got
+    one, which the builder fills in. Rows still without one are the
+    ones loaded since the builder last ran, and a partial index keeps
+    just those, so each run only reads new rows.
+
+    Exits if any of this fails, as populating needs all of it.
     """
 
     sql = Template("""
+        CREATE SEQUENCE IF NOT EXISTS ${table}_product_id_seq AS INT;
         CREATE TABLE IF NOT EXISTS $table (
-        product_id INT UNIQUE,
-        product_name VARCHAR UNIQUE);""")
+        product_id INT UNIQUE DEFAULT nextval('${table}_product_id_seq'),
+        product_name VARCHAR UNIQUE);
+        ALTER SEQUENCE ${table}_product_id_seq OWNED BY $table.product_id;
+        ALTER TABLE $table
+        ALTER COLUMN product_id SET DEFAULT nextval('${table}_product_id_seq');""")
+    sql_missing_ids = Template("""
+        SELECT setval('${table}_product_id_seq', max(product_id))
+        FROM $table HAVING max(product_id) IS NOT NULL;
+        UPDATE $table SET product_id = nextval('${table}_product_id_seq')
+        WHERE product_id IS NULL;""")
+    sql_transactions = Template("""
+        ALTER TABLE $transactions
+        ADD COLUMN IF NOT EXISTS product_id INT;
+        CREATE INDEX IF NOT EXISTS ${transactions}_new_products_idx
+        ON $transactions (product_name) WHERE product_id IS NULL;""")
 
     try:
-        cursor.execute(sql.substitute(table="tesco_products"))
+        cursor.execute(sql.substitute(table=db_config.tesco_products))
+        cursor.execute(
+            f"SELECT EXISTS (SELECT 1 FROM {db_config.tesco_products} WHERE product_id IS NULL);")
+        if cursor.fetchone()[0]:
+            cursor.execute(sql_missing_ids.substitute(table=db_config.tesco_products))
+            print(f"\nGave {cursor.rowcount} existing products an id.")
+        cursor.execute(sql_transactions.substitute(transactions=db_config.tesco_transactions))
         connection.commit()
     except Exception as e:
+        connection.rollback()
         print(e)
+        print(f"\n!!! Could not set up {db_config.tesco_products}, or product_id on {db_config.tesco_transactions}.")
+        print(f"!!! Import Tesco transactions with CSV2PG_tesco_card.py first.")
+        sys.exit(1)
 
 
 def populate_product_table_from_transaction_table(
@@ -54,26 +88,46 @@ def populate_product_table_from_transaction_table(
     cursor,):
 
     """
-    options:
-    1. copy the whole thing, chop off columns and dups.
-    2. go through each line, is it in other table, if not, in it goes
-    3. something like
-        CREATE TABLE tesco_products AS
-        SELECT * FROM tesco_transactions;
-        but dealing with dups and adding INT column?
+    Adds the product names of transactions loaded since the last run
+    to the product table, then writes each one's product_id back into
+    tesco_transactions, so they can be joined and grouped on an INT
+    rather than the name. Transactions without a product name are
+    left without an id.
     """
 
-    #~ move each transaction item to product table on unique NAME
-    sql = Template("""
+    #~ the NOT EXISTS is so names already present don't use up sequence values
+    sql_products = Template("""
         INSERT INTO $table (product_name)
-        SELECT product_name FROM tesco_transactions
+        SELECT DISTINCT product_name FROM $transactions AS transactions
+        WHERE product_id IS NULL
+        AND product_name IS NOT NULL
+        AND NOT EXISTS (
+            SELECT 1 FROM $table AS existing
+            WHERE existing.product_name = transactions.product_name)
+        ORDER BY product_name
         ON CONFLICT DO NOTHING;""")
+    sql_transactions = Template("""
+        UPDATE $transactions AS transactions
+        SET product_id = products.product_id
+        FROM $table AS products
+        WHERE transactions.product_id IS NULL
+        AND products.product_name = transactions.product_name;""")
 
     try:
-        cursor.execute(sql.substitute(table="tesco_products"))
+        #~ one builder at a time, loads can carry on meanwhile
+        cursor.execute(f"LOCK TABLE {db_config.tesco_products} IN SHARE ROW EXCLUSIVE MODE;")
+        cursor.execute(sql_products.substitute(
+            table=db_config.tesco_products,
+            transactions=db_config.tesco_transactions))
+        product_count = cursor.rowcount
+        cursor.execute(sql_transactions.substitute(
+            table=db_config.tesco_products,
+            transactions=db_config.tesco_transactions))
+        transaction_count = cursor.rowcount
         connection.commit()
-        print(f"\nOK, product names copied from transaction to products.")
+        print(f"\nOK, {product_count} new products added, {transaction_count} transactions given their product_id.")
     except Exception as e:
+        connection.rollback()
         print(e)
 
 
@@ -15,4 +15,45 @@ boots_products = "boots_products"
 tesco_transactions = "tesco_transactions"
 tesco_products = "tesco_products"
 dunn_humby = "dunn_humby"
-food_products = "food_products"
\ No newline at end of file
+dunn_humby_items = "dunn_humby_items"
+dunn_humby_products = "dunn_humby_products"
+dunn_humby_customers = "dunn_humby_customers"
+dunn_humby_baskets = "dunn_humby_baskets"
+dunn_humby_stores = "dunn_humby_stores"
+boots_daily_summary = "boots_daily_summary"
+dunn_humby_daily_summary = "dunn_humby_daily_summary"
+dunn_humby_basket_facts = "dunn_humby_basket_facts"
+food_products = "food_products"
+tesco_food_links = "tesco_food_links"
+ingest_manifest = "ingest_manifest"
+ingest_checkpoints = "ingest_checkpoints"
+
+#~ bytes read from the client per round trip when streaming COPY ... FROM STDIN.
+#~ larger chunks mean fewer round trips, memory use stays flat regardless.
+copy_chunk_size = 1024 * 1024
+
+#~ memory for each index build, after a --bulk load or with PG_status.py --build_indexes.
+bulk_maintenance_work_mem = "1GB"
+
+#~ how closely a date column must follow the order rows are stored in (from 0
+#~ to 1) for PG_status.py --build_indexes to give it a BRIN index, not a B-tree.
+brin_min_correlation = 0.9
+
+#~ the text search configuration product descriptions are indexed and
+#~ searched with (--search in the queriers), see \dF in psql for others.
+search_language = "english"
+
+#~ how alike (from 0 to 1, by trigram similarity) a Tesco product name and a
+#~ food_products description must be for PG_tesco_product_linker.py to link
+#~ them, and how many names it links per transaction.
+link_min_similarity = 0.3
+link_batch_size = 1000
+
+#~ opt-in partitioning of the transaction tables by shop date. Set a table to
+#~ "month" or "week" and it is made with a partition per month or week, which
+#~ the loaders add as new dates arrive. A table made before this was set is
+#~ converted with: python PG_status.py --partition
+partition_by = {
+    boots_transactions: None,
+    tesco_transactions: None,
+    dunn_humby: None}
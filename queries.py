@@ -19,17 +19,17 @@ def customer_records_for_product_from_date_from_store(join):
         return Template("""
             SELECT $record_type FROM $table
             LEFT JOIN $product_table
-            ON $card_table.ITEM_CODE = $product_table.productid
+            ON $card_table.PRODUCT_KEY = $product_table.PRODUCT_KEY
             WHERE DATE2 = '$date'
             AND ITEM_CODE = '$product'
-            AND STORE LIKE '%$store%'
+            AND STORE_CODE = '$store'
             AND ID = '$customer';""")
     else:
         return Template("""
             SELECT $record_type FROM $table
             WHERE DATE2 = '$date'
             AND ITEM_CODE = '$product'
-            AND STORE LIKE '%$store%'
+            AND STORE_CODE = '$store'
             AND ID = '$customer';""")
 
 
@@ -39,11 +39,11 @@ def customer_records_for_product_from_date_range_from_store(join):
         return Template("""
             SELECT $record_type FROM $table
             LEFT JOIN $product_table
-            ON $card_table.ITEM_CODE = $product_table.productid
+            ON $card_table.PRODUCT_KEY = $product_table.PRODUCT_KEY
             WHERE DATE2 >= '$start_date'
             AND DATE2 <= '$end_date'
             AND ITEM_CODE = '$product'
-            AND STORE LIKE '%$store%'
+            AND STORE_CODE = '$store'
             AND ID = '$customer';""")
     else:
         return Template("""
@@ -51,7 +51,7 @@ def customer_records_for_product_from_date_range_from_store(join):
             WHERE DATE2 >= '$start_date'
             AND DATE2 <= '$end_date'
             AND ITEM_CODE = '$product'
-            AND STORE LIKE '%$store%'
+            AND STORE_CODE = '$store'
             AND ID = '$customer';""")
 
 
@@ -62,15 +62,15 @@ def customer_records_from_store_from_date(join):
         return Template("""
             SELECT $record_type FROM $table
             LEFT JOIN $product_table
-            ON $card_table.ITEM_CODE = $product_table.productid
+            ON $card_table.PRODUCT_KEY = $product_table.PRODUCT_KEY
             WHERE DATE2 = '$date'
-            AND STORE LIKE '%$store%'
+            AND STORE_CODE = '$store'
             AND ID = '$customer';""")
     else:
         return Template("""
             SELECT $record_type FROM $table
             WHERE DATE2 = '$date'
-            AND STORE LIKE '%$store%'
+            AND STORE_CODE = '$store'
             AND ID = '$customer';""")
 
 
@@ -80,17 +80,17 @@ def customer_records_from_store_from_date_range(join):
         return Template("""
             SELECT $record_type FROM $table
             LEFT JOIN $product_table
-            ON $card_table.ITEM_CODE = $product_table.productid
+            ON $card_table.PRODUCT_KEY = $product_table.PRODUCT_KEY
             WHERE DATE2 >= '$start_date'
             AND DATE2 <= '$end_date'
-            AND STORE LIKE '%$store%'
+            AND STORE_CODE = '$store'
             AND ID = '$customer';""")
     else:
         return Template("""
             SELECT $record_type FROM $table
             WHERE DATE2 >= '$start_date'
             AND DATE2 <= '$end_date'
-            AND STORE LIKE '%$store%'
+            AND STORE_CODE = '$store'
             AND ID = '$customer';""")
 
 
@@ -100,16 +100,16 @@ def product_records_from_store_from_date(join):
         return Template("""
             SELECT $record_type FROM $table
             LEFT JOIN $product_table
-            ON $card_table.ITEM_CODE = $product_table.productid
+            ON $card_table.PRODUCT_KEY = $product_table.PRODUCT_KEY
             WHERE DATE2 = '$date'
             AND ITEM_CODE = '$product'
-            AND STORE LIKE '%$store%';""")
+            AND STORE_CODE = '$store';""")
     else:
         return Template("""
             SELECT $record_type FROM $table
             WHERE DATE2 = '$date'
             AND ITEM_CODE = '$product'
-            AND STORE LIKE '%$store%';""")
+            AND STORE_CODE = '$store';""")
 
 
 def product_records_from_store_from_date_range(join):
@@ -118,18 +118,18 @@ def product_records_from_store_from_date_range(join):
         return Template("""
             SELECT $record_type FROM $table
             LEFT JOIN $product_table
-            ON $card_table.ITEM_CODE = $product_table.productid
+            ON $card_table.PRODUCT_KEY = $product_table.PRODUCT_KEY
             WHERE DATE2 >= '$start_date'
             AND DATE2 <= '$end_date'
             AND ITEM_CODE = '$product'
-            AND STORE LIKE '%$store%';""")
+            AND STORE_CODE = '$store';""")
     else:
         return Template("""
             SELECT $record_type FROM $table
             WHERE DATE2 >= '$start_date'
             AND DATE2 <= '$end_date'
             AND ITEM_CODE = '$product'
-            AND STORE LIKE '%$store%';""")
+            AND STORE_CODE = '$store';""")
 
 
 def customer_records_for_product_from_store(join):
@@ -138,16 +138,16 @@ def customer_records_for_product_from_store(join):
         return Template("""
             SELECT $record_type FROM $table
             LEFT JOIN $product_table
-            ON $card_table.ITEM_CODE = $product_table.productid
+            ON $card_table.PRODUCT_KEY = $product_table.PRODUCT_KEY
             WHERE ID = '$customer'
             AND ITEM_CODE = '$product'
-            AND STORE LIKE '%$store%';""")
+            AND STORE_CODE = '$store';""")
     else:
         return Template("""
             SELECT $record_type FROM $table
             WHERE ID = '$customer'
             AND ITEM_CODE = '$product'
-            AND STORE LIKE '%$store%';""")
+            AND STORE_CODE = '$store';""")
 
 
 def customer_records_for_product_from_date(join):
@@ -156,7 +156,7 @@ def customer_records_for_product_from_date(join):
         return Template("""
             SELECT $record_type FROM $table
             LEFT JOIN $product_table
-            ON $card_table.ITEM_CODE = $product_table.productid
+            ON $card_table.PRODUCT_KEY = $product_table.PRODUCT_KEY
             WHERE ID = '$customer'
             AND DATE2 = '$date'
             AND ITEM_CODE = '$product';""")
@@ -174,7 +174,7 @@ def customer_records_for_product_from_date_range(join):
         return Template("""
             SELECT $record_type FROM $table
             LEFT JOIN $product_table
-            ON $card_table.ITEM_CODE = $product_table.productid
+            ON $card_table.PRODUCT_KEY = $product_table.PRODUCT_KEY
             WHERE ID = '$customer'
             AND DATE2 >= '$start_date'
             AND DATE2 <= '$end_date'
@@ -195,7 +195,7 @@ def customer_records_for_product(join):
         return Template("""
             SELECT $record_type FROM $table
             LEFT JOIN $product_table
-            ON $card_table.ITEM_CODE = $product_table.productid
+            ON $card_table.PRODUCT_KEY = $product_table.PRODUCT_KEY
             WHERE ID = '$customer'
             AND ITEM_CODE = '$product';""")
     else:
@@ -211,7 +211,7 @@ def customer_records_from_date(join):
         return Template("""
             SELECT $record_type FROM $table
             LEFT JOIN $product_table
-            ON $card_table.ITEM_CODE = $product_table.productid
+            ON $card_table.PRODUCT_KEY = $product_table.PRODUCT_KEY
             WHERE DATE2 = '$date'
             AND ID = '$customer';""")
     else:
@@ -227,7 +227,7 @@ def customer_records_from_date_range(join):
         return Template("""
             SELECT $record_type FROM $table
             LEFT JOIN $product_table
-            ON $card_table.ITEM_CODE = $product_table.productid
+            ON $card_table.PRODUCT_KEY = $product_table.PRODUCT_KEY
             WHERE DATE2 >= '$start_date'
             AND DATE2 <= '$end_date'
             AND ID = '$customer';""")
@@ -245,7 +245,7 @@ def product_records_for_date(join):
         return Template("""
             SELECT $record_type FROM $table
             LEFT JOIN $product_table
-            ON $card_table.ITEM_CODE = $product_table.productid
+            ON $card_table.PRODUCT_KEY = $product_table.PRODUCT_KEY
             WHERE DATE2 = '$date'
             AND ITEM_CODE = '$product';""")
     else:
@@ -261,7 +261,7 @@ def product_records_for_date_range(join):
         return Template("""
             SELECT $record_type FROM $table
             LEFT JOIN $product_table
-            ON $card_table.ITEM_CODE = $product_table.productid
+            ON $card_table.PRODUCT_KEY = $product_table.PRODUCT_KEY
             WHERE DATE2 >= '$start_date'
             AND DATE2 <= '$end_date'
             AND ITEM_CODE = '$product';""")
@@ -279,13 +279,13 @@ def store_records_for_customer(join):
         return Template("""
             SELECT $record_type FROM $table
             LEFT JOIN $product_table
-            ON $card_table.ITEM_CODE = $product_table.productid
-            WHERE STORE LIKE '%$store%'
+            ON $card_table.PRODUCT_KEY = $product_table.PRODUCT_KEY
+            WHERE STORE_CODE = '$store'
             AND ID = '$customer';""")
     else:
         return Template("""
             SELECT $record_type FROM $table
-            WHERE STORE LIKE '%$store%'
+            WHERE STORE_CODE = '$store'
             AND ID = '$customer';""")
 
 
@@ -295,13 +295,13 @@ def store_records_for_product(join):
         return Template("""
             SELECT $record_type FROM $table
             LEFT JOIN $product_table
-            ON $card_table.ITEM_CODE = $product_table.productid
-            WHERE STORE LIKE '%$store%'
+            ON $card_table.PRODUCT_KEY = $product_table.PRODUCT_KEY
+            WHERE STORE_CODE = '$store'
             AND ITEM_CODE = '$product';""")
     else:
         return Template("""
             SELECT $record_type FROM $table
-            WHERE STORE LIKE '%$store%'
+            WHERE STORE_CODE = '$store'
             AND ITEM_CODE = '$product';""")
 
 
@@ -311,13 +311,13 @@ def store_records_for_date(join):
         return Template("""
             SELECT $record_type FROM $table
             LEFT JOIN $product_table
-            ON $card_table.ITEM_CODE = $product_table.productid
-            WHERE STORE LIKE '%$store%'
+            ON $card_table.PRODUCT_KEY = $product_table.PRODUCT_KEY
+            WHERE STORE_CODE = '$store'
             AND DATE2 = '$date';""")
     else:
         return Template("""
             SELECT $record_type FROM $table
-            WHERE STORE LIKE '%$store%'
+            WHERE STORE_CODE = '$store'
             AND DATE2 = '$date';""")
 
 
@@ -327,14 +327,14 @@ def store_records_for_date_range(join):
         return Template("""
             SELECT $record_type FROM $table
             LEFT JOIN $product_table
-            ON $card_table.ITEM_CODE = $product_table.productid
-            WHERE STORE LIKE '%$store%'
+            ON $card_table.PRODUCT_KEY = $product_table.PRODUCT_KEY
+            WHERE STORE_CODE = '$store'
             AND DATE2 >= '$start_date'
             AND DATE2 <= '$end_date';""")
     else:
         return Template("""
             SELECT $record_type FROM $table
-            WHERE STORE LIKE '%$store%'
+            WHERE STORE_CODE = '$store'
             AND DATE2 >= '$start_date'
             AND DATE2 <= '$end_date';""")
 
@@ -346,7 +346,7 @@ def all_records_from_product(join):
         return Template("""
             SELECT $record_type FROM $table
             LEFT JOIN $product_table
-            ON $card_table.ITEM_CODE = $product_table.productid
+            ON $card_table.PRODUCT_KEY = $product_table.PRODUCT_KEY
             WHERE ITEM_CODE = '$product';""")
     else:
         return Template("""
@@ -360,7 +360,7 @@ def all_records_from_date(join):
         return Template("""
             SELECT $record_type FROM $table
             LEFT JOIN $product_table
-            ON $card_table.ITEM_CODE = $product_table.productid
+            ON $card_table.PRODUCT_KEY = $product_table.PRODUCT_KEY
             WHERE DATE2 = '$date';""")
     else:
         return Template("""
@@ -374,7 +374,7 @@ def all_records_from_date_range(join):
         return Template("""
             SELECT $record_type FROM $table
             LEFT JOIN $product_table
-            ON $card_table.ITEM_CODE = $product_table.productid
+            ON $card_table.PRODUCT_KEY = $product_table.PRODUCT_KEY
             WHERE DATE2 >= '$start_date'
             AND DATE2 <= '$end_date';""")
     else:
@@ -390,7 +390,7 @@ def all_records_from_customer(join):
         return Template("""
             SELECT $record_type FROM $table
             LEFT JOIN $product_table
-            ON $card_table.ITEM_CODE = $product_table.productid
+            ON $card_table.PRODUCT_KEY = $product_table.PRODUCT_KEY
             WHERE ID = '$customer';""")
     else:
         return Template("""
@@ -404,10 +404,10 @@ def all_records_from_store(join):
         return Template("""
             SELECT $record_type FROM $table
             LEFT JOIN $product_table
-            ON $card_table.ITEM_CODE = $product_table.productid
-            WHERE STORE LIKE '%$store%';""")
+            ON $card_table.PRODUCT_KEY = $product_table.PRODUCT_KEY
+            WHERE STORE_CODE = '$store';""")
     else:
         return Template("""
             SELECT $record_type FROM $table
-            WHERE STORE LIKE '%$store%';""")
+            WHERE STORE_CODE = '$store';""")
 
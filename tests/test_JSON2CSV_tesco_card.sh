@@ -0,0 +1,25 @@
+#!/bin/sh
+echo "Testing JSON2CSV_tesco_card.py, just a moment..."
+
+#~ only the first list in "Purchase" holds the transactions, a second
+#~ list (here with one extra item) must not turn up in the CSV
+tmp=$(mktemp -d)
+cat > $tmp/two_purchases.json <<'EOF'
+{"Purchase": [
+  [{"storeId": "1001", "timeStamp": "2021-02-15 10:00:00", "product": [
+     {"name": "Bananas Loose", "quantity": 1, "channel": "In Store", "weightInGrams": 500.0, "price": 0.45, "volumeInLitres": 0.0},
+     {"name": "Hovis Bread, Wholemeal 800G", "quantity": 2, "channel": "In Store", "weightInGrams": 0.0, "price": 1.1, "volumeInLitres": 0.0}]},
+   {"storeId": "1002", "timeStamp": "2021-02-16 11:30:00", "product": [
+     {"name": "Tesco Semi Skimmed Milk 2.272L", "quantity": 1, "channel": "Online", "weightInGrams": 0.0, "price": 1.25, "volumeInLitres": 2.272}]}],
+  [{"storeId": "9999", "timeStamp": "2021-03-01 09:00:00", "product": [
+     {"name": "Not a transaction", "quantity": 1, "channel": "In Store", "weightInGrams": 0.0, "price": 9.99, "volumeInLitres": 0.0}]}]
+]}
+EOF
+
+echo "Testing an export with two Purchase lists"
+python JSON2CSV_tesco_card.py -i $tmp/two_purchases.json >/dev/null 2>&1 \
+    && [ "$(wc -l < $tmp/two_purchases.csv)" -eq 4 ] \
+    && ! grep -q "Not a transaction" $tmp/two_purchases.csv \
+    && echo "OK" || echo "Failed";
+
+rm -r $tmp